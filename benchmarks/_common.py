@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+"""
+Shared helpers for the benchmark scripts.
+
+Every benchmark prints a human readable table and, with ``--json PATH``, dumps the same measurements as JSON so
+they can be tracked between releases.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--json', metavar='PATH', help='Write the measurements as JSON to PATH')
+    return parser
+
+
+def timed(func, *args, **kwargs):
+    """ Run `func` once, after a full garbage collection, and return (elapsed seconds, result) """
+    gc.collect()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def best_of(repeat, func, *args, **kwargs):
+    """ Run `func` `repeat` times and return (fastest elapsed seconds, result of the last run) """
+    timings = []
+    for _ in range(repeat):
+        elapsed, result = timed(func, *args, **kwargs)
+        timings.append(elapsed)
+    return min(timings), result
+
+
+def report(name, measurements, json_path=None):
+    """
+    Print and optionally save a list of measurements.
+
+    :param name: name of the benchmark.
+    :param measurements: list of flat dicts, one per measured case.
+    :param json_path: if set, path of the JSON file to write.
+    """
+    columns = []
+    for measurement in measurements:
+        columns.extend(key for key in measurement if key not in columns)
+    widths = [max(len(col), *(len(_format(m.get(col))) for m in measurements)) for col in columns]
+    print('== {} =='.format(name))
+    print('  '.join(col.ljust(width) for col, width in zip(columns, widths)))
+    for measurement in measurements:
+        print('  '.join(_format(measurement.get(col)).ljust(width) for col, width in zip(columns, widths)))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'benchmark': name, 'measurements': measurements}, f, indent=2)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+    return '' if value is None else str(value)
@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+Time and peak memory of rendering large failure reports into TestRail comments: full ``str(longrepr)`` then slice,
+as the plugin used to, versus `CommentRenderer` reading the report fragments from the end or the start.
+
+Reports are real pytest exception representations, with an assertion message and a captured log section of
+``--size`` bytes each.
+
+    python benchmarks/bench_comments.py --size 1000000 --size 10000000
+"""
+import tracemalloc
+
+import pytest
+
+from _common import argument_parser, best_of, report
+from pytest_testrail.plugin import COMMENT_SIZE_LIMIT, COMMENT_STRATEGIES, CommentRenderer
+
+
+def make_report(size):
+    line = 'DEBUG connection pool: request sent, waiting for the response of the TestRail server\n'
+    log = line * (size // len(line))
+    try:
+        assert False, log
+    except AssertionError:
+        longrepr = pytest.ExceptionInfo.from_current().getrepr(showlocals=True)
+    longrepr.addsection('Captured log call', log)
+    return longrepr
+
+
+def str_renderer(limit):
+    return lambda longrepr: str(longrepr)[-limit:]
+
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--size', type=int, action='append', help='bytes of log in the report (repeatable)')
+    parser.add_argument('--limit', type=int, default=COMMENT_SIZE_LIMIT)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    measurements = []
+    for size in args.size or [1000000, 10000000]:
+        longrepr = make_report(size)
+        modes = [('str + slice', str_renderer(args.limit))]
+        modes.extend((strategy, CommentRenderer(args.limit, strategy).render) for strategy in COMMENT_STRATEGIES)
+        for name, render in modes:
+            elapsed, _ = best_of(args.repeat, render, longrepr)
+            measurements.append({
+                'mode': name,
+                'log_bytes': size,
+                'limit': args.limit,
+                'render_s': elapsed,
+                'peak_bytes': peak_memory(render, longrepr),
+            })
+    report('comments', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+"""
+Upload size and wall time of result batches with and without gzip request compression, against the local
+TestRail stub.
+
+Results carry realistic pytest failure representations, rendered by the plugin. The stub reads request bodies at
+``--bandwidth`` bytes per second to stand in for a slow link to the TestRail host.
+
+    python benchmarks/bench_compression.py --results 2000 --bandwidth 1000000
+"""
+from _common import argument_parser, report, timed
+from pytest_testrail.plugin import CaseResult, PyTestRailPlugin, TESTRAIL_TEST_STATUS, batch_results
+from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
+
+FAILURE = '''{path}:{line}: in test_case_{index}
+    response = client.send_post('add_results_for_cases/{run}', payload)
+{path}:{callee}: in send_post
+    return self._request('POST', url, headers=headers, json=data)
+E   AssertionError: assert {{'error': 'Field :results.case_id is not a valid test case.'}} == []
+E     Left contains 1 more item:
+E     {{'error': 'Field :results.case_id is not a valid test case.'}}
+E     Full diff:
+E     - []
+E     + {{'error': 'Field :results.case_id is not a valid test case.'}}'''
+
+
+def make_results(count):
+    results = []
+    for index in range(count):
+        failed = index % 3 == 0
+        path = 'tests/api/test_module_{}.py'.format(index % 40)
+        comment = '\n'.join(FAILURE.format(path=path, line=20 + index % 200, index=index, run=index % 7,
+                                           callee=100 + index % 50) for _ in range(1 + index % 4)) if failed else ''
+        results.append(CaseResult(index + 1, TESTRAIL_TEST_STATUS['failed' if failed else 'passed'], comment,
+                                  duration=0.1, test_parametrize={'index': index} if index % 2 else None))
+    return results
+
+
+def upload(url, batches, threshold):
+    with APIClient(url, 'user', 'key', compress_threshold=threshold) as client:
+        for batch in batches:
+            client.send_post('add_results_for_cases/1', {'results': batch})
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--results', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=250)
+    parser.add_argument('--bandwidth', type=int, default=1000000, help='bytes per second')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--threshold', type=int, default=1024)
+    args = parser.parse_args()
+
+    tr_plugin = PyTestRailPlugin(None, 1, 1, 1, False, True, None)
+    tr_plugin.results = make_results(args.results)
+    payload = tr_plugin.build_payload()
+    batches = list(batch_results(payload.entries, args.batch_size, 0, payload.sizes))
+
+    measurements = []
+    for name, threshold in (('uncompressed', None), ('gzip', args.threshold)):
+        with StubTestRailServer(latency=args.latency, bandwidth=args.bandwidth) as stub:
+            elapsed, _ = timed(upload, stub.url, batches, threshold)
+            measurements.append({
+                'mode': name,
+                'results': args.results,
+                'requests': len(stub.requests),
+                'payload_bytes': sum(len(request.body) for request in stub.requests),
+                'upload_bytes': stub.bytes_received,
+                'total_s': elapsed,
+            })
+    for measurement in measurements:
+        measurement['ratio'] = measurement['payload_bytes'] / float(measurement['upload_bytes'])
+    report('compression', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
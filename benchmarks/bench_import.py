@@ -0,0 +1,66 @@
+# -*- coding: UTF-8 -*-
+"""
+Import time of the plugin entry point, as loaded by every pytest run (``pytest_testrail.conftest``), versus the
+modules only needed once ``--testrail`` is used, measured with ``python -X importtime`` in fresh interpreters.
+
+Only the modules not already imported by pytest itself are counted. With ``--max-ms``, the script exits with an
+error when loading the entry point takes longer, to catch regressions (e.g. a module level import of requests).
+
+    python benchmarks/bench_import.py --repeat 10 --max-ms 20
+"""
+import subprocess
+import sys
+
+from _common import argument_parser, report
+
+BASELINE = 'import pytest'
+TARGETS = (
+    ('entry point', 'import pytest_testrail.conftest'),
+    ('--testrail', 'import pytest_testrail.conftest, pytest_testrail.plugin, pytest_testrail.testrail_api'),
+)
+
+
+def import_times(statement):
+    """ :return dict: import time in microseconds of each module imported by `statement`, without its imports """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(own)
+    return times
+
+
+def extra_imports(statement):
+    """ :return tuple: (microseconds, number of modules) imported by `statement` after pytest """
+    before = import_times(BASELINE)
+    after = import_times(BASELINE + '; ' + statement)
+    extra = [own for name, own in after.items() if name not in before]
+    return sum(extra), len(extra)
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, help='fail when the entry point takes longer to import')
+    args = parser.parse_args()
+
+    measurements = []
+    for name, statement in TARGETS:
+        runs = [extra_imports(statement) for _ in range(args.repeat)]
+        measurements.append({
+            'import': name,
+            'modules': min(modules for _, modules in runs),
+            'import_ms': min(us for us, _ in runs) / 1000.0,
+        })
+    report('import time', measurements, args.json)
+
+    if args.max_ms is not None and measurements[0]['import_ms'] > args.max_ms:
+        sys.exit('pytest_testrail.conftest took {:.1f}ms to import, more than {}ms'.format(
+            measurements[0]['import_ms'], args.max_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+"""
+Marker parsing cost over synthetic items: collection plus the three report phases of every item.
+
+"legacy" parses markers with string patterns during collection and again at each report phase, "indexed" parses
+them once during collection (`PyTestRailPlugin.index_items`) and looks them up afterwards.
+
+    python benchmarks/bench_markers.py --items 200000
+"""
+import re
+
+from _common import argument_parser, best_of, report
+from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_DEFECTS_PREFIX, TESTRAIL_PREFIX
+
+
+class FakeMark(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class FakeItem(object):
+    """ Minimal stand-in for a pytest item with testrail markers """
+
+    def __init__(self, index):
+        self.nodeid = 'tests/test_module.py::test_{}'.format(index)
+        self._markers = {TESTRAIL_PREFIX: FakeMark(ids=('C{}'.format(index), 'C{}'.format(index + 1)))}
+        if index % 10 == 0:
+            self._markers[TESTRAIL_DEFECTS_PREFIX] = FakeMark(defect_ids=('PF-{}'.format(index),))
+
+    def get_closest_marker(self, name):
+        return self._markers.get(name)
+
+
+def legacy_clean_test_ids(test_ids):
+    return [int(re.search('(?P<test_id>[0-9]+$)', test_id).groupdict().get('test_id')) for test_id in test_ids]
+
+
+def legacy_clean_test_defects(defect_ids):
+    return [(re.search('(?P<defect_id>.*)', defect_id).groupdict().get('defect_id')) for defect_id in defect_ids]
+
+
+def legacy(items):
+    keys = [(item, legacy_clean_test_ids(item.get_closest_marker(TESTRAIL_PREFIX).kwargs.get('ids')))
+            for item in items if item.get_closest_marker(TESTRAIL_PREFIX)]
+    for item in items:
+        for when in ('setup', 'call', 'teardown'):
+            if item.get_closest_marker(TESTRAIL_DEFECTS_PREFIX):
+                defectids = item.get_closest_marker(TESTRAIL_DEFECTS_PREFIX).kwargs.get('defect_ids')
+                str(legacy_clean_test_defects(defectids)).replace('[', '').replace(']', '').replace("'", '')
+            if item.get_closest_marker(TESTRAIL_PREFIX):
+                legacy_clean_test_ids(item.get_closest_marker(TESTRAIL_PREFIX).kwargs.get('ids'))
+    return keys
+
+
+def indexed(items):
+    plugin = PyTestRailPlugin(None, None, None, None, False, True, None)
+    keys = plugin.index_items(items)
+    for item in items:
+        for when in ('setup', 'call', 'teardown'):
+            plugin.get_item_keys(item)
+    return keys
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    items = [FakeItem(index) for index in range(args.items)]
+    measurements = []
+    for name, func in (('legacy', legacy), ('indexed', indexed)):
+        elapsed, _ = best_of(args.repeat, func, items)
+        measurements.append({
+            'mode': name,
+            'items': args.items,
+            'total_s': elapsed,
+            'per_item_us': elapsed / args.items * 1e6,
+        })
+    report('markers', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+"""
+Peak RSS of the recorded results, keeping full failure reports (previous dict based results) versus compact
+`CaseResult` records.
+
+Each mode runs in its own process, since peak RSS never decreases within a process (``ru_maxrss`` is read as
+kilobytes, as reported on Linux).
+
+    python benchmarks/bench_memory.py --items 100000 --failure-ratio 0.3
+"""
+import resource
+import subprocess
+import sys
+
+from _common import argument_parser, report, timed
+from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
+
+
+class FakeLongRepr(object):
+    """ Stands for a pytest failure report: traceback entries, locals reprs and captured output """
+
+    def __init__(self, index):
+        self.entries = ['  File "test_module.py", line {}, in test_{}\n    assert value == expected'.format(
+            line, index) for line in range(20)]
+        self.locals = dict(('var_{}'.format(var), 'x' * 200) for var in range(10))
+        self.captured = 'captured log line {}\n'.format(index) * 200
+
+    def __str__(self):
+        return '\n'.join(self.entries) + '\n' + self.captured
+
+
+def record_legacy(items, failure_ratio):
+    results = []
+    for index in range(items):
+        failed = index < items * failure_ratio
+        results.append({
+            'case_id': index,
+            'status_id': TESTRAIL_TEST_STATUS['failed' if failed else 'passed'],
+            'comment': FakeLongRepr(index) if failed else None,
+            'duration': 0.1,
+            'defects': None,
+            'test_parametrize': None
+        })
+    return results
+
+
+def record_compact(items, failure_ratio):
+    plugin = PyTestRailPlugin(None, None, None, None, False, True, None)
+    for index in range(items):
+        failed = index < items * failure_ratio
+        plugin.add_result([index], TESTRAIL_TEST_STATUS['failed' if failed else 'passed'],
+                          comment=FakeLongRepr(index) if failed else None, duration=0.1)
+    return plugin.results
+
+
+MODES = {'dict + longrepr': record_legacy, 'CaseResult': record_compact}
+
+
+def run_mode(mode, items, failure_ratio):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed, results = timed(MODES[mode], items, failure_ratio)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('{} {} {}'.format(elapsed, baseline, peak))
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--failure-ratio', type=float, default=0.3)
+    parser.add_argument('--mode', choices=sorted(MODES), help='Run a single mode in this process (internal)')
+    args = parser.parse_args()
+
+    if args.mode:
+        return run_mode(args.mode, args.items, args.failure_ratio)
+
+    measurements = []
+    for mode in MODES:
+        output = subprocess.check_output([sys.executable, __file__, '--mode', mode, '--items', str(args.items),
+                                          '--failure-ratio', str(args.failure_ratio)])
+        elapsed, baseline, peak = output.split()
+        measurements.append({
+            'mode': mode,
+            'items': args.items,
+            'record_s': float(elapsed),
+            'peak_rss_mb': int(peak) / 1024.0,
+            'results_rss_mb': (int(peak) - int(baseline)) / 1024.0,
+        })
+    report('memory', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: UTF-8 -*-
+"""
+Entries, request bodies and time to build the payload of a data-driven suite, where each TestRail case is mapped
+to ``--params`` parametrized items, with each merge policy.
+
+    python benchmarks/bench_merge.py --cases 200 --params 500
+"""
+from _common import argument_parser, best_of, report
+from pytest_testrail.plugin import MERGE_POLICIES, CaseResult, PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.serializers import json_dumps
+
+
+def make_results(cases, params):
+    results = []
+    for index in range(cases * params):
+        failed = index % 97 == 0
+        results.append(CaseResult(1 + index % cases, TESTRAIL_TEST_STATUS['failed' if failed else 'passed'],
+                                  'AssertionError: assert {} == 0'.format(index) if failed else '', duration=0.1,
+                                  test_parametrize={'value': index // cases, 'mode': 'fast'}))
+    return results
+
+
+def build(results, policy):
+    tr_plugin = PyTestRailPlugin(None, 1, 1, 1, False, True, None, merge_policy=policy)
+    tr_plugin.results = results
+    return tr_plugin.build_payload()
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--cases', type=int, default=200)
+    parser.add_argument('--params', type=int, default=500, help='parametrized items of each case')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = make_results(args.cases, args.params)
+    measurements = []
+    for policy in MERGE_POLICIES:
+        elapsed, payload = best_of(args.repeat, build, results, policy)
+        measurements.append({
+            'policy': policy,
+            'results': len(results),
+            'entries': len(payload.entries),
+            'body_bytes': len(json_dumps({'results': payload.entries})),
+            'build_s': elapsed,
+        })
+    report('merge', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: UTF-8 -*-
+"""
+Latency per API call with and without connection pooling, against the local TestRail stub.
+
+The stub sleeps ``--connect-latency`` seconds on every new TCP connection to stand in for the TCP/TLS handshake
+of a remote TestRail host.
+
+    python benchmarks/bench_pooling.py --calls 200 --connect-latency 0.05
+"""
+import requests
+
+from _common import argument_parser, report, timed
+from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
+
+
+def unpooled_calls(url, calls):
+    for run_id in range(calls):
+        requests.get(url + 'index.php?/api/v2/get_run/{}'.format(run_id), auth=('user', 'key')).json()
+
+
+def pooled_calls(url, calls):
+    with APIClient(url, 'user', 'key') as client:
+        for run_id in range(calls):
+            client.send_get('get_run/{}'.format(run_id))
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--connect-latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    measurements = []
+    for name, func in (('per-call connection', unpooled_calls), ('pooled session', pooled_calls)):
+        with StubTestRailServer(connect_latency=args.connect_latency) as stub:
+            elapsed, _ = timed(func, stub.url, args.calls)
+            measurements.append({
+                'mode': name,
+                'calls': args.calls,
+                'connections': stub.connections,
+                'total_s': elapsed,
+                'per_call_ms': elapsed / args.calls * 1000,
+            })
+    report('pooling', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
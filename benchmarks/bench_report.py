@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+"""
+Per-test overhead of the plugin on a no-op suite of ``--tests`` parametrized tests, each one mapped to a TestRail
+case, run by pytest in a fresh process.
+
+``no testrail`` runs the suite without ``--testrail``; ``legacy`` records results with the previous report hook
+(``dir(item)`` and the marker lookup at every phase of every test); ``testrail`` with the current one, which
+returns right away for setup and teardown reports that aren't errors. Results are recorded in offline mode, so the
+time spent publishing them doesn't depend on a server.
+
+    python benchmarks/bench_report.py --tests 100000
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from _common import argument_parser, report, timed
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PARAMS = 100
+
+SUITE = '''
+import pytest
+from pytest_testrail.plugin import pytestrail
+
+'''
+TEST = '''
+@pytestrail.case('C{index}')
+@pytest.mark.parametrize('value', range({params}))
+def test_{index}(value):
+    pass
+'''
+
+# Imported with -p before the plugin is registered, to restore the previous report hook
+LEGACY_HOOK = '''
+import pytest
+from pytest_testrail import plugin
+
+
+@pytest.hookimpl(tryfirst=True, hookwrapper=True)
+def legacy_makereport(self, item, call):
+    outcome = yield
+    rep = outcome.get_result()
+    if 'callspec' in dir(item):
+        test_parametrize = item.callspec.params
+    else:
+        test_parametrize = None
+    testcaseids, defects = self.get_item_keys(item)
+    if rep.when == 'call' and testcaseids:
+        self.add_result(testcaseids, plugin.get_test_outcome(rep.outcome), comment=rep.longrepr,
+                        duration=rep.duration, defects=defects, test_parametrize=test_parametrize)
+
+
+plugin.PyTestRailPlugin.pytest_runtest_makereport = legacy_makereport
+'''
+
+TESTRAIL_OPTIONS = ['--testrail', '--tr-offline', 'requests.log', '--tr-url', 'http://unreachable.invalid/',
+                    '--tr-email', 'user', '--tr-password', 'key', '--tr-testrun-project-id', '1',
+                    '--tr-testrun-suite-id', '1']
+MODES = (
+    ('no testrail', []),
+    ('legacy', ['-p', 'legacy_report'] + TESTRAIL_OPTIONS),
+    ('testrail', TESTRAIL_OPTIONS),
+)
+
+
+def write_suite(directory, tests):
+    with open(os.path.join(directory, 'test_suite.py'), 'w') as f:
+        f.write(SUITE)
+        for index in range(1, tests // PARAMS + 1):
+            f.write(TEST.format(index=index, params=PARAMS))
+    with open(os.path.join(directory, 'legacy_report.py'), 'w') as f:
+        f.write(LEGACY_HOOK)
+
+
+def run_suite(directory, options):
+    env = dict(os.environ, PYTEST_DISABLE_PLUGIN_AUTOLOAD='1',
+               PYTHONPATH=os.pathsep.join([directory, ROOT, os.environ.get('PYTHONPATH', '')]))
+    subprocess.run([sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', '-p', 'pytest_testrail.conftest',
+                    'test_suite.py'] + options, cwd=directory, env=env, stdout=subprocess.DEVNULL, check=True)
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--tests', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        write_suite(directory, args.tests)
+        tests = args.tests // PARAMS * PARAMS
+        timings = [(name, min(timed(run_suite, directory, options)[0] for _ in range(args.repeat)))
+                   for name, options in MODES]
+    finally:
+        shutil.rmtree(directory)
+
+    baseline = timings[0][1]
+    report('report hook', [{
+        'mode': name,
+        'tests': tests,
+        'total_s': elapsed,
+        'overhead_us_per_test': (elapsed - baseline) / tests * 1e6,
+    } for name, elapsed in timings], args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+"""
+Hot paths of the plugin at increasing numbers of items, from 1k to 1M by default:
+
+* ``collection``: markers of the collected items parsed once (`PyTestRailPlugin.index_items`);
+* ``report``: the report hook driven through the setup, call and teardown phases of every item;
+* ``payload``: recorded results rendered and split into encoded batches (`build_payload`);
+* ``setup``: testrun created with every testcase (``add_run``), against the local TestRail stub;
+* ``publish``: results published to the testruns of a testplan (``get_plan``, paginated ``get_tests`` and
+  ``add_results_for_cases``), against the local TestRail stub.
+
+The stub waits ``--latency`` seconds per request and answers ``429 Too Many Requests`` to every ``--throttle``-th
+request. Write the measurements with ``--json`` to compare them between commits.
+
+    python benchmarks/bench_scaling.py --scale 1000 --scale 100000 --latency 0.01 --throttle 20 --json scaling.json
+"""
+from _common import argument_parser, report, timed
+from bench_markers import FakeItem
+from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
+
+SCALES = (1000, 10000, 100000, 1000000)
+FAILURE = '''tests/test_module.py:42: in test_case
+    assert response.status_code == 200
+E   AssertionError: assert 500 == 200'''
+
+
+class FakeReport(object):
+    def __init__(self, when, outcome, longrepr=None):
+        self.when = when
+        self.outcome = outcome
+        self.failed = outcome == 'failed'
+        self.longrepr = longrepr
+        self.duration = 0.001
+
+
+class FakeOutcome(object):
+    def __init__(self, report):
+        self.report = report
+
+    def get_result(self):
+        return self.report
+
+
+PASSED = [FakeOutcome(FakeReport(when, 'passed')) for when in ('setup', 'call', 'teardown')]
+FAILED = [PASSED[0], FakeOutcome(FakeReport('call', 'failed', FAILURE)), PASSED[2]]
+
+
+def run_reports(tr_plugin, items):
+    for index, item in enumerate(items):
+        for outcome in FAILED if index % 10 == 0 else PASSED:
+            hook = tr_plugin.pytest_runtest_makereport(item, None)
+            next(hook)
+            try:
+                hook.send(outcome)
+            except StopIteration:
+                pass
+
+
+def build_batches(tr_plugin, client):
+    payload = tr_plugin.build_payload()
+    return payload.batches(tr_plugin.batch_size, tr_plugin.batch_max_bytes, client.encode)
+
+
+def in_process(items, client):
+    tr_plugin = PyTestRailPlugin(client, 1, 1, 1, False, True, 'bench')
+    measurements = []
+    for path, func, func_args in (('collection', tr_plugin.index_items, (items,)),
+                                  ('report', run_reports, (tr_plugin, items)),
+                                  ('payload', build_batches, (tr_plugin, client))):
+        elapsed, _ = timed(func, *func_args)
+        measurements.append({'path': path, 'total_s': elapsed})
+    return tr_plugin, measurements
+
+
+def against_stub(tr_plugin, case_ids, args):
+    stub = StubTestRailServer(latency=args.latency, throttle=args.throttle, retry_after=args.retry_after)
+    stub.page_size = args.page_size
+    stub.tests = [{'case_id': case_id, 'status_id': TESTRAIL_TEST_STATUS['untested']} for case_id in case_ids]
+    stub.plan = {'id': 1, 'is_completed': False, 'entries': [
+        {'runs': [{'id': run_id, 'is_completed': False}]} for run_id in range(1, args.runs + 1)]}
+    measurements = []
+    with stub, APIClient(stub.url, 'user', 'key') as client:
+        tr_plugin.client = client
+        tr_plugin.publish_blocked = False  # lists the tests of every testrun
+        for path, func, func_args in (('setup', tr_plugin.prepare_testrun, (case_ids,)),
+                                      ('publish', publish_to_testplan, (tr_plugin,))):
+            requests = len(stub.requests)
+            elapsed, _ = timed(func, *func_args)
+            measurements.append({'path': path, 'total_s': elapsed, 'requests': len(stub.requests) - requests})
+        throttled = client.throttle_stats.too_many_requests
+    return measurements, throttled
+
+
+def publish_to_testplan(tr_plugin):
+    tr_plugin.testplan_id = 1
+    tr_plugin.publish_to_testruns(tr_plugin.get_available_testruns(tr_plugin.testplan_id))
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--scale', type=int, action='append', help='number of items (repeatable)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request of the stub')
+    parser.add_argument('--throttle', type=int, default=None, help='answer 429 to every N-th request')
+    parser.add_argument('--retry-after', type=float, default=0, help='Retry-After of the 429 responses')
+    parser.add_argument('--page-size', type=int, default=250, help='tests per page of get_tests')
+    parser.add_argument('--runs', type=int, default=2, help='testruns of the testplan')
+    args = parser.parse_args()
+
+    measurements = []
+    for scale in args.scale or SCALES:
+        items = [FakeItem(index) for index in range(1, scale + 1)]
+        case_ids = list(range(1, scale + 2))
+        with APIClient('http://localhost/', 'user', 'key') as client:  # only encodes the batches
+            tr_plugin, timings = in_process(items, client)
+        stub_timings, throttled = against_stub(tr_plugin, case_ids, args)
+        for timing in timings + stub_timings:
+            timing.update(items=scale, results=len(tr_plugin.results), per_item_us=timing['total_s'] / scale * 1e6)
+            if timing['path'] == 'publish':
+                timing['throttled'] = throttled
+            measurements.append(timing)
+    report('scaling', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+Time spent serializing the result batches of a session, with each JSON serializer installed, when the same results
+are published to every testrun of a testplan.
+
+``per run`` serializes the batches again for each testrun, as the plugin used to; ``once`` serializes them once and
+sends the same bytes to every testrun (`ResultsPayload.batches`).
+
+    python benchmarks/bench_serializers.py --results 50000 --runs 5
+"""
+from _common import argument_parser, best_of, report
+from bench_compression import make_results
+from pytest_testrail.plugin import PyTestRailPlugin, ResultsPayload
+from pytest_testrail.serializers import available_serializers, get_serializer
+
+
+def encode_per_run(payload, runs, batch_size, dumps):
+    for _ in range(runs):
+        for _, data in ResultsPayload(payload.entries, payload.sizes).batches(batch_size, 0):
+            dumps(data)
+
+
+def encode_once(payload, runs, batch_size, dumps):
+    shared = ResultsPayload(payload.entries, payload.sizes)
+    for _ in range(runs):
+        shared.batches(batch_size, 0, dumps)
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--results', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=5, help='testruns of the testplan')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tr_plugin = PyTestRailPlugin(None, 1, 1, 1, False, True, None)
+    tr_plugin.results = make_results(args.results)
+    payload = tr_plugin.build_payload()
+
+    measurements = []
+    for name in available_serializers():
+        _, dumps = get_serializer(name)
+        body_bytes = sum(len(dumps(data)) for _, data in payload.batches(args.batch_size, 0))
+        for mode, func in (('per run', encode_per_run), ('once', encode_once)):
+            elapsed, _ = best_of(args.repeat, func, payload, args.runs, args.batch_size, dumps)
+            measurements.append({
+                'serializer': name,
+                'mode': mode,
+                'results': args.results,
+                'runs': args.runs,
+                'body_bytes': body_bytes,
+                'encode_s': elapsed,
+            })
+    report('serializers', measurements, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# -*- coding: UTF-8 -*-
+#
+# Asynchronous flavour of the TestRail API binding (Python 3.7+).
+#
+# Requests go through aiohttp when it is installed, and through the pooled requests session of APIClient run in a
+# thread pool otherwise.
+#
+import asyncio
+import base64
+import gzip
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .testrail_api import (COMPRESS_LEVEL, COMPRESSION_REJECTED_STATUSES, IDEMPOTENT_POST_METHODS, RETRY_EXCEPTIONS,
+                           APIClient, request_not_sent)
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - depends on the environment
+    aiohttp = None
+
+# Errors of the transports, returned as {'error': ...} responses like APIClient does. Requests failing with
+# RETRY_TRANSPORT_ERRORS are sent again, with the retry policy of APIClient.
+if aiohttp is not None:
+    TRANSPORT_ERRORS = (requests.RequestException, aiohttp.ClientError, asyncio.TimeoutError)
+    RETRY_TRANSPORT_ERRORS = RETRY_EXCEPTIONS + (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+else:  # pragma: no cover - depends on the environment
+    TRANSPORT_ERRORS = (requests.RequestException, asyncio.TimeoutError)
+    RETRY_TRANSPORT_ERRORS = RETRY_EXCEPTIONS + (asyncio.TimeoutError,)
+
+DEFAULT_CONCURRENCY = 4
+
+
+class AsyncAPIClient(object):
+    '''
+    TestRail API client for asyncio, with the same `send_get` / `send_post` / `get_error` surface as `APIClient`.
+
+    At most `concurrency` requests are in flight at the same time. Requests go through the rate limiter of the
+    underlying `APIClient`: on a ``429`` response, every request of the client is held for the ``Retry-After`` delay,
+    then the request is scheduled again, up to `rate_limit_retries` times. Requests failing with a connection error,
+    a timeout or a 5xx response are sent again with the retry policy of `APIClient`. Transport errors and responses
+    which are not JSON are returned as ``{'error': ...}`` responses, as `APIClient` does.
+    '''
+
+    get_error = staticmethod(APIClient.get_error)
+
+    def __init__(self, base_url, user, password, concurrency=DEFAULT_CONCURRENCY, **kwargs):
+        '''
+        Instantiate the AsyncAPIClient class.
+
+        :param base_url: The same TestRail address for the API client you also use to access TestRail with your web
+            browser (e.g., https://<your-name>.testrail.com/ or http://<server>/testrail/).
+        :type base_url: str
+        :param user: Username for the account on the TestRail server.
+        :type user: str
+        :param password: Password for the account on the TestRail server.
+        :type password: str
+        :param concurrency: (optional) Maximum number of requests in flight. Defaults to ``4``.
+        :type concurrency: int
+        :param use_aiohttp: (optional) Send requests with aiohttp. Defaults to ``True`` when aiohttp is installed.
+        :type use_aiohttp: bool
+
+        Other keyword arguments (`headers`, `cert_check`, `timeout`, `rate_limit`, `rate_limit_retries`, `retries`,
+        `retry_backoff`, `compress_threshold`, `serializer`) are the ones of `APIClient`.
+        '''
+        self.concurrency = max(int(concurrency or DEFAULT_CONCURRENCY), 1)
+        self.use_aiohttp = aiohttp is not None if kwargs.get('use_aiohttp') is None else kwargs['use_aiohttp']
+        if self.use_aiohttp and aiohttp is None:
+            raise ImportError('aiohttp is required to send requests with aiohttp')
+        kwargs['pool_size'] = self.concurrency
+        self._sync_client = APIClient(base_url, user, password, **kwargs)
+        self._semaphore = None
+        self._session = None
+        self._executor = None
+
+    @property
+    def user(self):
+        return self._sync_client.user
+
+    @property
+    def headers(self):
+        return self._sync_client.headers
+
+    @property
+    def cert_check(self):
+        return self._sync_client.cert_check
+
+    @property
+    def timeout(self):
+        return self._sync_client.timeout
+
+    def run(self, coroutine):
+        '''
+        Run a coroutine using this client in a new event loop, and release connections once it is done.
+
+        :return: the result of the coroutine.
+        '''
+        async def main():
+            try:
+                return await coroutine
+            finally:
+                await self.aclose()
+        return asyncio.run(main())
+
+    async def aclose(self):
+        '''
+        Close the HTTP session and release its connections.
+        '''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._sync_client.close()
+        self._semaphore = None
+
+    @property
+    def rate_limiter(self):
+        return self._sync_client.rate_limiter
+
+    @property
+    def throttle_stats(self):
+        return self._sync_client.throttle_stats
+
+    def throttle(self, pause):
+        '''
+        Hold every request of this client for `pause` seconds.
+        '''
+        self.rate_limiter.pause(pause)
+
+    async def send_get(self, uri, **kwargs):
+        '''
+        Send GET
+
+        Issues a GET request (read) against the API and returns the result (as Python dict).
+        Accepts the same optional arguments as `APIClient.send_get`.
+        '''
+        return await self._send('GET', uri, None, **kwargs)
+
+    async def send_post(self, uri, data, **kwargs):
+        '''
+        Send POST
+
+        Issues a POST request (write) against the API and returns the result (as Python dict).
+        Accepts the same optional arguments as `APIClient.send_post`.
+        '''
+        return await self._send('POST', uri, data, **kwargs)
+
+    async def _send(self, method, uri, data, **kwargs):
+        cert_check = kwargs.get('cert_check', self.cert_check)
+        headers = kwargs.get('headers', self.headers)
+        idempotent = method == 'GET' or uri.startswith(IDEMPOTENT_POST_METHODS)
+        if data is not None:
+            data = self._sync_client.encode(data)
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+        compress_threshold = self._sync_client.compress_threshold
+        try:
+            if data is not None and compress_threshold and len(data) >= compress_threshold:
+                status, body = await self._request(method, uri, idempotent, gzip.compress(data, COMPRESS_LEVEL),
+                                                   dict(headers, **{'Content-Encoding': 'gzip'}), cert_check)
+                if status in COMPRESSION_REJECTED_STATUSES:
+                    rejected = status
+                    status, body = await self._request(method, uri, idempotent, data, headers, cert_check)
+                    if status != rejected:
+                        print("Compressed request rejected (HTTP {}): compression disabled".format(rejected))
+                        self._sync_client.compress_threshold = 0
+            else:
+                status, body = await self._request(method, uri, idempotent, data, headers, cert_check)
+        except TRANSPORT_ERRORS as exc:
+            return {'error': '{}: {}'.format(type(exc).__name__, exc)}
+        return self._sync_client._parse_body(body, status)
+
+    async def _request(self, method, uri, idempotent, data, headers, cert_check):
+        '''
+        Send a request, sending it again after '429 Too Many Requests' responses and transient errors, with the
+        retry policy of `APIClient`.
+
+        :param idempotent: whether the request can be sent again when it may have been processed by the server.
+        :raise: the error of the transport if the request still fails after the retries.
+        :return tuple: (status, body) of the response
+        '''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        transport = self._aiohttp_request if self.use_aiohttp else self._threaded_request
+        too_many_requests = retry = 0
+        while True:
+            delay = self.rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                async with self._semaphore:
+                    status, response_headers, body = await transport(method, uri, data, headers, cert_check)
+            except RETRY_TRANSPORT_ERRORS as exc:
+                delay = self._sync_client._retry_delay(retry, idempotent, exc=exc, not_sent=self._not_sent(exc))
+                if delay is None:
+                    raise
+            else:
+                self.rate_limiter.update(response_headers)
+                if status == 429:  # Too many requests
+                    if not self._sync_client._too_many_requests(response_headers, too_many_requests):
+                        return status, body
+                    too_many_requests += 1
+                    continue
+                delay = self._sync_client._retry_delay(retry, idempotent, status=status)
+                if delay is None:
+                    return status, body
+            retry += 1
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _not_sent(exc):
+        if aiohttp is not None and isinstance(exc, aiohttp.ClientConnectorError):
+            return True
+        return isinstance(exc, requests.RequestException) and request_not_sent(exc)
+
+    async def _aiohttp_request(self, method, uri, data, headers, cert_check):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers={'Authorization': self._basic_auth()},
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        if isinstance(cert_check, str):
+            verify = ssl.create_default_context(cafile=cert_check)
+        else:
+            verify = None if cert_check else False
+        async with self._session.request(method, self._sync_client._url + uri, headers=headers,
+                                         data=data, ssl=verify) as r:
+            return r.status, r.headers, await r.read()
+
+    def _basic_auth(self):
+        credentials = '{}:{}'.format(self._sync_client.user, self._sync_client.password).encode('utf-8')
+        return 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+    async def _threaded_request(self, method, uri, data, headers, cert_check):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        session = self._sync_client.session
+
+        def request():
+            r = session.request(method, self._sync_client._url + uri, headers=headers, data=data, verify=cert_check,
+                                timeout=self.timeout)
+            return r.status_code, r.headers, r.content
+        return await asyncio.get_running_loop().run_in_executor(self._executor, request)
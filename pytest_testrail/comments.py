@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+#
+# Rendering of pytest failure representations into TestRail comments.
+#
+import io
+
+try:
+    from _pytest._io import TerminalWriter
+except ImportError:  # pytest < 6
+    from py.io import TerminalWriter
+
+COMMENT_SIZE_LIMIT = 4000
+# Part of a failure representation kept in a comment longer than the size limit
+COMMENT_TAIL = 'tail'
+COMMENT_HEAD = 'head'
+COMMENT_HEAD_TAIL = 'head-tail'
+COMMENT_STRATEGIES = (COMMENT_TAIL, COMMENT_HEAD, COMMENT_HEAD_TAIL)
+COMMENT_ELLIPSIS = '\n...\n'
+
+
+class _FragmentWriter(TerminalWriter):
+    """ Terminal writer keeping the text fragments written by a pytest report, without joining them """
+
+    def __init__(self):
+        super(_FragmentWriter, self).__init__(file=io.StringIO())
+        self.hasmarkup = False
+        self.fragments = []
+
+    def write(self, msg, **kwargs):
+        if msg:
+            self.fragments.append(msg)
+
+
+def _strip(fragments):
+    """ Strip the joined text of `fragments` as `str()` strips pytest reports, without joining them """
+    start, end = 0, len(fragments)
+    while start < end and fragments[start].isspace():
+        start += 1
+    while end > start and fragments[end - 1].isspace():
+        end -= 1
+    fragments = fragments[start:end]
+    if fragments:
+        fragments[0] = fragments[0].lstrip()
+        fragments[-1] = fragments[-1].rstrip()
+    return fragments
+
+
+def _head(fragments, limit):
+    """ :return: (first `limit` characters of the joined fragments, True if there are more) """
+    pieces, size = [], 0
+    for fragment in fragments:
+        piece = fragment[:limit + 1 - size]
+        pieces.append(piece)
+        size += len(piece)
+        if size > limit:
+            break
+    return ''.join(pieces)[:limit], size > limit
+
+
+def _tail(fragments, limit):
+    """ :return: (last `limit` characters of the joined fragments, True if there are more) """
+    pieces, size = [], 0
+    for fragment in reversed(fragments):
+        piece = fragment[-(limit + 1 - size):]
+        pieces.append(piece)
+        size += len(piece)
+        if size > limit:
+            break
+    return ''.join(reversed(pieces))[-limit:], size > limit
+
+
+class CommentRenderer(object):
+    """
+    Render failure representations into comments of at most `limit` characters.
+
+    A pytest report is not rendered to its full text: the fragments written by its `toterminal` method are read
+    from the end (``tail``), from the start (``head``) or from both ends (``head-tail``) until `limit` characters
+    are kept, so that multi-megabyte logs are neither joined nor copied.
+    """
+    __slots__ = ('limit', 'strategy')
+
+    def __init__(self, limit=COMMENT_SIZE_LIMIT, strategy=COMMENT_TAIL):
+        if strategy not in COMMENT_STRATEGIES:
+            raise ValueError('comment strategy must be one of {}, not "{}"'.format(
+                ', '.join(COMMENT_STRATEGIES), strategy))
+        self.limit = max(int(limit or COMMENT_SIZE_LIMIT), len(COMMENT_ELLIPSIS) + 2)
+        self.strategy = strategy
+
+    def render(self, longrepr):
+        """
+        :param longrepr: failure representation: pytest report, or any object convertible to text
+        :return: (text, True if the text was truncated)
+        """
+        fragments = self.fragments(longrepr)
+        if self.strategy == COMMENT_TAIL:
+            return _tail(fragments, self.limit)
+        text, truncated = _head(fragments, self.limit)
+        if truncated and self.strategy == COMMENT_HEAD_TAIL:
+            kept = self.limit - len(COMMENT_ELLIPSIS)
+            text = text[:kept // 2] + COMMENT_ELLIPSIS + _tail(fragments, kept - kept // 2)[0]
+        return text, truncated
+
+    @staticmethod
+    def fragments(longrepr):
+        """
+        :return list: text fragments of `longrepr`, joined as `str(longrepr)`
+        """
+        if hasattr(longrepr, 'toterminal'):
+            writer = _FragmentWriter()
+            try:
+                longrepr.toterminal(writer)
+                return _strip(writer.fragments)
+            except Exception:  # rendered by str() as a last resort
+                pass
+        return [str(longrepr)]
+
+    def format(self, text, truncated):
+        """ Indent a rendered comment, to avoid string formatting by TestRail, and flag its truncation """
+        text = "    " + text.replace('\n', '\n    ')
+        if not truncated:
+            return text
+        if self.strategy == COMMENT_HEAD:
+            return 'Log truncated\n' + text + '\n...'
+        if self.strategy == COMMENT_HEAD_TAIL:
+            return 'Log truncated\n' + text
+        return 'Log truncated\n...\n' + text
+
+
+DEFAULT_COMMENT_RENDERER = CommentRenderer()
@@ -1,8 +1,15 @@
 # -*- coding: UTF-8 -*-
 import os
 import sys
-from .plugin import PyTestRailPlugin
-from .testrail_api import APIClient
+
+import pytest
+
+# Only the modules needed to declare options are imported here: the plugin, the API client and their dependencies
+# (requests...) are imported once --testrail (or a command of the plugin) is used, not by every pytest run.
+from .comments import COMMENT_STRATEGIES
+from .results import MERGE_POLICIES
+from .serializers import SERIALIZER_NAMES
+from .spool import FSYNC_POLICIES
 if sys.version_info.major == 2:
     # python2
     import ConfigParser as configparser
@@ -38,6 +45,69 @@ def pytest_addoption(parser):
         '--tr-timeout',
         action='store',
         help='Set timeout for connecting to TestRail server')
+    group.addoption(
+        '--tr-pool-size',
+        action='store',
+        default=None,
+        required=False,
+        help='Maximum number of keep-alive connections to the TestRail server (config file: pool_size in API section)')
+    group.addoption(
+        '--tr-cache-ttl',
+        action='store',
+        default=None,
+        required=False,
+        help='Cache run and plan metadata on disk for this number of seconds \
+              (config file: cache_ttl in API section)')
+    group.addoption(
+        '--tr-cache-dir',
+        action='store',
+        default=None,
+        required=False,
+        help='Directory of the run and plan metadata cache, defaults to the pytest cache directory \
+              (config file: cache_dir in API section)')
+    group.addoption(
+        '--tr-rate-limit',
+        action='store',
+        default=None,
+        required=False,
+        help='Maximum number of requests per minute sent to the TestRail server \
+              (config file: rate_limit in API section)')
+    group.addoption(
+        '--tr-rate-limit-retries',
+        action='store',
+        default=None,
+        required=False,
+        help='Number of retries of a request rejected with "429 Too Many Requests" \
+              (config file: rate_limit_retries in API section)')
+    group.addoption(
+        '--tr-retries',
+        action='store',
+        default=None,
+        required=False,
+        help='Number of retries of a request failing with a connection error, a timeout or a 5xx response \
+              (config file: retries in API section)')
+    group.addoption(
+        '--tr-retry-backoff',
+        action='store',
+        default=None,
+        required=False,
+        help='Number of seconds before the first retry of a failed request, doubled for each following retry \
+              (config file: retry_backoff in API section)')
+    group.addoption(
+        '--tr-compress-threshold',
+        action='store',
+        default=None,
+        required=False,
+        help='Size in bytes from which requests are sent gzip-compressed, disabled by default \
+              (config file: compress_threshold in API section)')
+    group.addoption(
+        '--tr-serializer',
+        action='store',
+        default=None,
+        choices=SERIALIZER_NAMES,
+        required=False,
+        help='JSON serializer of request bodies, defaults to the fastest one installed: orjson, ujson or json \
+              (config file: serializer in API section)')
     group.addoption(
         '--tr-testrun-assignedto-id',
         action='store',
@@ -106,6 +176,14 @@ def pytest_addoption(parser):
         action='store_true',
         required=False,
         help='Skip test cases that are not present in testrun')
+    group.addoption(
+        '--tr-sync-setup',
+        action='store_true',
+        default=None,
+        required=False,
+        help='Select or create the testrun before running tests, instead of in the background \
+              (config file: sync_setup in TESTRUN section)'
+    )
     group.addoption(
         '--tr-milestone-id',
         action='store',
@@ -113,6 +191,81 @@ def pytest_addoption(parser):
         required=False,
         help='Identifier of milestone, to be used in run creation (config file: milestone_id in TESTRUN section)'
     )
+    group.addoption(
+        '--tr-batch-size',
+        action='store',
+        default=None,
+        required=False,
+        help='Maximum number of results sent in a single request (config file: batch_size in API section)'
+    )
+    group.addoption(
+        '--tr-batch-max-bytes',
+        action='store',
+        default=None,
+        required=False,
+        help='Maximum size in bytes of the results sent in a single request \
+              (config file: batch_max_bytes in API section)'
+    )
+    group.addoption(
+        '--tr-stream',
+        action='store_true',
+        default=None,
+        required=False,
+        help='Publish results in the background while tests are running (config file: stream in API section)'
+    )
+    group.addoption(
+        '--tr-stream-interval',
+        action='store',
+        default=None,
+        required=False,
+        help='Maximum number of seconds between two uploads in streaming mode \
+              (config file: stream_interval in API section)'
+    )
+    group.addoption(
+        '--tr-publish-workers',
+        action='store',
+        default=None,
+        required=False,
+        help='Number of testruns of a testplan published concurrently \
+              (config file: publish_workers in API section)'
+    )
+    group.addoption(
+        '--tr-async',
+        action='store_true',
+        default=None,
+        required=False,
+        help='Publish the testruns of a testplan with an asyncio client, using aiohttp when installed \
+              (config file: async in API section)'
+    )
+    group.addoption(
+        '--tr-shard-dir',
+        action='store',
+        default=None,
+        required=False,
+        help='Directory shared by all shards of the suite, to create a single testrun for all of them \
+              (config file: shard_dir in TESTRUN section)'
+    )
+    group.addoption(
+        '--tr-shard-count',
+        action='store',
+        default=None,
+        required=False,
+        help='Number of shards sharing the testrun (config file: shard_count in TESTRUN section)'
+    )
+    group.addoption(
+        '--tr-shard-id',
+        action='store',
+        default=None,
+        required=False,
+        help='Unique name of this shard, defaults to <hostname>-<pid>'
+    )
+    group.addoption(
+        '--tr-shard-timeout',
+        action='store',
+        default=None,
+        required=False,
+        help='Number of seconds to wait for the other shards (config file: shard_timeout in TESTRUN section)'
+    )
     group.addoption(
         '--tc-custom-comment',
         action='store',
@@ -121,43 +274,237 @@ def pytest_addoption(parser):
         help='Custom comment, to be appended to default comment for test case \
               (config file: custom_comment in TESTCASE section)'
     )
+    group.addoption(
+        '--tc-comment-size-limit',
+        action='store',
+        default=None,
+        required=False,
+        help='Maximum number of characters of the failure representation published in a comment, 4000 by default \
+              (config file: comment_size_limit in TESTCASE section)'
+    )
+    group.addoption(
+        '--tc-comment-strategy',
+        action='store',
+        default=None,
+        choices=COMMENT_STRATEGIES,
+        required=False,
+        help='Part of a failure representation kept when it is too long: its end (tail, default), its beginning \
+              (head), or both (head-tail) (config file: comment_strategy in TESTCASE section)'
+    )
+    group.addoption(
+        '--tc-merge-policy',
+        action='store',
+        default=None,
+        choices=MERGE_POLICIES,
+        required=False,
+        help='Results published for a test case with several results (parametrized tests, reruns): all of them \
+              (all, default), or one with a summary of all outcomes: the last one (last), the worst one (worst) or \
+              the first failure (first-failure). Merged results are published at the end of the session, even with \
+              --tr-stream (config file: merge_policy in TESTCASE section)'
+    )
+    group.addoption(
+        '--tr-spool',
+        action='store',
+        default=None,
+        required=False,
+        help='Append results to this file as they are recorded, to publish them later with --tr-publish-spool \
+              if publishing fails (config file: spool in API section)'
+    )
+    group.addoption(
+        '--tr-spool-fsync',
+        action='store',
+        default=None,
+        choices=FSYNC_POLICIES,
+        required=False,
+        help='When the spool is forced to disk: after every result (always), after every published batch (batch) \
+              or never (config file: spool_fsync in API section)'
+    )
+    group.addoption(
+        '--tr-publish-spool',
+        action='store',
+        default=None,
+        required=False,
+        help='Publish the results of the spool written by a previous session, without running tests'
+    )
+    group.addoption(
+        '--tr-offline',
+        action='store',
+        default=None,
+        required=False,
+        help='Do not connect to TestRail: record the requests in this file, to send them later with --tr-replay \
+              (config file: offline in API section)'
+    )
+    group.addoption(
+        '--tr-replay',
+        action='store',
+        default=None,
+        required=False,
+        help='Send the requests recorded by a previous session run with --tr-offline, without running tests'
+    )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_cmdline_main(config):
+    spool_path = config.getoption('--tr-publish-spool')
+    if spool_path:
+        # Publish the results of a previous session, without running tests
+        from .spool import ResultSpool
+        config_manager = ConfigManager(config.getoption('--tr-config'), config)
+        tr_plugin = create_plugin(config, config_manager)
+        return 0 if tr_plugin.publish_spool(ResultSpool(spool_path, resume=True)) else 1
+    replay_log = config.getoption('--tr-replay')
+    if replay_log:
+        # Send the requests recorded by a previous session in offline mode
+        from .offline import replay_request_log
+        from .plugin import RESULTS_BATCH_MAX_BYTES, RESULTS_BATCH_SIZE
+        config_manager = ConfigManager(config.getoption('--tr-config'), config)
+        with create_client(config, config_manager) as client:
+            failures = replay_request_log(
+                client,
+                replay_log,
+                batch_size=config_manager.getoption('tr-batch-size', 'batch_size', 'API', default=RESULTS_BATCH_SIZE),
+                batch_max_bytes=config_manager.getoption('tr-batch-max-bytes', 'batch_max_bytes', 'API',
+                                                         default=RESULTS_BATCH_MAX_BYTES),
+                cert_check=config_manager.getoption('tr-no-ssl-cert-check', 'no_ssl_cert_check', 'API', is_bool=True,
+                                                    default=True)
+            )
+        return 0 if failures == 0 else 1
 
 
 def pytest_configure(config):
     if config.getoption('--testrail'):
+        from .plugin import XDIST_WORKER
+        from .sharding import ShardRendezvous, SHARD_TIMEOUT
+        from .spool import FSYNC_BATCH, ResultSpool
         cfg_file_path = config.getoption('--tr-config')
         config_manager = ConfigManager(cfg_file_path, config)
-        client = APIClient(config_manager.getoption('tr-url', 'url', 'API'),
-                           config_manager.getoption('tr-email', 'email', 'API'),
-                           config_manager.getoption('tr-password', 'password', 'API'),
-                           timeout=config_manager.getoption('tr-timeout', 'timeout', 'API'))
+        shard = None
+        shard_dir = config_manager.getoption('tr-shard-dir', 'shard_dir', 'TESTRUN')
+        if shard_dir and get_xdist_role(config) != XDIST_WORKER:
+            shard = ShardRendezvous(
+                shard_dir,
+                shard_count=config_manager.getoption('tr-shard-count', 'shard_count', 'TESTRUN', default=1),
+                shard_id=config.getoption('--tr-shard-id'),
+                timeout=config_manager.getoption('tr-shard-timeout', 'shard_timeout', 'TESTRUN',
+                                                 default=SHARD_TIMEOUT)
+            )
+
+        spool = None
+        spool_path = config_manager.getoption('tr-spool', 'spool', 'API')
+        if spool_path and get_xdist_role(config) != XDIST_WORKER:
+            spool = ResultSpool(spool_path,
+                                fsync=config_manager.getoption('tr-spool-fsync', 'spool_fsync', 'API',
+                                                               default=FSYNC_BATCH))
 
         config.pluginmanager.register(
-            PyTestRailPlugin(
-                client=client,
-                assign_user_id=config_manager.getoption('tr-testrun-assignedto-id', 'assignedto_id', 'TESTRUN'),
-                project_id=config_manager.getoption('tr-testrun-project-id', 'project_id', 'TESTRUN'),
-                suite_id=config_manager.getoption('tr-testrun-suite-id', 'suite_id', 'TESTRUN'),
-                include_all=config_manager.getoption('tr-testrun-suite-include-all', 'include_all', 'TESTRUN',
-                                                     is_bool=True, default=False),
-                cert_check=config_manager.getoption('tr-no-ssl-cert-check', 'no_ssl_cert_check', 'API', is_bool=True,
-                                                    default=True),
-                tr_name=config_manager.getoption('tr-testrun-name', 'name', 'TESTRUN'),
-                tr_description=config_manager.getoption('tr-testrun-description', 'description', 'TESTRUN'),
-                run_id=config.getoption('--tr-run-id'),
-                plan_id=config_manager.getoption('tr-plan-id', 'plan_id', 'TESTRUN'),
-                version=config.getoption('--tr-version'),
-                close_on_complete=config.getoption('--tr-close-on-complete'),
-                publish_blocked=config.getoption('--tr-dont-publish-blocked'),
-                skip_missing=config.getoption('--tr-skip-missing'),
-                milestone_id=config_manager.getoption('tr-milestone-id', 'milestone_id', 'TESTRUN'),
-                custom_comment=config_manager.getoption('tc-custom-comment', 'custom_comment', 'TESTCASE')
-            ),
+            create_plugin(config, config_manager, shard=shard, spool=spool),
             # Name of plugin instance (allow to be used by other plugins)
             name="pytest-testrail-instance"
         )
 
 
+def create_plugin(config, config_manager, **kwargs):
+    """
+    Create the TestRail client and the plugin instance from the command line options and the config file.
+
+    Other keyword arguments are given to PyTestRailPlugin.
+    """
+    from .offline import OfflineAPIClient
+    from .plugin import (PyTestRailPlugin, COMMENT_SIZE_LIMIT, COMMENT_TAIL, MERGE_ALL, PUBLISH_WORKERS,
+                         RESULTS_BATCH_MAX_BYTES, RESULTS_BATCH_SIZE, STREAM_INTERVAL)
+    offline_log = config_manager.getoption('tr-offline', 'offline', 'API')
+    if offline_log:
+        client = OfflineAPIClient(offline_log)
+    else:
+        client = create_client(config, config_manager)
+    publish_workers = config_manager.getoption('tr-publish-workers', 'publish_workers', 'API',
+                                               default=PUBLISH_WORKERS)
+    async_client = None
+    if not offline_log and config_manager.getoption('tr-async', 'async', 'API', is_bool=True, default=False):
+        from .async_api import AsyncAPIClient
+        async_client = AsyncAPIClient(client.base_url, client.user, client.password, concurrency=publish_workers,
+                                      timeout=client.timeout, cert_check=client.cert_check,
+                                      rate_limiter=client.rate_limiter, rate_limit_retries=client.rate_limit_retries,
+                                      retries=client.retries, retry_backoff=client.retry_backoff,
+                                      compress_threshold=client.compress_threshold, serializer=client.serializer)
+    return PyTestRailPlugin(
+        client=client,
+        assign_user_id=config_manager.getoption('tr-testrun-assignedto-id', 'assignedto_id', 'TESTRUN'),
+        project_id=config_manager.getoption('tr-testrun-project-id', 'project_id', 'TESTRUN'),
+        suite_id=config_manager.getoption('tr-testrun-suite-id', 'suite_id', 'TESTRUN'),
+        include_all=config_manager.getoption('tr-testrun-suite-include-all', 'include_all', 'TESTRUN',
+                                             is_bool=True, default=False),
+        cert_check=config_manager.getoption('tr-no-ssl-cert-check', 'no_ssl_cert_check', 'API', is_bool=True,
+                                            default=True),
+        tr_name=config_manager.getoption('tr-testrun-name', 'name', 'TESTRUN'),
+        tr_description=config_manager.getoption('tr-testrun-description', 'description', 'TESTRUN'),
+        run_id=config.getoption('--tr-run-id'),
+        plan_id=config_manager.getoption('tr-plan-id', 'plan_id', 'TESTRUN'),
+        version=config.getoption('--tr-version'),
+        close_on_complete=config.getoption('--tr-close-on-complete'),
+        publish_blocked=config.getoption('--tr-dont-publish-blocked'),
+        skip_missing=config.getoption('--tr-skip-missing'),
+        milestone_id=config_manager.getoption('tr-milestone-id', 'milestone_id', 'TESTRUN'),
+        custom_comment=config_manager.getoption('tc-custom-comment', 'custom_comment', 'TESTCASE'),
+        comment_size_limit=config_manager.getoption('tc-comment-size-limit', 'comment_size_limit', 'TESTCASE',
+                                                    default=COMMENT_SIZE_LIMIT),
+        comment_strategy=config_manager.getoption('tc-comment-strategy', 'comment_strategy', 'TESTCASE',
+                                                  default=COMMENT_TAIL),
+        merge_policy=config_manager.getoption('tc-merge-policy', 'merge_policy', 'TESTCASE', default=MERGE_ALL),
+        batch_size=config_manager.getoption('tr-batch-size', 'batch_size', 'API', default=RESULTS_BATCH_SIZE),
+        batch_max_bytes=config_manager.getoption('tr-batch-max-bytes', 'batch_max_bytes', 'API',
+                                                 default=RESULTS_BATCH_MAX_BYTES),
+        stream=config_manager.getoption('tr-stream', 'stream', 'API', is_bool=True, default=False),
+        stream_interval=config_manager.getoption('tr-stream-interval', 'stream_interval', 'API',
+                                                 default=STREAM_INTERVAL),
+        publish_workers=publish_workers,
+        xdist_role=get_xdist_role(config),
+        async_client=async_client,
+        background_setup=not config_manager.getoption('tr-sync-setup', 'sync_setup', 'TESTRUN', is_bool=True,
+                                                      default=False),
+        **kwargs
+    )
+
+
+def create_client(config, config_manager):
+    """
+    Create the TestRail API client from the command line options and the config file.
+    """
+    from .testrail_api import APIClient
+    cache_ttl = config_manager.getoption('tr-cache-ttl', 'cache_ttl', 'API')
+    cache_dir = config_manager.getoption('tr-cache-dir', 'cache_dir', 'API')
+    if cache_ttl and not cache_dir and getattr(config, 'cache', None) is not None:
+        mkdir = getattr(config.cache, 'mkdir', None) or config.cache.makedir
+        cache_dir = str(mkdir('testrail'))
+    return APIClient(config_manager.getoption('tr-url', 'url', 'API'),
+                     config_manager.getoption('tr-email', 'email', 'API'),
+                     config_manager.getoption('tr-password', 'password', 'API'),
+                     timeout=config_manager.getoption('tr-timeout', 'timeout', 'API'),
+                     pool_size=config_manager.getoption('tr-pool-size', 'pool_size', 'API'),
+                     cache_dir=cache_dir,
+                     cache_ttl=cache_ttl,
+                     rate_limit=config_manager.getoption('tr-rate-limit', 'rate_limit', 'API'),
+                     rate_limit_retries=config_manager.getoption('tr-rate-limit-retries', 'rate_limit_retries',
+                                                                 'API'),
+                     retries=config_manager.getoption('tr-retries', 'retries', 'API'),
+                     retry_backoff=config_manager.getoption('tr-retry-backoff', 'retry_backoff', 'API'),
+                     compress_threshold=config_manager.getoption('tr-compress-threshold', 'compress_threshold', 'API'),
+                     serializer=config_manager.getoption('tr-serializer', 'serializer', 'API'))
+
+
+def get_xdist_role(config):
+    """
+    :return: XDIST_WORKER in a pytest-xdist worker, XDIST_CONTROLLER when tests are distributed to workers,
+        None otherwise.
+    """
+    from .plugin import XDIST_CONTROLLER, XDIST_WORKER
+    if hasattr(config, 'workerinput') or hasattr(config, 'slaveinput'):
+        return XDIST_WORKER
+    if getattr(config.option, 'dist', 'no') != 'no':
+        return XDIST_CONTROLLER
+    return None
+
+
 class ConfigManager(object):
     def __init__(self, cfg_file_path, config):
         '''
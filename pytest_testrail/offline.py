@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+import itertools
+import json
+import threading
+
+from .plugin import (ADD_RESULTS_URL, GET_TESTPLAN_URL, RESULTS_BATCH_MAX_BYTES, RESULTS_BATCH_SIZE, TESTRAIL_PREFIX,
+                     batch_results)
+from .testrail_api import APIClient
+
+ADD_RESULTS_METHOD = ADD_RESULTS_URL.split('/')[0] + '/'
+GET_TESTPLAN_METHOD = GET_TESTPLAN_URL.split('/')[0] + '/'
+OFFLINE_ERROR = 'Not available in offline mode'
+
+
+class OfflineAPIClient(object):
+    '''
+    TestRail API client which never reaches the server: write requests are recorded in a request log, to be sent
+    later with `replay_request_log`.
+
+    Objects created offline (testruns) get negative placeholder ids, which are replaced by the real ids when the log
+    is replayed. The testruns of a testplan are not known offline: a single placeholder testrun stands for all the
+    open testruns of the testplan, and requests sent to it are sent to each of them on replay.
+    '''
+
+    get_error = staticmethod(APIClient.get_error)
+
+    def __init__(self, path):
+        '''
+        :param path: Path of the request log, in JSON lines.
+        :type path: str
+        '''
+        self.path = str(path)
+        self._file = None
+        self._written = False  # the log is only created by the first request recorded
+        self._lock = threading.Lock()
+        self._placeholders = itertools.count(-1, -1)
+        self._plan_runs = {}
+
+    def _record(self, method, uri, data=None, placeholder=None):
+        record = {'method': method, 'uri': uri}
+        if data is not None:
+            record['data'] = data
+        if placeholder is not None:
+            record['placeholder'] = placeholder
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a' if self._written else 'w')
+                self._written = True
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def send_get(self, uri, **kwargs):
+        '''
+        Answer a GET request (read) without sending it: testruns and testplans are reported as open, tests of
+        testruns are not available.
+        '''
+        name, _, object_id = uri.partition('/')
+        if uri.startswith(GET_TESTPLAN_METHOD):
+            with self._lock:
+                new = object_id not in self._plan_runs
+                if new:
+                    self._plan_runs[object_id] = next(self._placeholders)
+                run_id = self._plan_runs[object_id]
+            if new:
+                self._record('GET', uri, placeholder=run_id)
+            return {'id': int(object_id), 'is_completed': False,
+                    'entries': [{'runs': [{'id': run_id, 'is_completed': False}]}]}
+        if name == 'get_run':
+            return {'id': int(object_id), 'is_completed': False}
+        return {'error': OFFLINE_ERROR}
+
+    def send_post(self, uri, data, **kwargs):
+        '''
+        Record a POST request (write) in the request log, and answer it as TestRail would.
+        '''
+        if uri.startswith('add_run/'):
+            run_id = next(self._placeholders)
+            self._record('POST', uri, data, placeholder=run_id)
+            return dict(data, id=run_id, is_completed=False)
+        self._record('POST', uri, data)
+        if uri.startswith(ADD_RESULTS_METHOD):
+            return data.get('results', [])
+        return {}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_request_log(path):
+    '''
+    Read a request log, merging consecutive uploads of results to the same testrun.
+
+    :return list: recorded requests, as dicts with 'method', 'uri', and optional 'data' and 'placeholder'.
+    '''
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            previous = records[-1] if records else None
+            if previous and record['uri'].startswith(ADD_RESULTS_METHOD) and previous['uri'] == record['uri']:
+                previous['data'] = {'results': previous['data']['results'] + record['data']['results']}
+            else:
+                records.append(record)
+    return records
+
+
+def replay_request_log(client, path, batch_size=RESULTS_BATCH_SIZE, batch_max_bytes=RESULTS_BATCH_MAX_BYTES,
+                       cert_check=True):
+    '''
+    Send the requests recorded by `OfflineAPIClient` to TestRail.
+
+    Results are sent in batches of `batch_size` entries and `batch_max_bytes` bytes, whatever the size of the
+    recorded uploads.
+
+    :param APIClient client: client connected to the TestRail server
+    :param str path: path of the request log
+    :return int: number of requests which failed
+    '''
+    batch_size, batch_max_bytes = int(batch_size or 0), int(batch_max_bytes or 0)
+    run_ids = {}  # placeholder -> real testrun ids
+    failures = 0
+    for record in read_request_log(path):
+        name, _, object_id = record['uri'].partition('/')
+        if object_id.startswith('-'):
+            if int(object_id) not in run_ids:
+                print('[{}] Skipped {}: testrun {} was not created'.format(TESTRAIL_PREFIX, record['uri'], object_id))
+                failures += 1
+                continue
+            uris = ['{}/{}'.format(name, run_id) for run_id in run_ids[int(object_id)]]
+        else:
+            uris = [record['uri']]
+
+        if record['method'] == 'GET':  # testruns of a testplan
+            response = client.send_get(record['uri'], cert_check=cert_check)
+            error = client.get_error(response)
+            if error:
+                print('[{}] Failed to replay GET {}: "{}"'.format(TESTRAIL_PREFIX, record['uri'], error))
+                failures += 1
+            else:
+                run_ids[record['placeholder']] = [run['id'] for entry in response['entries'] for run in entry['runs']
+                                                  if not run['is_completed']]
+            continue
+        if record['uri'].startswith(ADD_RESULTS_METHOD):
+            pending = [(uri, {'results': batch}) for uri in uris
+                       for batch in batch_results(record['data']['results'], batch_size, batch_max_bytes)]
+        else:
+            pending = [(uri, record['data']) for uri in uris]
+        for uri, data in pending:
+            response = client.send_post(uri, data, cert_check=cert_check)
+            error = client.get_error(response)
+            if error:
+                print('[{}] Failed to replay POST {}: "{}"'.format(TESTRAIL_PREFIX, uri, error))
+                failures += 1
+            elif record.get('placeholder') is not None:
+                run_ids[record['placeholder']] = [response['id']]
+    return failures
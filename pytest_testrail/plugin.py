@@ -1,19 +1,21 @@
 # -*- coding: UTF-8 -*-
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from operator import itemgetter
 
+import asyncio
+import json
 import pytest
 import re
+import threading
+import time
 import warnings
 
-# Reference: http://docs.gurock.com/testrail-api2/reference-statuses
-TESTRAIL_TEST_STATUS = {
-    "passed": 1,
-    "blocked": 2,
-    "untested": 3,
-    "retest": 4,
-    "failed": 5
-}
+from .comments import (COMMENT_ELLIPSIS, COMMENT_HEAD, COMMENT_HEAD_TAIL, COMMENT_SIZE_LIMIT,  # noqa: F401
+                       COMMENT_STRATEGIES, COMMENT_TAIL, DEFAULT_COMMENT_RENDERER, CommentRenderer)
+from .results import (MERGE_ALL, MERGE_FIRST_FAILURE, MERGE_LAST, MERGE_POLICIES, MERGE_WORST,  # noqa: F401
+                      TESTRAIL_TEST_STATUS, CaseResult, MergedCaseResult, merge_results, sort_results)
+from .testrail_api import EncodedData, ThrottleStats
 
 PYTEST_TO_TESTRAIL_STATUS = {
     "passed": TESTRAIL_TEST_STATUS["passed"],
@@ -32,14 +34,36 @@ CLOSE_TESTPLAN_URL = 'close_plan/{}'
 GET_TESTRUN_URL = 'get_run/{}'
 GET_TESTPLAN_URL = 'get_plan/{}'
 GET_TESTS_URL = 'get_tests/{}'
+API_PATH = '/api/v2/'
+
+TEST_ID_PATTERN = re.compile('(?P<test_id>[0-9]+$)')
+DEFECT_ID_PATTERN = re.compile('(?P<defect_id>.*)')
+
+# Upper bounds of a single 'add_results_for_cases' request
+RESULTS_BATCH_SIZE = 1000
+RESULTS_BATCH_MAX_BYTES = 8 * 1024 * 1024
 
-COMMENT_SIZE_LIMIT = 4000
+# Seconds between two uploads of the background worker in streaming mode
+STREAM_INTERVAL = 30
+
+# Number of testruns of a testplan published concurrently
+PUBLISH_WORKERS = 4
+
+# Roles of the plugin instance when tests are distributed with pytest-xdist
+XDIST_CONTROLLER = 'controller'
+XDIST_WORKER = 'worker'
+XDIST_OUTPUT_KEY = 'testrail'
 
 
 class DeprecatedTestDecorator(DeprecationWarning):
     pass
 
 
+class TestRailResponseError(Exception):
+    """ Error returned by the TestRail API """
+    __test__ = False
+
+
 warnings.simplefilter(action='once', category=DeprecatedTestDecorator, lineno=0)
 
 
@@ -109,7 +133,8 @@ def clean_test_ids(test_ids):
     :param list test_ids: list of test_ids.
     :return list ints: contains list of test_ids as ints.
     """
-    return [int(re.search('(?P<test_id>[0-9]+$)', test_id).groupdict().get('test_id')) for test_id in test_ids]
+    search = TEST_ID_PATTERN.search
+    return [int(search(test_id).group('test_id')) for test_id in test_ids]
 
 
 def clean_test_defects(defect_ids):
@@ -119,29 +144,156 @@ def clean_test_defects(defect_ids):
         :param list defect_ids: list of defect_ids.
         :return list ints: contains list of defect_ids as ints.
         """
-    return [(re.search('(?P<defect_id>.*)', defect_id).groupdict().get('defect_id')) for defect_id in defect_ids]
+    search = DEFECT_ID_PATTERN.search
+    return [search(defect_id).group('defect_id') for defect_id in defect_ids]
+
+
+class ResultsPayload(object):
+    """
+    Rendered result entries, sorted by case id, with the JSON-serialized size of each entry.
+    """
+    __slots__ = ('entries', 'sizes', '_batches', '_lock')
+
+    def __init__(self, entries, sizes=None):
+        self.entries = entries
+        self.sizes = [len(json.dumps(entry)) for entry in entries] if sizes is None else sizes
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def batches(self, max_entries=RESULTS_BATCH_SIZE, max_bytes=RESULTS_BATCH_MAX_BYTES, encode=None):
+        """
+        Split the entries in batches, built and encoded once whatever the number of testruns they are sent to.
+
+        :param encode: (optional) function returning the JSON document of the data of a request, e.g.
+                       `APIClient.encode`. Batches it fails to encode are left as plain data, so that the error is
+                       raised again when they are sent, and the batch kept in `failed_batches`.
+        :return list: (entries, data of the 'add_results_for_cases' request) tuples
+        """
+        key = (max_entries, max_bytes)
+        with self._lock:
+            if key not in self._batches:
+                batches = []
+                for entries in batch_results(self.entries, max_entries, max_bytes, self.sizes):
+                    data = {'results': entries}
+                    if encode is not None:
+                        try:
+                            data = EncodedData(data, encode(data))
+                        except (TypeError, ValueError, OverflowError):
+                            pass
+                    batches.append((entries, data))
+                self._batches[key] = batches
+            return self._batches[key]
+
+    def exclude(self, case_ids):
+        """ Return a payload without the entries of the given case ids """
+        if not isinstance(case_ids, (set, frozenset)):
+            case_ids = set(case_ids)
+        if not case_ids:
+            return self
+        kept = [index for index, entry in enumerate(self.entries) if entry['case_id'] not in case_ids]
+        return ResultsPayload([self.entries[index] for index in kept], [self.sizes[index] for index in kept])
+
+
+class RunMembership(object):
+    """
+    Case ids of the tests of a testrun, as frozensets keyed by status, for O(1) membership checks.
+    """
+    __slots__ = ('case_ids', 'by_status')
+
+    def __init__(self, tests):
+        by_status = {}
+        for test in tests:
+            by_status.setdefault(test.get('status_id'), set()).add(test.get('case_id'))
+        self.by_status = dict((status_id, frozenset(case_ids)) for status_id, case_ids in by_status.items())
+        self.case_ids = frozenset().union(*self.by_status.values())
+
+    def __contains__(self, case_id):
+        return case_id in self.case_ids
+
+    def with_status(self, status_id):
+        """ Return the frozenset of case ids of the testrun having the given status """
+        return self.by_status.get(status_id, frozenset())
+
+
+def batch_results(entries, max_entries=RESULTS_BATCH_SIZE, max_bytes=RESULTS_BATCH_MAX_BYTES, sizes=None):
+    """
+    Split result entries into consecutive chunks bounded by entry count and JSON-serialized size.
+
+    An entry bigger than `max_bytes` on its own is still sent, alone in its chunk.
+
+    :param list entries: result entries, as sent to 'add_results_for_cases'.
+    :param int max_entries: maximum number of entries per chunk (falsy for no limit).
+    :param int max_bytes: maximum serialized size of a chunk payload in bytes (falsy for no limit).
+    :param list sizes: already known serialized size of each entry.
+    :return generator: lists of entries, in the original order.
+    """
+    overhead = len(json.dumps({'results': []}))
+    chunk, chunk_bytes = [], overhead
+    for index, entry in enumerate(entries):
+        entry_bytes = (len(json.dumps(entry)) if sizes is None else sizes[index]) + 2  # separator between entries
+        full = max_entries and len(chunk) >= max_entries
+        too_big = max_bytes and chunk_bytes + entry_bytes > max_bytes
+        if chunk and (full or too_big):
+            yield chunk
+            chunk, chunk_bytes = [], overhead
+        chunk.append(entry)
+        chunk_bytes += entry_bytes
+    if chunk:
+        yield chunk
+
+
+def read_tests_page(response):
+    """
+    Read a response of 'get_tests'.
+
+    Paginated responses (TestRail 6.7+) give the uri of the next page in their '_links.next' link.
+
+    :return: tuple (tests of the page, with only their 'case_id' and 'status_id', uri of the next page or None)
+    """
+    if isinstance(response, list):  # TestRail < 6.7: not paginated
+        tests, next_uri = response, None
+    else:
+        tests = response.get('tests', [])
+        next_link = (response.get('_links') or {}).get('next')
+        next_uri = next_link.split(API_PATH, 1)[-1] if next_link else None
+    return [{'case_id': test.get('case_id'), 'status_id': test.get('status_id')} for test in tests], next_uri
 
 
 def get_testrail_keys(items):
     """Return Tuple of Pytest nodes and TestRail ids from pytests markers"""
     testcaseids = []
     for item in items:
-        if item.get_closest_marker(TESTRAIL_PREFIX):
-            testcaseids.append(
-                (
-                    item,
-                    clean_test_ids(
-                        item.get_closest_marker(TESTRAIL_PREFIX).kwargs.get('ids')
-                    )
-                )
-            )
+        marker = item.get_closest_marker(TESTRAIL_PREFIX)
+        if marker:
+            testcaseids.append((item, clean_test_ids(marker.kwargs.get('ids'))))
     return testcaseids
 
 
+def get_item_keys(item):
+    """
+    Parse TestRail markers of a pytest item.
+
+    :return tuple: (list of testcase ids as ints, or None if the item has no testrail marker,
+                    defects as a comma separated string, or None if the item has no defects)
+    """
+    marker = item.get_closest_marker(TESTRAIL_PREFIX)
+    case_ids = clean_test_ids(marker.kwargs.get('ids') or ()) if marker else None
+    marker = item.get_closest_marker(TESTRAIL_DEFECTS_PREFIX)
+    defect_ids = marker.kwargs.get('defect_ids') if marker else None
+    defects = None
+    if defect_ids:
+        defects = str(clean_test_defects(defect_ids)).replace('[', '').replace(']', '').replace("'", '')
+    return case_ids, defects
+
+
 class PyTestRailPlugin(object):
     def __init__(self, client, assign_user_id, project_id, suite_id, include_all, cert_check, tr_name,
                  tr_description='', run_id=0, plan_id=0, version='', close_on_complete=False,
-                 publish_blocked=True, skip_missing=False, milestone_id=None, custom_comment=None):
+                 publish_blocked=True, skip_missing=False, milestone_id=None, custom_comment=None,
+                 batch_size=RESULTS_BATCH_SIZE, batch_max_bytes=RESULTS_BATCH_MAX_BYTES, stream=False,
+                 stream_interval=STREAM_INTERVAL, publish_workers=PUBLISH_WORKERS, xdist_role=None, shard=None,
+                 async_client=None, spool=None, comment_size_limit=COMMENT_SIZE_LIMIT,
+                 comment_strategy=COMMENT_TAIL, background_setup=False, merge_policy=MERGE_ALL):
         self.assign_user_id = assign_user_id
         self.cert_check = cert_check
         self.client = client
@@ -159,10 +311,46 @@ class PyTestRailPlugin(object):
         self.skip_missing = skip_missing
         self.milestone_id = milestone_id
         self.custom_comment = custom_comment
+        self.comment_renderer = CommentRenderer(comment_size_limit, comment_strategy)
+        if merge_policy not in MERGE_POLICIES:
+            raise ValueError('merge policy must be one of {}, not "{}"'.format(', '.join(MERGE_POLICIES),
+                                                                               merge_policy))
+        self.merge_policy = merge_policy
+        self.batch_size = int(batch_size or 0)
+        self.batch_max_bytes = int(batch_max_bytes or 0)
+        self.failed_batches = []
+        self.stream = stream
+        self.stream_interval = float(stream_interval or STREAM_INTERVAL)
+        if self.stream_interval <= 0:
+            raise ValueError('stream interval must be a positive number of seconds, not "{}"'.format(stream_interval))
+        self._stream_testruns = None
+        self._stream_thread = None
+        self._stream_wakeup = threading.Event()
+        self._stream_stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._flushed = 0
+        self.publish_workers = max(int(publish_workers or 1), 1)
+        self.publish_timings = {}
+        self._payload = None
+        self._payload_key = None
+        self.testrail_keys = {}
+        self._run_memberships = {}
+        self.xdist_role = xdist_role
+        self.collected_case_ids = []
+        self.shard = shard
+        self.async_client = async_client
+        self.spool = spool
+        self.background_setup = background_setup
+        self._setup_executor = None
+        self._setup_local = threading.local()
+        self._held_messages = []
+        self._testplan_lookup = None
+        self._testrun_lookup = None
+        self._testrun_setup = None
 
     # pytest hooks
 
-    def pytest_report_header(self, config, startdir):
+    def pytest_report_header(self, config):
         """ Add extra-info in header """
         message = 'pytest-testrail: '
         if self.testplan_id:
@@ -173,100 +361,267 @@ class PyTestRailPlugin(object):
             message += 'a new testrun will be created'
         return message
 
+    def pytest_configure(self, config):
+        if self.background_setup and self.xdist_role != XDIST_WORKER:
+            self.start_lookup()
+
     @pytest.hookimpl(trylast=True)
     def pytest_collection_modifyitems(self, session, config, items):
-        items_with_tr_keys = get_testrail_keys(items)
+        items_with_tr_keys = self.index_items(items)
         tr_keys = [case_id for item in items_with_tr_keys for case_id in item[1]]
 
-        if self.testplan_id and self.is_testplan_available():
-            self.testrun_id = 0
-        elif self.testrun_id and self.is_testrun_available():
-            self.testplan_id = 0
-            if self.skip_missing:
-                tests_list = [
-                    test.get('case_id') for test in self.get_tests(self.testrun_id)
-                ]
-                for item, case_id in items_with_tr_keys:
-                    if not set(case_id).intersection(set(tests_list)):
-                        mark = pytest.mark.skip('Test is not present in testrun.')
-                        item.add_marker(mark)
-        else:
-            if self.testrun_name is None:
-                self.testrun_name = testrun_name()
-
-            self.create_test_run(
-                self.assign_user_id,
-                self.project_id,
-                self.suite_id,
-                self.include_all,
-                self.testrun_name,
-                tr_keys,
-                self.milestone_id,
-                self.testrun_description
-            )
+        if self.xdist_role == XDIST_WORKER:
+            # The controller creates the testrun and publishes results: only keep collected ids for it
+            self.collected_case_ids = tr_keys
+            if self.skip_missing and self.testrun_id:
+                self.skip_missing_items(items_with_tr_keys)
+            return
+
+        self.prepare_testrun(tr_keys, items_with_tr_keys)
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        """ Merge results sent by a pytest-xdist worker """
+        output = getattr(node, 'workeroutput', None) or getattr(node, 'slaveoutput', None) or {}
+        data = output.get(XDIST_OUTPUT_KEY)
+        if data:
+            self.collected_case_ids.extend(data['case_ids'])
+            results = [CaseResult.from_record(record) for record in data['results']]
+            self.results.extend(results)
+            if self.spool is not None:
+                self.spool.write_results(results)
 
     @pytest.hookimpl(tryfirst=True, hookwrapper=True)
     def pytest_runtest_makereport(self, item, call):
-        """ Collect result and associated testcases (TestRail) of an execution """
+        """
+        Collect result and associated testcases (TestRail) of an execution.
+
+        The call phase is recorded, as well as errors of the setup (e.g. a failing fixture, the test is not called)
+        and of the teardown: other setup and teardown reports return before looking up the item's testcases.
+        """
         outcome = yield
         rep = outcome.get_result()
-        defectids = None
-        if 'callspec' in dir(item):
-            test_parametrize = item.callspec.params
-        else:
-            test_parametrize = None
-        comment = rep.longrepr
-        if item.get_closest_marker(TESTRAIL_DEFECTS_PREFIX):
-            defectids = item.get_closest_marker(TESTRAIL_DEFECTS_PREFIX).kwargs.get('defect_ids')
-        if item.get_closest_marker(TESTRAIL_PREFIX):
-            testcaseids = item.get_closest_marker(TESTRAIL_PREFIX).kwargs.get('ids')
-            if rep.when == 'call' and testcaseids:
-                if defectids:
-                    self.add_result(
-                        clean_test_ids(testcaseids),
-                        get_test_outcome(outcome.get_result().outcome),
-                        comment=comment,
-                        duration=rep.duration,
-                        defects=str(clean_test_defects(defectids)).replace('[', '').replace(']', '').replace("'", ''),
-                        test_parametrize=test_parametrize
-                    )
-                else:
-                    self.add_result(
-                        clean_test_ids(testcaseids),
-                        get_test_outcome(outcome.get_result().outcome),
-                        comment=comment,
-                        duration=rep.duration,
-                        test_parametrize=test_parametrize
-                    )
+        if rep.when != 'call' and not rep.failed:
+            return
+        testcaseids, defects = self.get_item_keys(item)
+        if not testcaseids:
+            return
+        callspec = getattr(item, 'callspec', None)
+        self.add_result(
+            testcaseids,
+            get_test_outcome(rep.outcome),
+            comment=rep.longrepr,
+            duration=rep.duration,
+            defects=defects,
+            test_parametrize=callspec.params if callspec is not None else None
+        )
 
     def pytest_sessionfinish(self, session, exitstatus):
         """ Publish results in TestRail """
+        if self.xdist_role == XDIST_WORKER:
+            output = getattr(session.config, 'workeroutput', None)
+            if output is None:
+                output = session.config.slaveoutput
+            output[XDIST_OUTPUT_KEY] = {
+                'case_ids': self.collected_case_ids,
+                'results': [result.to_record() for result in self.results]
+            }
+            return
+        if self.xdist_role == XDIST_CONTROLLER:
+            # Items are collected by workers: select or create the testrun once all of them are done
+            self.prepare_testrun(list(OrderedDict.fromkeys(self.collected_case_ids)))
+        self.wait_testrun()
+
         print('[{}] Start publishing'.format(TESTRAIL_PREFIX))
         if self.results:
             tests_list = [str(result['case_id']) for result in self.results]
             print('[{}] Testcases to publish: {}'.format(TESTRAIL_PREFIX, ', '.join(tests_list)))
 
-            if self.testrun_id:
+            if self._stream_thread:
+                self.stop_streaming()
+            elif self.testrun_id:
                 self.add_results(self.testrun_id)
             elif self.testplan_id:
                 testruns = self.get_available_testruns(self.testplan_id)
                 print('[{}] Testruns to update: {}'.format(TESTRAIL_PREFIX, ', '.join([str(elt) for elt in testruns])))
+                self.publish_to_testruns(testruns)
                 for testrun_id in testruns:
-                    self.add_results(testrun_id)
+                    print('[{}] Testrun {} published in {:.2f}s'.format(
+                        TESTRAIL_PREFIX, testrun_id, self.publish_timings[testrun_id]))
             else:
                 print('[{}] No data published'.format(TESTRAIL_PREFIX))
 
-            if self.close_on_complete and self.testrun_id:
-                self.close_test_run(self.testrun_id)
-            elif self.close_on_complete and self.testplan_id:
-                self.close_test_plan(self.testplan_id)
+            if self.failed_batches:
+                print('[{}] {} batch(es) of results could not be published, see "failed_batches"'.format(
+                    TESTRAIL_PREFIX, len(self.failed_batches)))
+        elif self._stream_thread:
+            self.stop_streaming()
+
+        # With shards, the testrun is closed by the last shard to complete
+        if self.shard is not None:
+            can_close = self.shard.finish()
+        else:
+            can_close = bool(self.results)
+        if can_close and self.close_on_complete and self.testrun_id:
+            self.close_test_run(self.testrun_id)
+        elif can_close and self.close_on_complete and self.testplan_id:
+            self.close_test_plan(self.testplan_id)
+        stats = getattr(self.client, 'throttle_stats', None)
+        if isinstance(stats, ThrottleStats) and (stats.throttled_requests or stats.too_many_requests):
+            print('[{}] Throttled for {:.1f}s: {} request(s) delayed, {} "429 Too Many Requests" response(s)'.format(
+                TESTRAIL_PREFIX, stats.throttled_time, stats.throttled_requests, stats.too_many_requests))
+        if self._setup_executor is not None:
+            self._setup_executor.shutdown()
+        self.client.close()
+        if self.spool is not None:
+            self.spool.close()
         print('[{}] End publishing'.format(TESTRAIL_PREFIX))
 
     # plugin
 
+    def index_items(self, items):
+        """
+        Parse TestRail markers of collected items once, and keep them in `testrail_keys` for later phases.
+
+        :return list: tuples of items with testrail markers and their testcase ids
+        """
+        items_with_tr_keys = []
+        for item in items:
+            keys = self.testrail_keys[item.nodeid] = get_item_keys(item)
+            if keys[0] is not None:
+                items_with_tr_keys.append((item, keys[0]))
+        return items_with_tr_keys
+
+    def prepare_testrun(self, tr_keys, items_with_tr_keys=()):
+        """
+        Select the existing testplan or testrun, or create a new testrun with the given testcase ids.
+
+        With `background_setup`, the new testrun is created in the background: tests run meanwhile, and results
+        wait for it when they are first published.
+
+        :param list tr_keys: collected testcase ids
+        :param list items_with_tr_keys: tuples of items and their testcase ids, to skip the ones missing in the testrun
+        """
+        testplan_lookup, self._testplan_lookup = self._testplan_lookup, None
+        testrun_lookup, self._testrun_lookup = self._testrun_lookup, None
+        if self.testplan_id and (self._setup_result(testplan_lookup) if testplan_lookup
+                                 else self.is_testplan_available()):
+            self.testrun_id = 0
+        elif self.testrun_id and (self._setup_result(testrun_lookup) if testrun_lookup
+                                  else self.is_testrun_available()):
+            self.testplan_id = 0
+            if self.skip_missing:
+                self.skip_missing_items(items_with_tr_keys)
+        elif self.shard is not None:
+            self.testrun_id = self.shard.get_or_create_run(tr_keys, self._create_new_test_run)
+            print('[{}] Shard "{}" uses testrun ID={}'.format(TESTRAIL_PREFIX, self.shard.shard_id, self.testrun_id))
+            if self.testrun_id and self.skip_missing:
+                self.skip_missing_items(items_with_tr_keys)
+        elif self.background_setup:
+            self._testrun_setup = self._submit_setup(self._setup_new_test_run, tr_keys)
+            return
+        else:
+            self._create_new_test_run(tr_keys)
+        self._testrun_ready()
+
+    def _setup_new_test_run(self, tr_keys):
+        self._create_new_test_run(tr_keys)
+        self._testrun_ready()
+
+    def _testrun_ready(self):
+        """ Record the testrun or testplan fed in the spool, and start streaming results to it """
+        if self.spool is not None:
+            self.spool.write_target(run_id=self.testrun_id, plan_id=self.testplan_id, version=self.version,
+                                    custom_comment=self.custom_comment, batch_size=self.batch_size,
+                                    batch_max_bytes=self.batch_max_bytes,
+                                    comment_size_limit=self.comment_renderer.limit,
+                                    comment_strategy=self.comment_renderer.strategy,
+                                    merge_policy=self.merge_policy)
+
+        if self.stream and self.xdist_role != XDIST_CONTROLLER:
+            self.start_streaming()
+
+    def _submit_setup(self, func, *args):
+        if self._setup_executor is None:
+            self._setup_executor = ThreadPoolExecutor(max_workers=1)
+        return self._setup_executor.submit(self._run_setup, func, *args)
+
+    def _run_setup(self, func, *args):
+        self._setup_local.hold_messages = True
+        try:
+            return func(*args)
+        finally:
+            self._setup_local.hold_messages = False
+
+    def _setup_result(self, setup):
+        """ Wait for a task of the setup thread and print the messages it held back """
+        try:
+            return setup.result()
+        finally:
+            messages, self._held_messages = self._held_messages, []
+            for message in messages:
+                print(message)
+
+    def _print(self, message):
+        """
+        Print a message, or hold it back when called from the setup thread: it would be printed in the middle of the
+        progress line of pytest. Held messages are printed when the main thread waits for the setup.
+        """
+        if getattr(self._setup_local, 'hold_messages', False):
+            self._held_messages.append(message)
+        else:
+            print(message)
+
+    def start_lookup(self):
+        """
+        Check the selected testplan or testrun in the background, so that the request overlaps test collection.
+        `prepare_testrun` uses the answer.
+        """
+        if self.testplan_id:
+            self._testplan_lookup = self._submit_setup(self.is_testplan_available)
+        elif self.testrun_id:
+            self._testrun_lookup = self._submit_setup(self.is_testrun_available)
+
+    def wait_testrun(self):
+        """
+        Wait for the testrun created in the background by `prepare_testrun`, if any.
+        """
+        setup, self._testrun_setup = self._testrun_setup, None
+        if setup is not None:
+            try:
+                self._setup_result(setup)
+            except Exception as exc:
+                print('[{}] Failed to create testrun: "{}"'.format(TESTRAIL_PREFIX, exc))
+
+    def _create_new_test_run(self, tr_keys):
+        if self.testrun_name is None:
+            self.testrun_name = testrun_name()
+        self.create_test_run(self.assign_user_id, self.project_id, self.suite_id, self.include_all,
+                             self.testrun_name, tr_keys, self.milestone_id, self.testrun_description)
+        return self.testrun_id
+
+    def skip_missing_items(self, items_with_tr_keys):
+        """ Mark items whose testcases are not present in the testrun as skipped """
+        membership = self.get_run_membership(self.testrun_id)
+        if membership is not None:
+            for item, case_id in items_with_tr_keys:
+                if membership.case_ids.isdisjoint(case_id):
+                    mark = pytest.mark.skip('Test is not present in testrun.')
+                    item.add_marker(mark)
+
+    def get_item_keys(self, item):
+        """
+        :return tuple: (testcase ids, defects) of an item, from `testrail_keys` when already parsed.
+        """
+        try:
+            return self.testrail_keys[item.nodeid]
+        except KeyError:
+            keys = self.testrail_keys[item.nodeid] = get_item_keys(item)
+            return keys
+
     def add_result(self, test_ids, status, comment='', defects=None, duration=0, test_parametrize=None):
         """
-        Add a new result to results dict to be submitted at the end.
+        Add a new result to results list to be submitted at the end.
 
         :param list test_parametrize: Add test parametrize to test result
         :param defects: Add defects to test result
@@ -275,91 +630,367 @@ class PyTestRailPlugin(object):
         :param comment: None or a failure representation.
         :param duration: Time it took to run just the test.
         """
+        results = []
         for test_id in test_ids:
-            data = {
-                'case_id': test_id,
-                'status_id': status,
-                'comment': comment,
-                'duration': duration,
-                'defects': defects,
-                'test_parametrize': test_parametrize
-            }
-            self.results.append(data)
+            # the comment is rendered once for all the case ids of the test
+            results.append(results[0].for_case(test_id) if results else CaseResult(
+                test_id, status, comment, duration, defects, test_parametrize, self.comment_renderer))
+        self.results.extend(results)
+        if self.spool is not None:
+            self.spool.write_results(results)
+        if self._stream_thread and len(self.results) - self._flushed >= self.batch_size > 0:
+            self._stream_wakeup.set()
+
+    def start_streaming(self):
+        """
+        Start the background worker publishing results while tests are still running.
+
+        Results are flushed every `stream_interval` seconds, or as soon as `batch_size` results are pending.
 
-    def add_results(self, testrun_id):
+        Results merged by `merge_policy` are not streamed: more results of a case may be recorded until the end of
+        the session, and TestRail shows the latest result of a case, so they are held back and published once, at
+        the end of the session.
         """
-        Add results one by one to improve errors handling.
+        if self.merge_policy != MERGE_ALL:
+            self._print('[{}] Results merged with the "{}" policy are published at the end of the session, '
+                        'not streamed'.format(TESTRAIL_PREFIX, self.merge_policy))
+            return
+        if self.testrun_id:
+            self._stream_testruns = [self.testrun_id]
+        elif self.testplan_id:
+            self._stream_testruns = self.get_available_testruns(self.testplan_id)
+        else:
+            self._print('[{}] No testrun available, results will not be streamed'.format(TESTRAIL_PREFIX))
+            return
+        self._print('[{}] Streaming results to testruns: {}'.format(
+            TESTRAIL_PREFIX, ', '.join(str(elt) for elt in self._stream_testruns)))
+        self._stream_thread = threading.Thread(target=self._stream_worker, name='pytest-testrail-stream')
+        self._stream_thread.daemon = True
+        self._stream_thread.start()
+
+    def stop_streaming(self):
+        """
+        Stop the background worker and publish the results still pending.
+        """
+        self._stream_stopping.set()
+        self._stream_wakeup.set()
+        self._stream_thread.join()
+        self._stream_thread = None
+        self.flush_results()
+
+    def _stream_worker(self):
+        while not self._stream_stopping.is_set():
+            self._stream_wakeup.wait(self.stream_interval)
+            self._stream_wakeup.clear()
+            if self._stream_stopping.is_set():
+                break
+            try:
+                self.flush_results()
+            except Exception as exc:
+                print('[{}] Failed to stream results: "{}"'.format(TESTRAIL_PREFIX, exc))
+
+    def flush_results(self):
+        """
+        Publish the results recorded since the previous flush to the streamed testruns.
+        """
+        with self._flush_lock:
+            start = self._flushed
+            pending = self.results[start:]
+            if not pending:
+                return
+            self._flushed += len(pending)
+            self.publish_to_testruns(self._stream_testruns, pending, upload=(start, self._flushed))
+
+    def publish_to_testruns(self, testruns, results=None, upload=None):
+        """
+        Publish results to several testruns, up to `publish_workers` testruns at a time.
 
-        :param testrun_id: Id of the testrun to feed
+        The time spent on each testrun is accumulated in `publish_timings`.
+
+        :param list testruns: Ids of the testruns to feed
+        :param list results: results to publish (defaults to all the results recorded)
+        :param tuple upload: (start, end) range of the recorded results given as `results`
+        """
+        payload = self.build_payload(results)
+        if upload is None and results is None:
+            upload = (0, len(self.results))
+        if self.async_client is not None and len(testruns) > 1:
+            self.async_client.run(self.publish_to_testruns_async(testruns, payload, upload))
+            return
+
+        def publish(testrun_id):
+            start = time.time()
+            try:
+                self.add_results(testrun_id, payload=payload, upload=upload)
+            finally:
+                elapsed = time.time() - start
+                self.publish_timings[testrun_id] = self.publish_timings.get(testrun_id, 0) + elapsed
+
+        if self.publish_workers == 1 or len(testruns) < 2:
+            for testrun_id in testruns:
+                publish(testrun_id)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.publish_workers, len(testruns))) as executor:
+            for future in [executor.submit(publish, testrun_id) for testrun_id in testruns]:
+                future.result()
+
+    async def publish_to_testruns_async(self, testruns, payload, upload=None):
+        """
+        Publish results to several testruns through `async_client`.
+
+        The tests of every testrun are listed concurrently, then the uploads of all testruns run concurrently, the
+        batches of a single testrun being still sent in order.
+
+        :param list testruns: Ids of the testruns to feed
+        :param ResultsPayload payload: rendered results
+        :param tuple upload: (start, end) range of the recorded results rendered in `payload`
+        """
+        if self.publish_blocked is False:
+            print('[{}] Option "Don\'t publish blocked testcases" activated'.format(TESTRAIL_PREFIX))
+            pending = [run_id for run_id in testruns if run_id not in self._run_memberships]
+            memberships = await asyncio.gather(*[self.get_run_membership_async(run_id) for run_id in pending])
+            self._run_memberships.update(zip(pending, memberships))
+        await asyncio.gather(*[self.add_results_async(testrun_id, payload, upload) for testrun_id in testruns])
 
+    async def add_results_async(self, testrun_id, payload, upload=None):
         """
-        # unicode converter for compatibility of python 2 and 3
+        Asynchronous counterpart of `add_results`, using the testrun membership already fetched.
+        """
+        start = time.time()
+        membership = self._run_memberships.get(testrun_id)
+        if self.publish_blocked is False and membership is not None:
+            blocked_tests_list = membership.with_status(TESTRAIL_TEST_STATUS["blocked"])
+            print('[{}] Blocked testcases excluded: {}'.format(
+                TESTRAIL_PREFIX, ', '.join(str(elt) for elt in sorted(blocked_tests_list))))
+            payload = payload.exclude(blocked_tests_list)
+        batches = payload.batches(self.batch_size, self.batch_max_bytes, self._encoder())
         try:
-            converter = unicode
-        except NameError:
-            converter = lambda s, c: str(bytes(s, "utf-8"), c)
-        # Results are sorted by 'case_id' and by 'status_id' (worst result at the end)
+            for index, (batch, data) in enumerate(batches):
+                if self._is_published(testrun_id, upload, batch):
+                    continue
+                try:
+                    response = await self.async_client.send_post(
+                        ADD_RESULTS_URL.format(testrun_id),
+                        data,
+                        cert_check=self.cert_check
+                    )
+                    error = self.async_client.get_error(response)
+                except Exception as exc:
+                    error = '{}: {}'.format(type(exc).__name__, exc)
+                self._check_batch(testrun_id, batch, index, len(batches), error, upload)
+        finally:
+            elapsed = time.time() - start
+            self.publish_timings[testrun_id] = self.publish_timings.get(testrun_id, 0) + elapsed
+
+    async def get_run_membership_async(self, run_id):
+        """
+        Asynchronous counterpart of `get_run_membership`, following the pages of 'get_tests' with `async_client`.
+
+        :return RunMembership: or None if tests of the testrun can't be retrieved.
+        """
+        tests = []
+        uri = GET_TESTS_URL.format(run_id)
+        while uri:
+            response = await self.async_client.send_get(uri, cert_check=self.cert_check)
+            error = self.async_client.get_error(response)
+            if error:
+                print('[{}] Failed to get tests: "{}"'.format(TESTRAIL_PREFIX, error))
+                return None
+            page, uri = read_tests_page(response)
+            tests.extend(page)
+        return RunMembership(tests)
+
+    def add_results(self, testrun_id, results=None, payload=None, upload=None):
+        """
+        Add results one by one to improve errors handling.
 
-        # Comment sort by status_id due to issue with pytest-rerun failures,
-        # for details refer to issue https://github.com/allankp/pytest-testrail/issues/100
-        # self.results.sort(key=itemgetter('status_id'))
-        self.results.sort(key=itemgetter('case_id'))
+        :param testrun_id: Id of the testrun to feed
+        :param list results: results to publish (defaults to all the results recorded)
+        :param ResultsPayload payload: already rendered results, takes precedence over `results`
+        :param tuple upload: (start, end) range of the recorded results published, to acknowledge published
+                             batches in the spool
+
+        """
+        if upload is None and results is None and payload is None:
+            upload = (0, len(self.results))
+        if payload is None:
+            payload = self.build_payload(results)
 
         # Manage case of "blocked" testcases
         if self.publish_blocked is False:
             print('[{}] Option "Don\'t publish blocked testcases" activated'.format(TESTRAIL_PREFIX))
-            blocked_tests_list = [
-                test.get('case_id') for test in self.get_tests(testrun_id)
-                if test.get('status_id') == TESTRAIL_TEST_STATUS["blocked"]
-            ]
-            print('[{}] Blocked testcases excluded: {}'.format(TESTRAIL_PREFIX,
-                                                               ', '.join(str(elt) for elt in blocked_tests_list)))
-            self.results = [result for result in self.results if result.get('case_id') not in blocked_tests_list]
+            membership = self.get_run_membership(testrun_id)
+            if membership is not None:
+                blocked_tests_list = membership.with_status(TESTRAIL_TEST_STATUS["blocked"])
+                print('[{}] Blocked testcases excluded: {}'.format(
+                    TESTRAIL_PREFIX, ', '.join(str(elt) for elt in sorted(blocked_tests_list))))
+                payload = payload.exclude(blocked_tests_list)
 
         # prompt enabling include all test cases from test suite when creating test run
         if self.include_all:
             print('[{}] Option "Include all testcases from test suite for test run" activated'.format(TESTRAIL_PREFIX))
 
         # Publish results
-        data = {'results': []}
-        for result in self.results:
-            entry = {'status_id': result['status_id'], 'case_id': result['case_id'], 'defects': result['defects']}
-            if self.version:
-                entry['version'] = self.version
-            comment = result.get('comment', '')
-            test_parametrize = result.get('test_parametrize', '')
-            entry['comment'] = u''
-            if test_parametrize:
-                entry['comment'] += u"# Test parametrize: #\n"
-                entry['comment'] += str(test_parametrize) + u'\n\n'
-            if comment:
-                if self.custom_comment:
-                    entry['comment'] += self.custom_comment + '\n'
-                    # Indent text to avoid string formatting by TestRail. Limit size of comment.
-                    entry['comment'] += u"# Pytest result: #\n"
-                    entry['comment'] += u'Log truncated\n...\n' if len(str(comment)) > COMMENT_SIZE_LIMIT else u''
-                    entry['comment'] += u"    " + converter(str(comment), "utf-8")[-COMMENT_SIZE_LIMIT:].replace('\n', '\n    ') # noqa
-                else:
-                    # Indent text to avoid string formatting by TestRail. Limit size of comment.
-                    entry['comment'] += u"# Pytest result: #\n"
-                    entry['comment'] += u'Log truncated\n...\n' if len(str(comment)) > COMMENT_SIZE_LIMIT else u''
-                    entry['comment'] += u"    " + converter(str(comment), "utf-8")[-COMMENT_SIZE_LIMIT:].replace('\n', '\n    ') # noqa
-            elif comment == '':
-                entry['comment'] = self.custom_comment
-            duration = result.get('duration')
-            if duration:
-                duration = 1 if (duration < 1) else int(round(duration))  # TestRail API doesn't manage milliseconds
-                entry['elapsed'] = str(duration) + 's'
-            data['results'].append(entry)
+        batches = payload.batches(self.batch_size, self.batch_max_bytes, self._encoder())
+        for index, (batch, data) in enumerate(batches):
+            if not self._is_published(testrun_id, upload, batch):
+                self.publish_batch(testrun_id, batch, index, len(batches), upload, data)
 
-        response = self.client.send_post(
-            ADD_RESULTS_URL.format(testrun_id),
-            data,
-            cert_check=self.cert_check
-        )
-        error = self.client.get_error(response)
+    def _encoder(self):
+        """ :return: the function encoding request bodies of the client, or None if it doesn't expose one """
+        return getattr(self.client, 'encode', None)
+
+    def build_payload(self, results=None):
+        """
+        Render results into the entries sent to TestRail.
+
+        Results of the same case are first merged according to `merge_policy`. Rendering the recorded results is
+        done once and cached, so that publishing them to several testruns doesn't render them again.
+
+        :param list results: results to render (defaults to all the results recorded)
+        :return ResultsPayload:
+        """
+        if results is not None:
+            return self._render_payload(results)
+        key = (id(self.results), len(self.results))
+        if self._payload_key != key:
+            self._payload = self._render_payload(self.results)
+            self._payload_key = key
+        return self._payload
+
+    def _render_payload(self, results):
+        results = merge_results(results, self.merge_policy)
+        return ResultsPayload([self.render_result(result) for result in sort_results(results)])
+
+    def render_result(self, result):
+        """
+        Render a single result into an entry of 'add_results_for_cases'.
+
+        :param CaseResult result: result, as recorded by `add_result` (or an equivalent dict)
+        :return dict:
+        """
+        entry = {'status_id': result['status_id'], 'case_id': result['case_id'], 'defects': result['defects']}
+        if self.version:
+            entry['version'] = self.version
+        comment = result.get('comment', '')
+        test_parametrize = result.get('test_parametrize', '')
+        entry['comment'] = u''
+        if test_parametrize:
+            entry['comment'] += u"# Test parametrize: #\n"
+            entry['comment'] += str(test_parametrize) + u'\n\n'
+        if comment:
+            if self.custom_comment:
+                entry['comment'] += self.custom_comment + '\n'
+            comment, truncated = self.comment_renderer.render(comment)
+            truncated = truncated or isinstance(result, CaseResult) and result.truncated
+            entry['comment'] += u"# Pytest result: #\n"
+            entry['comment'] += self.comment_renderer.format(comment, truncated)
+        elif comment == '':
+            entry['comment'] = self.custom_comment
+        if isinstance(result, MergedCaseResult):
+            entry['comment'] = u"# Merged results: #\n" + result.summary + u'\n\n' + (entry['comment'] or u'')
+        duration = result.get('duration')
+        if duration:
+            duration = 1 if (duration < 1) else int(round(duration))  # TestRail API doesn't manage milliseconds
+            entry['elapsed'] = str(duration) + 's'
+        return entry
+
+    def publish_batch(self, testrun_id, entries, index=0, count=1, upload=None, data=None):
+        """
+        Publish one batch of results. Failed batches are kept in `failed_batches` to be retried on their own.
+
+        :param testrun_id: Id of the testrun to feed
+        :param list entries: result entries of the batch
+        :param int index: position of the batch in the upload
+        :param int count: number of batches of the upload
+        :param tuple upload: (start, end) range of the recorded results the batch was built from
+        :param data: (optional) data of the request, as built by `ResultsPayload.batches`
+        :return: True if the batch was published
+        """
+        try:
+            response = self.client.send_post(
+                ADD_RESULTS_URL.format(testrun_id),
+                {'results': entries} if data is None else data,
+                cert_check=self.cert_check
+            )
+            error = self.client.get_error(response)
+        except Exception as exc:
+            error = '{}: {}'.format(type(exc).__name__, exc)
+        return self._check_batch(testrun_id, entries, index, count, error, upload)
+
+    def _check_batch(self, testrun_id, entries, index, count, error, upload=None):
+        """
+        Keep a batch in `failed_batches` when its upload failed with `error`, acknowledge it in the spool otherwise.
+        """
         if error:
-            print('[{}] Info: Testcases not published for following reason: "{}"'.format(TESTRAIL_PREFIX, error))
+            print('[{}] Info: Testcases not published (batch {}/{} of testrun {}, case ids {}-{}) '
+                  'for following reason: "{}"'.format(TESTRAIL_PREFIX, index + 1, count, testrun_id,
+                                                      entries[0]['case_id'], entries[-1]['case_id'], error))
+            self.failed_batches.append({
+                'testrun_id': testrun_id,
+                'index': index,
+                'count': count,
+                'results': entries,
+                'error': error,
+                'upload': upload
+            })
+            return False
+        if self.spool is not None and upload is not None:
+            self.spool.ack(testrun_id, upload, entries)
+        return True
+
+    def _is_published(self, testrun_id, upload, entries):
+        """ :return: True if the batch was already acknowledged in the spool """
+        return self.spool is not None and upload is not None and self.spool.is_acked(testrun_id, upload, entries)
+
+    def publish_spool(self, spool):
+        """
+        Publish the results of a spool written by a previous session, skipping the batches it acknowledges.
+
+        :param ResultSpool spool: spool loaded with `resume=True`
+        :return: True if every result of the spool is published
+        """
+        target = spool.target or {}
+        if not (target.get('run_id') or target.get('plan_id')):
+            print('[{}] No testrun recorded in spool "{}"'.format(TESTRAIL_PREFIX, spool.path))
+            return False
+        self.spool = spool
+        self.testrun_id, self.testplan_id = target['run_id'], target['plan_id']
+        self.version, self.custom_comment = target['version'], target['custom_comment']
+        self.batch_size, self.batch_max_bytes = target['batch_size'], target['batch_max_bytes']
+        self.comment_renderer = CommentRenderer(target.get('comment_size_limit'),
+                                                target.get('comment_strategy', COMMENT_TAIL))
+        self.merge_policy = target.get('merge_policy', MERGE_ALL)
+        self.results = [CaseResult.from_record(record) for record in spool.results]
+        testruns = [self.testrun_id] if self.testrun_id else self.get_available_testruns(self.testplan_id)
+        print('[{}] Publishing {} result(s) of spool "{}" to testruns: {}'.format(
+            TESTRAIL_PREFIX, len(self.results), spool.path, ', '.join(str(elt) for elt in testruns)))
+        for testrun_id in testruns:
+            for start, end in spool.uploads(testrun_id, len(self.results)):
+                self.add_results(testrun_id, self.results[start:end], upload=(start, end))
+
+        if self.failed_batches:
+            print('[{}] {} batch(es) of results could not be published, publish the spool again to retry'.format(
+                TESTRAIL_PREFIX, len(self.failed_batches)))
+        elif self.close_on_complete and self.testrun_id:
+            self.close_test_run(self.testrun_id)
+        elif self.close_on_complete and self.testplan_id:
+            self.close_test_plan(self.testplan_id)
+        self.client.close()
+        spool.close()
+        return not self.failed_batches
+
+    def retry_failed_batches(self):
+        """
+        Publish again every batch that previously failed.
+
+        :return: the list of batches still failing
+        """
+        failed_batches, self.failed_batches = self.failed_batches, []
+        for batch in failed_batches:
+            self.publish_batch(batch['testrun_id'], batch['results'], batch['index'], batch['count'],
+                               batch.get('upload'))
+        return self.failed_batches
 
     def create_test_run(self, assign_user_id, project_id, suite_id, include_all,
                         testrun_name, tr_keys, milestone_id, description=''):
@@ -385,12 +1016,12 @@ class PyTestRailPlugin(object):
         )
         error = self.client.get_error(response)
         if error:
-            print('[{}] Failed to create testrun: "{}"'.format(TESTRAIL_PREFIX, error))
+            self._print('[{}] Failed to create testrun: "{}"'.format(TESTRAIL_PREFIX, error))
         else:
             self.testrun_id = response['id']
-            print('[{}] New testrun created with name "{}" and ID={}'.format(TESTRAIL_PREFIX,
-                                                                             testrun_name,
-                                                                             self.testrun_id))
+            self._print('[{}] New testrun created with name "{}" and ID={}'.format(TESTRAIL_PREFIX,
+                                                                                   testrun_name,
+                                                                                   self.testrun_id))
 
     def close_test_run(self, testrun_id):
         """
@@ -436,7 +1067,7 @@ class PyTestRailPlugin(object):
         )
         error = self.client.get_error(response)
         if error:
-            print('[{}] Failed to retrieve testrun: "{}"'.format(TESTRAIL_PREFIX, error))
+            self._print('[{}] Failed to retrieve testrun: "{}"'.format(TESTRAIL_PREFIX, error))
             return False
 
         return response['is_completed'] is False
@@ -453,7 +1084,7 @@ class PyTestRailPlugin(object):
         )
         error = self.client.get_error(response)
         if error:
-            print('[{}] Failed to retrieve testplan: "{}"'.format(TESTRAIL_PREFIX, error))
+            self._print('[{}] Failed to retrieve testplan: "{}"'.format(TESTRAIL_PREFIX, error))
             return False
 
         return response['is_completed'] is False
@@ -470,7 +1101,7 @@ class PyTestRailPlugin(object):
         )
         error = self.client.get_error(response)
         if error:
-            print('[{}] Failed to retrieve testplan: "{}"'.format(TESTRAIL_PREFIX, error))
+            self._print('[{}] Failed to retrieve testplan: "{}"'.format(TESTRAIL_PREFIX, error))
         else:
             for entry in response['entries']:
                 for run in entry['runs']:
@@ -478,17 +1109,47 @@ class PyTestRailPlugin(object):
                         testruns_list.append(run['id'])
         return testruns_list
 
+    def get_run_membership(self, run_id):
+        """
+        Build the membership index of a testrun once, and reuse it afterwards.
+
+        :return RunMembership: or None if tests of the testrun can't be retrieved.
+        """
+        if run_id not in self._run_memberships:
+            try:
+                self._run_memberships[run_id] = RunMembership(self.iter_tests(run_id))
+            except TestRailResponseError as exc:
+                print('[{}] Failed to get tests: "{}"'.format(TESTRAIL_PREFIX, exc))
+                self._run_memberships[run_id] = None
+        return self._run_memberships[run_id]
+
     def get_tests(self, run_id):
         """
-        :return: the list of tests containing in a testrun.
+        :return: the list of tests containing in a testrun (only 'case_id' and 'status_id' of each test).
 
         """
-        response = self.client.send_get(
-            GET_TESTS_URL.format(run_id),
-            cert_check=self.cert_check
-        )
-        error = self.client.get_error(response)
-        if error:
-            print('[{}] Failed to get tests: "{}"'.format(TESTRAIL_PREFIX, error))
+        try:
+            return list(self.iter_tests(run_id))
+        except TestRailResponseError as exc:
+            print('[{}] Failed to get tests: "{}"'.format(TESTRAIL_PREFIX, exc))
             return None
-        return response
+
+    def iter_tests(self, run_id):
+        """
+        Iterate over the tests of a testrun, one page at a time.
+
+        Paginated responses (TestRail 6.7+) are followed through their '_links.next' link, and only the fields used
+        by the plugin are kept, so that the full JSON of every page is not held in memory at once.
+
+        :raise TestRailResponseError: if a page can't be retrieved.
+        :return generator: dicts with 'case_id' and 'status_id' of each test.
+        """
+        uri = GET_TESTS_URL.format(run_id)
+        while uri:
+            response = self.client.send_get(uri, cert_check=self.cert_check)
+            error = self.client.get_error(response)
+            if error:
+                raise TestRailResponseError(error)
+            tests, uri = read_tests_page(response)
+            for test in tests:
+                yield test
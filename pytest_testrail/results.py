@@ -0,0 +1,216 @@
+# -*- coding: UTF-8 -*-
+#
+# Results recorded by the plugin, and how the results of a same TestRail case are merged. Kept apart from the plugin
+# so that the entry point can list the merge policies without importing it.
+#
+from collections import OrderedDict
+from operator import itemgetter
+
+from .comments import DEFAULT_COMMENT_RENDERER
+
+# Reference: http://docs.gurock.com/testrail-api2/reference-statuses
+TESTRAIL_TEST_STATUS = {
+    "passed": 1,
+    "blocked": 2,
+    "untested": 3,
+    "retest": 4,
+    "failed": 5
+}
+
+MERGE_ALL = 'all'
+MERGE_LAST = 'last'
+MERGE_WORST = 'worst'
+MERGE_FIRST_FAILURE = 'first-failure'
+MERGE_POLICIES = (MERGE_ALL, MERGE_LAST, MERGE_WORST, MERGE_FIRST_FAILURE)
+
+# From the best status to the worst, for the "worst" merge policy. Custom statuses rank as "retest".
+STATUS_SEVERITY = {
+    TESTRAIL_TEST_STATUS["passed"]: 0,
+    TESTRAIL_TEST_STATUS["untested"]: 1,
+    TESTRAIL_TEST_STATUS["blocked"]: 2,
+    TESTRAIL_TEST_STATUS["retest"]: 3,
+    TESTRAIL_TEST_STATUS["failed"]: 4,
+}
+STATUS_NAMES = dict((status_id, name) for name, status_id in TESTRAIL_TEST_STATUS.items())
+
+# Parametrizations of the results that didn't pass, listed in the summary of a merged result
+MERGE_SUMMARY_PARAMS = 10
+
+
+def sort_results(results):
+    """
+    Sort results by 'case_id'.
+
+    Sort by 'status_id' (worst result at the end) is disabled due to issue with pytest-rerun failures,
+    for details refer to issue https://github.com/allankp/pytest-testrail/issues/100: results of the same case are
+    merged by `merge_results` instead.
+    """
+    return sorted(results, key=itemgetter('case_id'))
+
+
+def severity(status_id):
+    """ Rank of a status, from 0 (passed) to the worst one """
+    return STATUS_SEVERITY.get(status_id, STATUS_SEVERITY[TESTRAIL_TEST_STATUS['retest']])
+
+
+class CaseResult(object):
+    """
+    Result of a pytest test for a single TestRail case.
+
+    The failure representation is rendered to text and truncated by a `CommentRenderer` when the result is
+    recorded, so that the report (tracebacks, locals, captured output) is not kept alive until the end of the
+    session. Results can still be read like the dicts used by previous versions (`result['case_id']`,
+    `result.get('comment')`) and compare equal to them.
+    """
+    __slots__ = ('case_id', 'status_id', 'comment', 'duration', 'defects', 'test_parametrize', 'truncated')
+    fields = ('case_id', 'status_id', 'comment', 'duration', 'defects', 'test_parametrize')
+
+    def __init__(self, case_id, status_id, comment='', duration=0, defects=None, test_parametrize=None,
+                 renderer=DEFAULT_COMMENT_RENDERER):
+        self.case_id = case_id
+        self.status_id = status_id
+        self.duration = duration
+        self.defects = defects
+        self.test_parametrize = test_parametrize
+        self.truncated = False
+        if comment:
+            comment, self.truncated = renderer.render(comment)
+        self.comment = comment
+
+    def for_case(self, case_id):
+        """ Return a copy of the result for another case id, without rendering the comment again """
+        result = CaseResult.__new__(CaseResult)
+        for slot in self.__slots__:
+            setattr(result, slot, getattr(self, slot))
+        result.case_id = case_id
+        return result
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def to_record(self):
+        """ Return the result as a compact tuple of builtin types, e.g. to send it from a pytest-xdist worker """
+        test_parametrize = None if self.test_parametrize is None else str(self.test_parametrize)
+        return (self.case_id, self.status_id, self.comment, self.duration, self.defects, test_parametrize,
+                self.truncated)
+
+    @classmethod
+    def from_record(cls, record):
+        """ Build a result back from the tuple returned by `to_record` """
+        result = cls.__new__(cls)
+        for slot, value in zip(cls.__slots__, record):
+            setattr(result, slot, value)
+        return result
+
+    def __eq__(self, other):
+        if isinstance(other, CaseResult):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CaseResult({})'.format(', '.join('{}={!r}'.format(field, getattr(self, field))
+                                                 for field in self.fields))
+
+
+class MergedCaseResult(CaseResult):
+    """
+    Result standing for several results of the same TestRail case (parametrized tests, reruns), with a summary of
+    their outcomes.
+    """
+    __slots__ = ('summary',)
+
+
+class _CaseMerge(object):
+    """ Results of a TestRail case merged so far """
+    __slots__ = ('result', 'count', 'duration', 'outcomes', 'not_passed', 'params')
+
+    def __init__(self):
+        self.result = None
+        self.count = 0
+        self.duration = 0
+        self.outcomes = {}
+        self.not_passed = 0
+        self.params = []
+
+    def add(self, result, policy):
+        status_id = result['status_id']
+        self.count += 1
+        self.duration += result.get('duration') or 0
+        self.outcomes[status_id] = self.outcomes.get(status_id, 0) + 1
+        if status_id != TESTRAIL_TEST_STATUS['passed']:
+            self.not_passed += 1
+            test_parametrize = result.get('test_parametrize')
+            if test_parametrize and len(self.params) < MERGE_SUMMARY_PARAMS:
+                self.params.append(str(test_parametrize))
+
+        if self.result is None or policy == MERGE_LAST:
+            self.result = result
+        elif policy == MERGE_WORST:
+            # The latest of the worst results
+            if severity(status_id) >= severity(self.result['status_id']):
+                self.result = result
+        elif policy == MERGE_FIRST_FAILURE:
+            # The last result until one fails
+            if self.result['status_id'] != TESTRAIL_TEST_STATUS['failed']:
+                self.result = result
+
+    def summary(self):
+        outcomes = sorted(self.outcomes.items(), key=lambda item: (severity(item[0]), item[0]))
+        summary = '{} results: {}'.format(self.count, ', '.join(
+            '{} {}'.format(count, STATUS_NAMES.get(status_id, 'status {}'.format(status_id)))
+            for status_id, count in outcomes))
+        if self.params:
+            summary += '\nNot passed: ' + ', '.join(self.params)
+            if self.not_passed > len(self.params):
+                summary += ', ... ({} more)'.format(self.not_passed - len(self.params))
+        return summary
+
+    def merged(self):
+        if self.count == 1:
+            return self.result
+        result = MergedCaseResult.__new__(MergedCaseResult)
+        result.case_id = self.result['case_id']
+        result.status_id = self.result['status_id']
+        result.comment = self.result.get('comment', '')
+        result.duration = self.duration
+        result.defects = self.result.get('defects')
+        result.test_parametrize = self.result.get('test_parametrize')
+        result.truncated = getattr(self.result, 'truncated', False)
+        result.summary = self.summary()
+        return result
+
+
+def merge_results(results, policy=MERGE_ALL):
+    """
+    Merge the results of each TestRail case into one, in a single pass over the results.
+
+    :param results: results, in the order they were recorded
+    :param str policy: result kept for a case: the last one, the worst one, the first failure (or the last result
+        if none failed), or all of them (`MERGE_ALL`, no merge)
+    :return list: results, in the order their case was first recorded. Results merged from several ones are
+        `MergedCaseResult` instances, with the duration of all of them and a summary of their outcomes.
+    """
+    if policy not in MERGE_POLICIES:
+        raise ValueError('merge policy must be one of {}, not "{}"'.format(', '.join(MERGE_POLICIES), policy))
+    if policy == MERGE_ALL:
+        return results
+    merges = OrderedDict()
+    for result in results:
+        merge = merges.get(result['case_id'])
+        if merge is None:
+            merge = merges[result['case_id']] = _CaseMerge()
+        merge.add(result, policy)
+    return [merge.merged() for merge in merges.values()]
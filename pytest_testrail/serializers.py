@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+#
+# JSON serializers of request bodies. orjson and ujson are optional, and only imported when a client asks for them.
+#
+import importlib
+import json
+
+# From the fastest
+SERIALIZER_NAMES = ('orjson', 'ujson', 'json')
+
+
+def json_dumps(data):
+    # non-ASCII characters escaped, as requests does: lone surrogates (e.g. undecodable file names in exception
+    # messages) can't be encoded as UTF-8
+    return json.dumps(data, separators=(',', ':')).encode('ascii')
+
+
+def _load(name):
+    '''
+    :return: function returning the JSON document of a value as UTF-8 bytes, or None if `name` is not installed.
+    '''
+    if name == 'json':
+        return json_dumps
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        return None
+    if name == 'orjson':
+        return module.dumps
+    return lambda data: module.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def available_serializers():
+    '''
+    :return list: names of the serializers installed, from the fastest.
+    '''
+    return [name for name in SERIALIZER_NAMES if _load(name) is not None]
+
+
+def get_serializer(name=None):
+    '''
+    JSON serializer of request bodies.
+
+    :param name: (optional) One of ``orjson``, ``ujson`` or ``json``. Defaults to the fastest one installed.
+    :type name: str
+    :return: (name, function) tuple, the function returning the JSON document of a value as UTF-8 bytes.
+    '''
+    if name is not None and name not in SERIALIZER_NAMES:
+        raise ValueError('serializer must be one of {}, not "{}"'.format(', '.join(SERIALIZER_NAMES), name))
+    for serializer in SERIALIZER_NAMES if name is None else (name,):
+        dumps = _load(serializer)
+        if dumps is not None:
+            return serializer, dumps
+    raise ValueError('serializer "{}" is not installed'.format(name))
+
+
+class EncodedData(dict):
+    '''
+    Request data whose JSON document is already built: sending it again (e.g. the same batch of results to every
+    testrun of a testplan) doesn't serialize it again. Compares equal to the plain data.
+    '''
+
+    __slots__ = ('body',)
+
+    def __init__(self, data, body):
+        '''
+        :param dict data: data of the request
+        :param bytes body: JSON document of `data`, as UTF-8 bytes
+        '''
+        super(EncodedData, self).__init__(data)
+        self.body = body
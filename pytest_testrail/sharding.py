@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+import errno
+import json
+import os
+import socket
+import time
+
+from .plugin import TESTRAIL_PREFIX
+
+SHARD_TIMEOUT = 600
+RUN_FILE = 'run.json'
+RUN_LOCK = 'run.lock'
+CLOSE_LOCK = 'close.lock'
+CASES_PREFIX = 'cases-'
+DONE_PREFIX = 'done-'
+
+
+class ShardRendezvous(object):
+    '''
+    Coordinate shards of a test suite running on separate machines through a shared directory.
+
+    Every shard publishes the testcase ids it collected. The first shard to atomically create the run lock waits
+    for all shards, creates the testrun with the union of their testcase ids, and publishes the testrun id; the other
+    shards wait for it. Once every shard reported completion, a single one of them is elected to close the testrun.
+
+    The directory must be specific to one pipeline (e.g. include the CI pipeline id in its path).
+    '''
+
+    def __init__(self, directory, shard_count, shard_id=None, timeout=SHARD_TIMEOUT, poll_interval=0.5):
+        '''
+        :param directory: Directory shared by all shards.
+        :type directory: str
+        :param shard_count: Number of shards of the suite.
+        :type shard_count: int
+        :param shard_id: (optional) Unique name of this shard, defaults to ``<hostname>-<pid>``.
+        :type shard_id: str
+        :param timeout: (optional) Number of seconds to wait for the other shards.
+        :type timeout: float
+        '''
+        self.directory = str(directory)
+        self.shard_count = int(shard_count)
+        self.shard_id = str(shard_id or '{}-{}'.format(socket.gethostname(), os.getpid()))
+        self.timeout = float(timeout or SHARD_TIMEOUT)
+        self.poll_interval = poll_interval
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as exc:  # created by another shard meanwhile
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    def get_or_create_run(self, case_ids, create_run):
+        '''
+        Publish the testcase ids of this shard and return the id of the testrun shared by all shards.
+
+        :param case_ids: testcase ids collected by this shard.
+        :type case_ids: list
+        :param create_run: called with the union of every shard's testcase ids by the single shard creating the
+            testrun; must return the id of the new testrun (0 if it couldn't be created).
+        :type create_run: callable
+        :return: id of the testrun, 0 if it is not available.
+        '''
+        self._write_json(CASES_PREFIX + self.shard_id, list(case_ids))
+        if self._acquire(RUN_LOCK):
+            if not self._wait(lambda: len(self._names(CASES_PREFIX)) >= self.shard_count):
+                print('[{}] Shard "{}": timeout waiting for other shards, creating testrun with {}/{} shards'.format(
+                    TESTRAIL_PREFIX, self.shard_id, len(self._names(CASES_PREFIX)), self.shard_count))
+            all_case_ids = set()
+            for name in self._names(CASES_PREFIX):
+                all_case_ids.update(self._read_json(name))
+            run_id = create_run(sorted(all_case_ids))
+            self._write_json(RUN_FILE, {'run_id': run_id or 0, 'shard_id': self.shard_id})
+            return run_id or 0
+
+        if not self._wait(lambda: os.path.exists(self._path(RUN_FILE))):
+            print('[{}] Shard "{}": timeout waiting for the testrun to be created'.format(TESTRAIL_PREFIX,
+                                                                                          self.shard_id))
+            return 0
+        return self._read_json(RUN_FILE)['run_id']
+
+    def finish(self):
+        '''
+        Report completion of this shard.
+
+        :return: True for the single shard that should close the testrun, once every shard is done.
+        '''
+        self._write_json(DONE_PREFIX + self.shard_id, {'finished_at': time.time()})
+        if len(self._names(DONE_PREFIX)) >= self.shard_count:
+            return self._acquire(CLOSE_LOCK)
+        return False
+
+    # shared directory helpers
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _names(self, prefix):
+        return [name for name in os.listdir(self.directory) if name.startswith(prefix) and name.endswith('.json')]
+
+    def _write_json(self, name, data):
+        # write then rename, so that other shards never read a partial file
+        name = name if name.endswith('.json') else name + '.json'
+        tmp_path = self._path('.{}.{}.tmp'.format(name, self.shard_id))
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self._path(name))
+
+    def _read_json(self, name):
+        with open(self._path(name)) as f:
+            return json.load(f)
+
+    def _acquire(self, name):
+        try:
+            os.close(os.open(self._path(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            return False
+
+    def _wait(self, condition):
+        deadline = time.time() + self.timeout
+        while not condition():
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import json
+import os
+import threading
+
+FSYNC_ALWAYS = 'always'
+FSYNC_BATCH = 'batch'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER)
+
+
+def batch_digest(entries):
+    '''
+    :return: a digest identifying a batch of result entries.
+    '''
+    return hashlib.sha1(json.dumps(entries, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultSpool(object):
+    '''
+    Write-ahead log of the results of a session, in JSON lines.
+
+    Results are appended as they are recorded, before being published. Every batch accepted by TestRail is
+    acknowledged in the spool, with the range of spooled results it was built from, so that publishing the spool
+    again (e.g. with ``--tr-publish-spool``) only sends the batches not acknowledged yet.
+
+    Lines of the spool are one of:
+
+    - ``{"target": {...}}``: testrun or testplan fed, and the settings used to render the results
+    - ``{"result": [...]}``: a result, as given by `CaseResult.to_record`
+    - ``{"ack": testrun_id, "upload": [start, end], "digest": ...}``: a batch published to a testrun
+
+    The `fsync` policy tells when data is forced to disk: after every line (``always``), after every
+    acknowledgement and when the spool is closed (``batch``), or never (``never``, data is left to the OS).
+    '''
+
+    def __init__(self, path, fsync=FSYNC_BATCH, resume=False):
+        '''
+        :param path: Path of the spool file.
+        :type path: str
+        :param fsync: (optional) One of ``always``, ``batch`` or ``never``.
+        :type fsync: str
+        :param resume: (optional) Load the content of an existing spool and append to it, instead of starting a new
+            one.
+        :type resume: bool
+        '''
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync policy must be one of {}, not "{}"'.format(', '.join(FSYNC_POLICIES), fsync))
+        self.path = str(path)
+        self.fsync = fsync
+        self.target = None
+        self.results = []
+        self.acks = {}
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            # drop the line being written when the process was killed
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line.decode('utf-8'))
+            if 'result' in record:
+                self.results.append(record['result'])
+            elif 'ack' in record:
+                self.acks.setdefault((record['ack'], tuple(record['upload'])), set()).add(record['digest'])
+            elif 'target' in record:
+                self.target = record['target']
+
+    def _write(self, records, sync=False):
+        data = ''.join(json.dumps(record) + '\n' for record in records)
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync == FSYNC_ALWAYS or sync and self.fsync == FSYNC_BATCH:
+                os.fsync(self._file.fileno())
+
+    def write_target(self, **target):
+        ''' Record the testrun or testplan fed, and the settings used to render the results '''
+        self.target = target
+        self._write([{'target': target}], sync=True)
+
+    def write_results(self, results):
+        '''
+        :param list results: `CaseResult` objects to append to the spool.
+        '''
+        self._write([{'result': result.to_record()} for result in results])
+
+    def ack(self, testrun_id, upload, entries):
+        '''
+        Record a batch published to a testrun.
+
+        :param testrun_id: Id of the testrun fed
+        :param tuple upload: (start, end) range of the spooled results the batch was built from
+        :param list entries: result entries of the batch
+        '''
+        digest = batch_digest(entries)
+        self.acks.setdefault((testrun_id, tuple(upload)), set()).add(digest)
+        self._write([{'ack': testrun_id, 'upload': list(upload), 'digest': digest}], sync=True)
+
+    def is_acked(self, testrun_id, upload, entries):
+        ''' :return: True if the batch was already published to the testrun '''
+        digests = self.acks.get((testrun_id, tuple(upload)))
+        return bool(digests) and batch_digest(entries) in digests
+
+    def uploads(self, testrun_id, count=None):
+        '''
+        Ranges of spooled results to publish to a testrun: the ranges already (partly) published, in order to
+        complete them batch by batch, then the ranges never published.
+
+        :param testrun_id: Id of the testrun fed
+        :param int count: number of spooled results (defaults to the results loaded)
+        :return list: (start, end) tuples
+        '''
+        count = len(self.results) if count is None else count
+        ranges = sorted(upload for run_id, upload in self.acks if run_id == testrun_id)
+        uploads, position = [], 0
+        for start, end in ranges:
+            if start > position:
+                uploads.append((position, start))
+            uploads.append((start, end))
+            position = max(position, end)
+        if position < count:
+            uploads.append((position, count))
+        return uploads
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if self.fsync != FSYNC_NEVER:
+                    os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
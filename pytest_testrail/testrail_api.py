@@ -11,15 +11,237 @@
 # Copyright Gurock Software GmbH. See license.md for details.
 #
 
+import gzip
+import json
+import os
+import random
+import sqlite3
 import sys
 import requests
+import threading
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .serializers import EncodedData, SERIALIZER_NAMES, get_serializer, json_dumps  # noqa: F401
 
 if sys.version_info.major == 2:
     from urlparse import urljoin
 else:
     from urllib.parse import urljoin
 
+DEFAULT_POOL_SIZE = 10
+# Retries of a request answered with '429 Too Many Requests' before giving up
+DEFAULT_RATE_LIMIT_RETRIES = 5
+DEFAULT_RATE_LIMIT_BURST = 10
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Retries of a request failing with a transient error (connection error, timeout, 5xx response)
+DEFAULT_RETRIES = 3
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+RETRY_STATUSES = (500, 502, 503, 504)
+# POST methods which can be sent twice without side effect. Other POST methods (e.g. adding results) are only sent
+# again when the server surely didn't process them.
+IDEMPOTENT_POST_METHODS = ('close_run/', 'close_plan/', 'update_')
+UNPROCESSED_STATUSES = (503,)
+COMPRESS_LEVEL = 6
+# Responses of a server which doesn't accept compressed request bodies. TestRail answers 400 to invalid results
+# (e.g. a case which isn't in the testrun), which must not be sent twice.
+COMPRESSION_REJECTED_STATUSES = (415,)
+
+# GET methods whose responses can be cached (run/plan metadata)
+CACHEABLE_METHODS = ('get_run/', 'get_plan/', 'get_tests/')
+# POST method -> cached GET methods made stale by it, for the same id. Other POST methods clear the whole cache.
+CACHE_INVALIDATIONS = {
+    'add_results_for_cases/': ('get_run/', 'get_tests/'),
+    'add_results/': ('get_run/', 'get_tests/'),
+}
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    '''
+    Delay before retry number `attempt` (starting at 0): exponential backoff with jitter, so that clients throttled
+    at the same time don't all come back at the same time.
+    '''
+    delay = min(maximum, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def request_not_sent(exc):
+    '''
+    :return: True if the requests exception `exc` was raised before the request reached the server.
+    '''
+    return isinstance(exc, requests.exceptions.ConnectTimeout) or \
+        isinstance(getattr(exc.args[0] if exc.args else None, 'reason', None), NewConnectionError)
+
+
+class ThrottleStats(object):
+    '''
+    Time spent by an API client waiting for the rate limits of the TestRail server.
+    '''
+
+    __slots__ = ('throttled_time', 'throttled_requests', 'too_many_requests', 'gave_up')
+
+    def __init__(self):
+        self.throttled_time = 0.0  # seconds spent waiting before sending requests
+        self.throttled_requests = 0  # requests delayed by the limiter
+        self.too_many_requests = 0  # '429 Too Many Requests' responses received
+        self.gave_up = 0  # requests abandoned after too many '429' responses
+
+    def __repr__(self):
+        return '<ThrottleStats {}>'.format(', '.join('{}={!r}'.format(field, getattr(self, field))
+                                                     for field in self.__slots__))
+
+
+class RateLimiter(object):
+    '''
+    Token bucket shared by every thread and task sending requests through the same client.
+
+    Requests are spread to stay under `rate` requests per minute, with bursts of up to `burst` requests. Without
+    `rate`, requests are only held after the server asked to slow down (``429`` responses, exhausted
+    ``X-RateLimit-Remaining``). An ``X-RateLimit-Limit`` header lower than `rate` lowers it.
+    '''
+
+    def __init__(self, rate=None, burst=DEFAULT_RATE_LIMIT_BURST):
+        '''
+        :param rate: (optional) Maximum number of requests per minute.
+        :type rate: float
+        :param burst: (optional) Number of requests that can be sent at once after an idle period.
+        :type burst: int
+        '''
+        self.rate = float(rate) if rate else None
+        self.burst = max(int(burst or 1), 1)
+        self.stats = ThrottleStats()
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._paused_until = 0
+
+    def reserve(self):
+        '''
+        Take a token for a request about to be sent.
+
+        :return: number of seconds to wait before sending the request.
+        '''
+        with self._lock:
+            now = time.time()
+            delay = max(self._paused_until - now, 0)
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate / 60)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = max(delay, -self._tokens * 60 / self.rate)
+            if delay > 0:
+                self.stats.throttled_time += delay
+                self.stats.throttled_requests += 1
+            return delay
+
+    def acquire(self):
+        '''
+        Take a token, sleeping as long as needed.
+        '''
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        '''
+        Hold every request for `seconds`.
+        '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+    def update(self, headers):
+        '''
+        Adapt to the rate-limit headers of a response.
+        '''
+        limit, remaining, reset = (headers.get(name) for name in ('X-RateLimit-Limit', 'X-RateLimit-Remaining',
+                                                                  'X-RateLimit-Reset'))
+        try:
+            if limit is not None and (not self.rate or float(limit) < self.rate):
+                with self._lock:
+                    self.rate = float(limit)
+            if remaining is not None and int(remaining) <= 0 and reset is not None:
+                reset = float(reset)
+                # either a number of seconds or an epoch timestamp
+                self.pause(reset - time.time() if reset > 10 ** 9 else reset)
+        except ValueError:
+            pass
+
+    def too_many_requests(self, attempt, retry_after=None):
+        '''
+        Record a '429 Too Many Requests' response and hold every request for the delay asked by the server, or for
+        a jittered backoff delay if the server didn't tell.
+
+        :return: the pause in seconds.
+        '''
+        self.stats.too_many_requests += 1
+        try:
+            pause = float(retry_after)
+        except (TypeError, ValueError):
+            pause = backoff_delay(attempt)
+        self.pause(pause)
+        return pause
+
+
+class ResponseCache(object):
+    '''
+    Persistent cache of API GET responses, stored in a SQLite database shared by every process using the same path.
+
+    Entries are fresh for `ttl` seconds. Once stale, they are revalidated with ``If-None-Match`` when the server
+    provided an ``ETag``, and re-fetched otherwise.
+    '''
+
+    def __init__(self, path, ttl):
+        '''
+        :param path: Path of the SQLite database file.
+        :type path: str
+        :param ttl: Number of seconds a cached response is used without asking the server.
+        :type ttl: float
+        '''
+        self.path = path
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                         '(key TEXT PRIMARY KEY, body TEXT, etag TEXT, stored_at REAL)')
+
+    def get(self, key):
+        '''
+        :return: tuple (response, etag, fresh) or None if `key` is not cached.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT body, etag, stored_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        body, etag, stored_at = row
+        return json.loads(body), etag, time.time() - stored_at < self.ttl
+
+    def set(self, key, response, etag=None):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(response), etag, time.time()))
+
+    def touch(self, key):
+        ''' Mark a cached response as fresh again (after a successful revalidation) '''
+        with self._lock:
+            self._db.execute('UPDATE responses SET stored_at = ? WHERE key = ?', (time.time(), key))
+
+    def invalidate(self, key):
+        ''' Remove the response cached for `key`, and for the same method with extra parameters (`key&...`) '''
+        with self._lock:
+            self._db.execute('DELETE FROM responses WHERE key = ? OR substr(key, 1, ?) = ?',
+                             (key, len(key) + 1, key + '&'))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+
+    def close(self):
+        self._db.close()
+
 
 class APIClient:
     def __init__(self, base_url, user, password, **kwargs):
@@ -41,7 +263,37 @@ class APIClient:
         :param timeout: (optional) How many seconds to wait for the server to send data before giving up, as a float,
             or a :ref:`(connect timeout, read timeout) <timeouts>` tuple.
         :type timeout: float or tuple
+        :param pool_size: (optional) Maximum number of keep-alive connections kept open to the TestRail host.
+            Defaults to ``10``.
+        :type pool_size: int
+        :param cache_dir: (optional) Directory of the persistent cache of run/plan metadata. Caching is enabled only
+            when both `cache_dir` and `cache_ttl` are set.
+        :type cache_dir: str
+        :param cache_ttl: (optional) Number of seconds cached run/plan metadata is used without asking the server.
+        :type cache_ttl: float
+        :param rate_limit: (optional) Maximum number of requests per minute sent to the server.
+        :type rate_limit: float
+        :param rate_limit_retries: (optional) Number of times a request answered with '429 Too Many Requests' is
+            sent again before giving up. Defaults to ``5``.
+        :type rate_limit_retries: int
+        :param rate_limiter: (optional) Rate limiter shared with other clients, takes precedence over `rate_limit`.
+        :type rate_limiter: RateLimiter
+        :param retries: (optional) Number of times a request failing with a connection error, a timeout or a 5xx
+            response is sent again. Requests which are not idempotent are only sent again when they surely didn't
+            reach the server. Defaults to ``3``.
+        :type retries: int
+        :param retry_backoff: (optional) Delay in seconds before the first retry, doubled for each following retry.
+            Defaults to ``1``.
+        :type retry_backoff: float
+        :param compress_threshold: (optional) Size in bytes from which POST bodies are sent gzip-compressed. If the
+            server rejects a compressed body with 415, it is sent again uncompressed, and compression is disabled when
+            that succeeds. Defaults to ``None`` (no compression).
+        :type compress_threshold: int
+        :param serializer: (optional) JSON serializer of POST bodies: ``orjson``, ``ujson`` or ``json``. Defaults to
+            the fastest one installed.
+        :type serializer: str
         '''
+        self.base_url = base_url
         self.user = user
         self.password = password
         self._url = urljoin(base_url, 'index.php?/api/v2/')
@@ -50,6 +302,173 @@ class APIClient:
         self.timeout = kwargs.get('timeout', 10.0)
         if self.timeout is not None:
             self.timeout = isinstance(self.timeout, float) if False else float(self.timeout)
+        self.pool_size = int(kwargs.get('pool_size') or DEFAULT_POOL_SIZE)
+        self._session = None
+        self.cache = None
+        cache_dir, cache_ttl = kwargs.get('cache_dir'), float(kwargs.get('cache_ttl') or 0)
+        if cache_dir and cache_ttl > 0:
+            os.makedirs(cache_dir, exist_ok=True)  # shared by concurrent sessions, which may create it meanwhile
+            self.cache = ResponseCache(os.path.join(str(cache_dir), 'responses.sqlite3'), cache_ttl)
+        self.rate_limiter = kwargs.get('rate_limiter') or RateLimiter(kwargs.get('rate_limit'))
+        rate_limit_retries = kwargs.get('rate_limit_retries')
+        self.rate_limit_retries = int(DEFAULT_RATE_LIMIT_RETRIES if rate_limit_retries is None else rate_limit_retries)
+        retries = kwargs.get('retries')
+        self.retries = int(DEFAULT_RETRIES if retries is None else retries)
+        self.retry_backoff = float(kwargs.get('retry_backoff') or BACKOFF_BASE)
+        self.compress_threshold = int(kwargs.get('compress_threshold') or 0)
+        self.serializer, self._dumps = get_serializer(kwargs.get('serializer'))
+
+    @property
+    def session(self):
+        '''
+        Pooled HTTP session shared by every request sent through this client.
+
+        Connections are kept alive and reused between calls, so only the first request to the TestRail host
+        pays for the TCP/TLS handshake. The session is created lazily and re-created after :meth:`close`.
+        '''
+        if self._session is None:
+            session = requests.Session()
+            session.auth = (self.user, self.password)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def encode(self, data):
+        '''
+        :return bytes: the JSON document of `data`, as sent in a POST body.
+        '''
+        if isinstance(data, bytes):
+            return data
+        if isinstance(data, EncodedData):
+            return data.body
+        try:
+            return self._dumps(data)
+        except (TypeError, ValueError, OverflowError):
+            # values the fast serializers don't handle (e.g. integers over 64 bits, lone surrogates)
+            return json_dumps(data)
+
+    def close(self):
+        '''
+        Close the pooled HTTP session and release its connections.
+        '''
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def _cache_key(self, uri):
+        return '{}@{}'.format(self.user, self._url + uri)
+
+    def _invalidate_cache(self, uri):
+        for method, stale_methods in CACHE_INVALIDATIONS.items():
+            if uri.startswith(method):
+                object_id = uri[len(method):]
+                for stale_method in stale_methods:
+                    self.cache.invalidate(self._cache_key(stale_method + object_id))
+                return
+        self.cache.clear()
+
+    def throttle(self, pause):
+        '''
+        Hold every request sent through this client, from any thread, for `pause` seconds.
+
+        :param pause: number of seconds to wait before sending the next request.
+        :type pause: float
+        '''
+        self.rate_limiter.pause(pause)
+
+    @property
+    def throttle_stats(self):
+        '''
+        :return ThrottleStats: time spent waiting for the rate limits of the server.
+        '''
+        return self.rate_limiter.stats
+
+    def _too_many_requests(self, headers, attempt):
+        '''
+        Handle a '429 Too Many Requests' response.
+
+        :return: True if the request should be sent again.
+        '''
+        if attempt >= self.rate_limit_retries:
+            self.rate_limiter.stats.gave_up += 1
+            return False
+        pause = self.rate_limiter.too_many_requests(attempt, headers.get('Retry-After'))
+        print("Too many requests: pause for {:.0f}s".format(pause))
+        return True
+
+    @staticmethod
+    def _parse_body(body, status_code):
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError:
+            return {'error': 'HTTP {}: the response is not valid JSON'.format(status_code)}
+
+    def _retry_delay(self, retry, idempotent, status=None, exc=None, not_sent=False):
+        '''
+        Retry policy of a request which failed with the transient transport error `exc` (connection error, timeout),
+        or was answered with `status`, shared by the synchronous and asynchronous clients.
+
+        Requests are sent again after a 5xx response or a transient error, up to `retries` times, with an exponential
+        backoff. Requests which are not idempotent are only sent again when the server surely didn't process them:
+        not sent at all (`not_sent`), or answered with '503 Service Unavailable'.
+
+        :param int retry: number of times the request was already sent again
+        :param idempotent: whether the request can be sent again when it may have been processed by the server.
+        :return: delay in seconds before sending the request again, or None if it must not be sent again.
+        '''
+        if exc is None:
+            if status not in RETRY_STATUSES:
+                return None
+            error = 'HTTP {}'.format(status)
+            not_sent = status in UNPROCESSED_STATUSES
+        else:
+            error = '{}: {}'.format(type(exc).__name__, exc)
+        if retry >= self.retries or not (idempotent or not_sent):
+            return None
+        delay = backoff_delay(retry, self.retry_backoff)
+        print("Request failed ({}): retry {}/{} in {:.1f}s".format(error, retry + 1, self.retries, delay))
+        return delay
+
+    def _request(self, method, url, idempotent, **kwargs):
+        '''
+        Send a request, sending it again after '429 Too Many Requests' responses and transient errors.
+
+        :param idempotent: whether the request can be sent again when it may have been processed by the server.
+        :raise requests.RequestException: if the request still fails after the retries.
+        :return requests.Response:
+        '''
+        too_many_requests = retry = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except RETRY_EXCEPTIONS as exc:
+                delay = self._retry_delay(retry, idempotent, exc=exc, not_sent=request_not_sent(exc))
+                if delay is None:
+                    raise
+            else:
+                self.rate_limiter.update(r.headers)
+                if r.status_code == 429:  # Too many requests
+                    if not self._too_many_requests(r.headers, too_many_requests):
+                        return r
+                    too_many_requests += 1
+                    continue
+                delay = self._retry_delay(retry, idempotent, status=r.status_code)
+                if delay is None:
+                    return r
+            retry += 1
+            time.sleep(delay)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def send_get(self, uri, **kwargs):
         '''
@@ -71,21 +490,25 @@ class APIClient:
         cert_check = kwargs.get('cert_check', self.cert_check)
         headers = kwargs.get('headers', self.headers)
         url = self._url + uri
-        r = requests.get(
-            url,
-            auth=(self.user, self.password),
-            headers=headers,
-            verify=cert_check,
-            timeout=self.timeout
-        )
-
-        if r.status_code == 429:  # Too many requests
-            pause = int(r.headers.get('Retry-After', 60))
-            print("Too many requests: pause for {}s".format(pause))
-            time.sleep(pause)
-            return self.send_get(uri, **kwargs)
-        else:
-            return r.json()
+        cached = None
+        if self.cache is not None and uri.startswith(CACHEABLE_METHODS):
+            cached = self.cache.get(self._cache_key(uri))
+            if cached and cached[2]:
+                return cached[0]
+            if cached and cached[1]:
+                headers = dict(headers, **{'If-None-Match': cached[1]})
+        try:
+            r = self._request('GET', url, True, headers=headers, verify=cert_check)
+        except requests.RequestException as exc:
+            return {'error': '{}: {}'.format(type(exc).__name__, exc)}
+
+        if r.status_code == 304 and cached:  # Not modified
+            self.cache.touch(self._cache_key(uri))
+            return cached[0]
+        response = self._parse_body(r.content, r.status_code)
+        if self.cache is not None and uri.startswith(CACHEABLE_METHODS) and r.status_code == 200:
+            self.cache.set(self._cache_key(uri), response, r.headers.get('ETag'))
+        return response
 
     def send_post(self, uri, data, **kwargs):
         '''
@@ -95,8 +518,9 @@ class APIClient:
 
         :param uri: The API method to call including parameters (e.g. get_case/1)
         :type uri: str
-        :param data: The data to submit as part of the request (strings must be UTF-8 encoded).
-        :type data: dict
+        :param data: The data to submit as part of the request (strings must be UTF-8 encoded), or its JSON document
+            already encoded, as bytes or `EncodedData`.
+        :type data: dict or bytes
         :param headers: (optional) Dictionary of HTTP Headers to send with the request.
         :type headers: dict
         :param cert_check: (optional) Either a boolean, in which case it controls whether we verify the server's TLS
@@ -109,22 +533,27 @@ class APIClient:
         cert_check = kwargs.get('cert_check', self.cert_check)
         headers = kwargs.get('headers', self.headers)
         url = self._url + uri
-        r = requests.post(
-            url,
-            auth=(self.user, self.password),
-            headers=headers,
-            json=data,
-            verify=cert_check,
-            timeout=self.timeout
-        )
-
-        if r.status_code == 429:  # Too many requests
-            pause = int(r.headers.get('Retry-After', 60))
-            print("Too many requests: pause for {}s".format(pause))
-            time.sleep(pause)
-            return self.send_post(uri, data, **kwargs)
-        else:
-            return r.json()
+        idempotent = uri.startswith(IDEMPOTENT_POST_METHODS)
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+        try:
+            body = self.encode(data)
+            if self.compress_threshold and len(body) >= self.compress_threshold:
+                r = self._request('POST', url, idempotent, verify=cert_check, data=gzip.compress(body, COMPRESS_LEVEL),
+                                  headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+                if r.status_code in COMPRESSION_REJECTED_STATUSES:
+                    rejected = r.status_code
+                    r = self._request('POST', url, idempotent, headers=headers, data=body, verify=cert_check)
+                    if r.status_code != rejected:
+                        print("Compressed request rejected (HTTP {}): compression disabled".format(rejected))
+                        self.compress_threshold = 0
+            else:
+                r = self._request('POST', url, idempotent, headers=headers, data=body, verify=cert_check)
+        except requests.RequestException as exc:
+            return {'error': '{}: {}'.format(type(exc).__name__, exc)}
+
+        if self.cache is not None and r.status_code != 429:
+            self._invalidate_cache(uri)
+        return self._parse_body(r.content, r.status_code)
 
     @staticmethod
     def get_error(json_response):
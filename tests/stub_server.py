@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+"""
+Minimal in-process TestRail API server used by the tests and the benchmarks.
+
+It answers the handful of API v2 endpoints the plugin relies on, keeps every request it received, and can inject
+latency and canned faults (e.g. ``429`` or ``502`` responses, dropped connections, slow responses) in front of the
+regular routes.
+"""
+import gzip
+import hashlib
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+API_PREFIX = '/index.php?/api/v2/'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubRequest(object):
+    """ A request received by the stub server """
+
+    def __init__(self, method, uri, headers, body, raw_size=None):
+        self.method = method
+        self.uri = uri
+        self.headers = headers
+        self.body = body
+        self.raw_size = len(body) if raw_size is None else raw_size  # size of the body on the wire
+
+    @property
+    def endpoint(self):
+        return self.uri.split('/', 1)[0]
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8')) if self.body else None
+
+
+class StubTestRailServer(object):
+    """
+    Local TestRail stub.
+
+    :param latency: seconds to wait before answering each request.
+    :param connect_latency: seconds to wait once per new TCP connection (simulates TCP/TLS handshake cost).
+    :param etags: send an ``ETag`` with GET responses, and answer ``304`` to matching ``If-None-Match`` requests.
+    :param accept_gzip: decompress gzip-encoded request bodies; answer ``415`` to them otherwise.
+    :param bandwidth: bytes per second received, to simulate a slow link (request bodies only).
+    :param throttle: answer ``429`` to every `throttle`-th request, with a ``Retry-After`` of `retry_after` seconds.
+    """
+
+    def __init__(self, latency=0.0, connect_latency=0.0, etags=False, accept_gzip=True, bandwidth=None,
+                 throttle=None, retry_after=0):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.etags = etags
+        self.accept_gzip = accept_gzip
+        self.bandwidth = bandwidth
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.requests = []
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.faults = []
+        self.runs = {}
+        self.plan = {'id': 1, 'is_completed': False, 'entries': []}
+        self.tests = []
+        self.page_size = None
+        self.routes = {
+            'add_run': self._add_run,
+            'get_run': self._get_run,
+            'get_plan': self._get_plan,
+            'get_tests': self._get_tests,
+            'add_results_for_cases': self._add_results_for_cases,
+            'close_run': self._close,
+            'close_plan': self._close,
+        }
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    # lifecycle
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # fault injection
+
+    def inject(self, status, body=None, headers=None, times=1, delay=0):
+        """
+        Answer the next `times` requests with `status` instead of the regular route, after `delay` seconds.
+
+        With `status` None, the connection is closed without any response. With `status` 0, the request is answered
+        by the regular route after `delay` seconds.
+        """
+        for _ in range(times):
+            self.faults.append((status, body if body is not None else {'error': 'injected'}, headers or {}, delay))
+
+    # routing
+
+    @property
+    def bytes_received(self):
+        return sum(request.raw_size for request in self.requests)
+
+    def dispatch(self, request):
+        fault = None
+        with self._lock:
+            self.requests.append(request)
+            if self.faults:
+                fault = self.faults.pop(0)
+            elif self.throttle and len(self.requests) % self.throttle == 0:
+                fault = (429, {'error': 'API Rate Limit Exceeded'}, {'Retry-After': str(self.retry_after)}, 0)
+        if request.headers.get('Content-Encoding') == 'gzip' and not self.accept_gzip:
+            return 415, {'error': 'Unsupported Media Type'}, {}
+        if fault is not None:
+            status, body, headers, delay = fault
+            if delay:
+                time.sleep(delay)
+            if status != 0:
+                return status, body, headers
+        route = self.routes.get(request.endpoint)
+        if route is None:
+            return 404, {'error': 'Unknown method'}, {}
+        response = route(request)
+        return response if isinstance(response, tuple) else (200, response, {})
+
+    def _add_run(self, request):
+        run = dict(request.json() or {}, id=next(self._ids), is_completed=False)
+        self.runs[run['id']] = run
+        return run
+
+    def _get_run(self, request):
+        run_id = int(request.uri.split('/')[1])
+        return self.runs.get(run_id, {'id': run_id, 'is_completed': False})
+
+    def _get_plan(self, request):
+        return self.plan
+
+    def _get_tests(self, request):
+        if not self.page_size:
+            return self.tests
+        run_id = request.uri.split('/')[1].split('&')[0]
+        params = dict(param.split('=', 1) for param in request.uri.split('&')[1:])
+        offset = int(params.get('offset', 0))
+        page = self.tests[offset:offset + self.page_size]
+        next_offset = offset + self.page_size
+        next_link = None
+        if next_offset < len(self.tests):
+            next_link = '/api/v2/get_tests/{}&limit={}&offset={}'.format(run_id, self.page_size, next_offset)
+        return {'offset': offset, 'limit': self.page_size, 'size': len(page),
+                '_links': {'next': next_link, 'prev': None}, 'tests': page}
+
+    def _add_results_for_cases(self, request):
+        return (request.json() or {}).get('results', [])
+
+    def _close(self, request):
+        return {}
+
+
+def _make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with stub._lock:
+                stub.connections += 1
+            if stub.connect_latency:
+                time.sleep(stub.connect_latency)
+
+        def log_message(self, *args):
+            pass
+
+        def _handle(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            raw_size = len(body)
+            if stub.bandwidth:
+                time.sleep(raw_size / float(stub.bandwidth))
+            if body and self.headers.get('Content-Encoding') == 'gzip' and stub.accept_gzip:
+                body = gzip.decompress(body)
+            uri = self.path[len(API_PREFIX):] if self.path.startswith(API_PREFIX) else self.path.lstrip('/')
+            with stub._lock:
+                stub.in_flight += 1
+                stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+            try:
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, payload, headers = stub.dispatch(StubRequest(self.command, uri, dict(self.headers), body,
+                                                                     raw_size))
+            finally:
+                with stub._lock:
+                    stub.in_flight -= 1
+            if status is None:  # dropped connection
+                self.close_connection = True
+                return
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+            if stub.etags and self.command == 'GET' and status == 200:
+                etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+                headers = dict(headers, ETag=etag)
+                if self.headers.get('If-None-Match') == etag:
+                    status, data = 304, b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+
+import pytest
+
+from pytest_testrail import async_api
+from pytest_testrail.async_api import AsyncAPIClient
+from pytest_testrail.plugin import PyTestRailPlugin, CaseResult, TESTRAIL_TEST_STATUS
+from tests.stub_server import StubTestRailServer
+
+TRANSPORTS = [
+    pytest.param(True, id='aiohttp',
+                 marks=pytest.mark.skipif(async_api.aiohttp is None, reason='aiohttp is not installed')),
+    pytest.param(False, id='threads'),
+]
+
+
+@pytest.fixture
+def stub():
+    with StubTestRailServer() as server:
+        yield server
+
+
+@pytest.fixture(params=TRANSPORTS)
+def async_client(request, stub):
+    return AsyncAPIClient(stub.url, 'user@email.com', 'api_key', concurrency=3, use_aiohttp=request.param)
+
+
+def test_send_get_and_post(async_client, stub):
+    async def scenario():
+        run = await async_client.send_get('get_run/1')
+        results = await async_client.send_post('add_results_for_cases/1', {'results': [{'case_id': 1}]})
+        return run, results
+
+    assert async_client.run(scenario()) == ({'id': 1, 'is_completed': False}, [{'case_id': 1}])
+    assert [request.method for request in stub.requests] == ['GET', 'POST']
+    assert stub.requests[1].json() == {'results': [{'case_id': 1}]}
+    assert stub.requests[0].headers['Authorization'].startswith('Basic ')
+
+
+def test_concurrency_is_bounded(async_client, stub):
+    stub.latency = 0.05
+
+    async def scenario():
+        return await asyncio.gather(*[async_client.send_get('get_run/{}'.format(run_id)) for run_id in range(12)])
+
+    runs = async_client.run(scenario())
+
+    assert [run['id'] for run in runs] == list(range(12))
+    assert 1 < stub.max_in_flight <= 3
+
+
+def test_too_many_requests_holds_every_request(async_client, stub, monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(async_api.asyncio, 'sleep', fake_sleep)
+    stub.inject(429, headers={'Retry-After': '30'})
+
+    async def scenario():
+        return await async_client.send_post('add_results_for_cases/1', {'results': []})
+
+    assert async_client.run(scenario()) == []
+    assert len(sleeps) == 1 and 29 < sleeps[0] <= 30
+    assert len(stub.requests) == 2
+
+
+def test_get_error(async_client):
+    assert async_client.get_error({'error': 'Field :case_id is not a valid test case.'}) is not None
+    assert async_client.get_error([]) is None
+
+
+def test_plugin_publishes_testplan_asynchronously(async_client, stub):
+    stub.latency = 0.05
+    stub.page_size = 2
+    stub.tests = [{'case_id': 1, 'status_id': TESTRAIL_TEST_STATUS['blocked']},
+                  {'case_id': 2, 'status_id': TESTRAIL_TEST_STATUS['untested']},
+                  {'case_id': 3, 'status_id': TESTRAIL_TEST_STATUS['untested']}]
+    client = async_client._sync_client
+    tr_plugin = PyTestRailPlugin(client, 1, 1, 1, False, True, None, publish_blocked=False, batch_size=1,
+                                 async_client=async_client)
+    tr_plugin.results = [CaseResult(case_id, TESTRAIL_TEST_STATUS['passed']) for case_id in (1, 2, 3)]
+
+    tr_plugin.publish_to_testruns([10, 11, 12])
+
+    uploads = [request for request in stub.requests if request.endpoint == 'add_results_for_cases']
+    for run_id in (10, 11, 12):
+        case_ids = [request.json()['results'][0]['case_id'] for request in uploads
+                    if request.uri == 'add_results_for_cases/{}'.format(run_id)]
+        assert case_ids == [2, 3]
+        assert tr_plugin._run_memberships[run_id].case_ids == frozenset([1, 2, 3])
+        assert run_id in tr_plugin.publish_timings
+    assert len([request for request in stub.requests if request.endpoint == 'get_tests']) == 6
+    assert stub.max_in_flight > 1
+    assert tr_plugin.failed_batches == []
+
+
+def test_plugin_records_failed_batches(async_client, stub):
+    stub.inject(400, body={'error': 'Field :results cannot be empty'})
+    tr_plugin = PyTestRailPlugin(async_client._sync_client, 1, 1, 1, False, True, None, async_client=async_client)
+    tr_plugin.results = [CaseResult(1, TESTRAIL_TEST_STATUS['passed'])]
+
+    tr_plugin.publish_to_testruns([10, 11])
+
+    assert len(tr_plugin.failed_batches) == 1
+    assert tr_plugin.failed_batches[0]['error'] == 'Field :results cannot be empty'
+    assert tr_plugin.failed_batches[0]['testrun_id'] in (10, 11)
+
+
+@pytest.mark.parametrize('fault', [
+    {'status': 502, 'body': b'<html>Bad Gateway</html>'},
+    {'status': None},  # connection reset
+])
+def test_errors_returned_as_responses(async_client, stub, fault):
+    async_client._sync_client.retries = 0
+    stub.inject(**fault)
+
+    response = async_client.run(async_client.send_post('add_results_for_cases/1', {'results': []}))
+
+    error = async_client.get_error(response)
+    assert error == 'HTTP 502: the response is not valid JSON' if fault['status'] else error
+
+
+def test_validation_errors_not_sent_again_uncompressed(async_client, stub):
+    async_client._sync_client.compress_threshold = 1
+    stub.inject(400, body={'error': 'Field :results.case_id is not a valid test case.'})
+
+    response = async_client.run(async_client.send_post('add_results_for_cases/1', {'results': [{'case_id': 1}]}))
+
+    assert async_client.get_error(response) == 'Field :results.case_id is not a valid test case.'
+    assert [request.headers.get('Content-Encoding') for request in stub.requests] == ['gzip']
+    assert async_client._sync_client.compress_threshold == 1
+
+
+def test_plugin_publishes_when_tests_listing_fails(async_client, stub):
+    async_client._sync_client.retries = 0
+    stub.inject(502, body=b'<html>Bad Gateway</html>')
+    tr_plugin = PyTestRailPlugin(async_client._sync_client, 1, 1, 1, False, True, None, publish_blocked=False,
+                                 async_client=async_client)
+    tr_plugin.results = [CaseResult(1, TESTRAIL_TEST_STATUS['passed'])]
+
+    tr_plugin.publish_to_testruns([10])
+
+    assert tr_plugin._run_memberships[10] is None
+    assert [request.uri for request in stub.requests] == ['get_tests/10', 'add_results_for_cases/10']
+    assert tr_plugin.failed_batches == []
+
+
+def test_get_retried_on_transient_errors(async_client, stub):
+    async_client._sync_client.retry_backoff = 0.01
+    async_client._sync_client.timeout = 0.2
+    stub.inject(502, body=b'<html>Bad Gateway</html>')
+    stub.inject(None)  # connection reset
+    stub.inject(0, delay=0.5)  # read timeout
+
+    assert async_client.run(async_client.send_get('get_run/1')) == {'id': 1, 'is_completed': False}
+    assert len(stub.requests) == 4
+
+
+def test_results_retried_only_when_not_processed(async_client, stub):
+    async_client._sync_client.retry_backoff = 0.01
+    stub.inject(502)
+    stub.inject(503)
+
+    async def scenario():
+        first = await async_client.send_post('add_results_for_cases/1', {'results': [{'case_id': 1}]})
+        second = await async_client.send_post('add_results_for_cases/1', {'results': [{'case_id': 2}]})
+        return first, second
+
+    first, second = async_client.run(scenario())
+
+    assert async_client.get_error(first) == 'injected'
+    assert second == [{'case_id': 2}]
+    assert [request.json()['results'][0]['case_id'] for request in stub.requests] == [1, 2, 2]
+
+
+def test_plugin_retries_tests_listing(async_client, stub):
+    async_client._sync_client.retry_backoff = 0.01
+    stub.tests = [{'case_id': 1, 'status_id': TESTRAIL_TEST_STATUS['blocked']}]
+    stub.inject(502, body=b'<html>Bad Gateway</html>')
+    tr_plugin = PyTestRailPlugin(async_client._sync_client, 1, 1, 1, False, True, None, publish_blocked=False,
+                                 async_client=async_client)
+    tr_plugin.results = [CaseResult(case_id, TESTRAIL_TEST_STATUS['passed']) for case_id in (1, 2)]
+
+    tr_plugin.publish_to_testruns([10, 11])
+
+    # either testrun may get the '502' response
+    assert [tr_plugin._run_memberships[run_id].case_ids for run_id in (10, 11)] == [frozenset([1])] * 2
+    assert len([request for request in stub.requests if request.endpoint == 'get_tests']) == 3
+    assert sorted(request.uri for request in stub.requests if request.endpoint == 'add_results_for_cases') == [
+        'add_results_for_cases/10', 'add_results_for_cases/11']
+    assert tr_plugin.failed_batches == []
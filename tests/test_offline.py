@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+import pytest
+
+from pytest_testrail.offline import OfflineAPIClient, read_request_log, replay_request_log
+from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
+
+pytest_plugins = "pytester"
+
+TEST_FILE = """
+from pytest_testrail.plugin import pytestrail
+
+@pytestrail.case('C1')
+def test_one():
+    pass
+
+@pytestrail.case('C2', 'C3')
+def test_two():
+    assert False
+"""
+
+
+@pytest.fixture
+def stub():
+    with StubTestRailServer() as server:
+        yield server
+
+
+def test_offline_session_then_replay(testdir, stub):
+    testdir.makepyfile(TEST_FILE)
+    log = str(testdir.tmpdir.join('requests.log'))
+    options = ['-p', 'pytest_testrail.conftest', '--tr-email', 'user', '--tr-password', 'key',
+               '--tr-testrun-project-id', '3', '--tr-testrun-suite-id', '4', '--tr-close-on-complete']
+
+    result = testdir.runpytest('--testrail', '--tr-offline', log, '--tr-url', 'http://unreachable.invalid/',
+                               *options)
+    result.assert_outcomes(passed=1, failed=1)
+    assert [(record['method'], record['uri']) for record in read_request_log(log)] == [
+        ('POST', 'add_run/3'), ('POST', 'add_results_for_cases/-1'), ('POST', 'close_run/-1')]
+
+    result = testdir.runpytest('--tr-replay', log, '--tr-url', stub.url, '--tr-batch-size', '2', *options)
+
+    assert result.ret == 0
+    assert [request.uri for request in stub.requests] == [
+        'add_run/3', 'add_results_for_cases/1', 'add_results_for_cases/1', 'close_run/1']
+    assert sorted(stub.requests[0].json()['case_ids']) == [1, 2, 3]
+    assert [len(request.json()['results']) for request in stub.requests[1:3]] == [2, 1]
+
+
+def test_offline_testplan_replayed_to_open_testruns(stub, tmpdir):
+    log = str(tmpdir.join('requests.log'))
+    offline_client = OfflineAPIClient(log)
+    tr_plugin = PyTestRailPlugin(offline_client, 1, 1, 1, False, True, None, plan_id=7, stream=True)
+    tr_plugin.prepare_testrun([1, 2])
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS['passed'])
+    tr_plugin.flush_results()
+    tr_plugin.add_result([2], TESTRAIL_TEST_STATUS['failed'])
+    tr_plugin.stop_streaming()
+    offline_client.close()
+
+    # results streamed by chunks are sent at once
+    records = read_request_log(log)
+    assert [record['uri'] for record in records] == ['get_plan/7', 'add_results_for_cases/-1']
+    assert [entry['case_id'] for entry in records[1]['data']['results']] == [1, 2]
+
+    stub.plan = {'id': 7, 'is_completed': False,
+                 'entries': [{'runs': [{'id': 11, 'is_completed': False}, {'id': 12, 'is_completed': True}]},
+                             {'runs': [{'id': 13, 'is_completed': False}]}]}
+    with APIClient(stub.url, 'user@email.com', 'api_key') as client:
+        assert replay_request_log(client, log) == 0
+
+    assert [request.uri for request in stub.requests] == [
+        'get_plan/7', 'add_results_for_cases/11', 'add_results_for_cases/13']
+
+
+def test_replay_skips_requests_of_testruns_not_created(stub, tmpdir):
+    log = str(tmpdir.join('requests.log'))
+    offline_client = OfflineAPIClient(log)
+    run = offline_client.send_post('add_run/1', {'case_ids': [1]})
+    offline_client.send_post('add_results_for_cases/{}'.format(run['id']), {'results': [{'case_id': 1}]})
+    offline_client.close()
+    stub.inject(400, body={'error': 'Field :project_id is not a valid or accessible project.'})
+
+    with APIClient(stub.url, 'user@email.com', 'api_key') as client:
+        assert replay_request_log(client, log) == 2
+
+    assert [request.uri for request in stub.requests] == ['add_run/1']
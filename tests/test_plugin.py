@@ -2,10 +2,17 @@
 from datetime import datetime
 from freezegun import freeze_time
 from mock import call, create_autospec
+import os
 import pytest
+import subprocess
+import sys
+import threading
+import time
+import weakref
 from pytest_testrail import plugin
 from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
 from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
 
 pytest_plugins = "pytester"
 
@@ -173,6 +180,46 @@ def test_pytest_runtest_makereport(pytest_test_items, tr_plugin, testdir):
     assert tr_plugin.results == expected_results
 
 
+def test_setup_and_teardown_errors_recorded(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_testrail.plugin import pytestrail
+
+        @pytest.fixture
+        def broken_setup():
+            raise RuntimeError('setup failed')
+
+        @pytest.fixture
+        def broken_teardown():
+            yield
+            raise RuntimeError('teardown failed')
+
+        @pytestrail.case('C1')
+        def test_setup_error(broken_setup):
+            pass
+
+        @pytestrail.case('C2')
+        def test_teardown_error(broken_teardown):
+            pass
+
+        @pytestrail.case('C3')
+        @pytest.mark.skip
+        def test_skipped():
+            pass
+    """)
+    with StubTestRailServer() as stub:
+        result = testdir.runpytest('-p', 'pytest_testrail.conftest', '--testrail', '--tr-url', stub.url,
+                                   '--tr-email', 'user', '--tr-password', 'key', '--tr-testrun-project-id', '1',
+                                   '--tr-testrun-suite-id', '1')
+        result.assert_outcomes(passed=1, errors=2, skipped=1)
+        results = stub.requests[-1].json()['results']
+
+    assert [(entry['case_id'], entry['status_id']) for entry in results] == [
+        (1, TESTRAIL_TEST_STATUS["failed"]), (2, TESTRAIL_TEST_STATUS["passed"]), (2, TESTRAIL_TEST_STATUS["failed"])]
+    assert 'setup failed' in results[0]['comment']
+    assert 'teardown failed' in results[2]['comment']
+
+
 def test_pytest_sessionfinish(api_client, tr_plugin):
     tr_plugin.results = [
         {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'duration': 2.6, 'defects':'PF-516'},
@@ -301,6 +348,48 @@ def test_is_testrun_available(api_client, tr_plugin):
     assert tr_plugin.is_testrun_available() is False
 
 
+def test_testrun_created_in_background(api_client, capsys):
+    tr_plugin = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID, SUITE_ID, False, True, 'name',
+                                 background_setup=True)
+    created = threading.Event()
+
+    def add_run(uri, data, **kwargs):
+        created.wait(5)
+        return {'id': 42}
+    api_client.send_post.side_effect = add_run
+
+    tr_plugin.pytest_configure(None)
+    tr_plugin.prepare_testrun([1, 2])
+    # tests run meanwhile
+    assert tr_plugin.testrun_id == 0
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS["passed"])
+    created.set()
+    tr_plugin._testrun_setup.exception(5)
+    # printed by the main thread, not in the middle of the progress line
+    assert 'New testrun created' not in capsys.readouterr().out
+
+    api_client.send_post.side_effect = None
+    tr_plugin.pytest_sessionfinish(None, 0)
+    assert tr_plugin.testrun_id == 42
+    assert 'New testrun created with name "name" and ID=42' in capsys.readouterr().out
+    assert api_client.send_post.call_args_list[1][0][0] == plugin.ADD_RESULTS_URL.format(42)
+    api_client.send_get.assert_not_called()
+
+
+def test_testrun_looked_up_at_configure(api_client):
+    tr_plugin = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID, SUITE_ID, False, True, 'name', run_id=10,
+                                 background_setup=True)
+    api_client.send_get.return_value = {'is_completed': False}
+
+    tr_plugin.pytest_configure(None)
+    assert tr_plugin._testrun_lookup is not None
+    tr_plugin.prepare_testrun([1, 2])
+
+    assert tr_plugin.testrun_id == 10
+    api_client.send_get.assert_called_once_with(plugin.GET_TESTRUN_URL.format(10), cert_check=True)
+    api_client.send_post.assert_not_called()
+
+
 def test_is_testplan_available(api_client, tr_plugin):
     """ Test of method `is_testplan_available` """
     tr_plugin.testplan_id = 100
@@ -457,3 +546,468 @@ def test_api_client_timeout(api_client):
 
     api_client.send_post('/timeout', data={"body": "body"}, timeout=None)
     api_client.send_post.assert_called_with('/timeout', data={"body": "body"}, timeout=None)
+
+
+def test_pytest_sessionfinish_closes_client(api_client, tr_plugin):
+    tr_plugin.pytest_sessionfinish(None, 0)
+    api_client.close.assert_called_once_with()
+
+
+def test_batch_results():
+    entries = [{'case_id': case_id, 'status_id': 1, 'comment': 'x' * 100} for case_id in range(10)]
+
+    assert [len(batch) for batch in plugin.batch_results(entries, max_entries=4, max_bytes=0)] == [4, 4, 2]
+    batches = list(plugin.batch_results(entries, max_entries=0, max_bytes=320))
+    assert [len(batch) for batch in batches] == [2] * 5
+    assert [entry for batch in batches for entry in batch] == entries
+    assert all(len(plugin.json.dumps({'results': batch})) <= 320 for batch in batches)
+    # an oversized entry is sent alone
+    assert [len(batch) for batch in plugin.batch_results(entries[:3], max_entries=0, max_bytes=10)] == [1, 1, 1]
+
+
+def test_add_results_in_batches(api_client, tr_plugin):
+    tr_plugin.batch_size = 2
+    tr_plugin.results = [
+        {'case_id': case_id, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'duration': 1, 'defects': None}
+        for case_id in (1, 2, 3, 4, 5)
+    ]
+    api_client.send_post.side_effect = [[], {'error': 'Request too large'}, []]
+
+    tr_plugin.add_results(10)
+
+    sent = [c[0][1]['results'] for c in api_client.send_post.call_args_list]
+    assert [[entry['case_id'] for entry in batch] for batch in sent] == [[1, 2], [3, 4], [5]]
+    assert len(tr_plugin.failed_batches) == 1
+    failed = tr_plugin.failed_batches[0]
+    assert (failed['testrun_id'], failed['index'], failed['count']) == (10, 1, 3)
+    assert failed['error'] == 'Request too large'
+
+    api_client.send_post.side_effect = None
+    api_client.send_post.return_value = []
+    assert tr_plugin.retry_failed_batches() == []
+    api_client.send_post.assert_called_with(plugin.ADD_RESULTS_URL.format(10), {'results': sent[1]},
+                                            cert_check=True)
+
+
+def test_add_results_batch_exception(api_client, tr_plugin):
+    tr_plugin.batch_size = 1
+    tr_plugin.results = [
+        {'case_id': case_id, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'defects': None} for case_id in (1, 2)
+    ]
+    api_client.send_post.side_effect = [IOError('Connection reset'), []]
+
+    tr_plugin.add_results(10)
+
+    assert api_client.send_post.call_count == 2
+    assert [batch['error'] for batch in tr_plugin.failed_batches] == ['OSError: Connection reset']
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_streaming_flushes_on_batch_size(api_client, tr_plugin):
+    tr_plugin.testrun_id = 10
+    tr_plugin.batch_size = 2
+    tr_plugin.stream_interval = 60
+    api_client.send_post.return_value = []
+    tr_plugin.start_streaming()
+
+    tr_plugin.add_result([1, 2], TESTRAIL_TEST_STATUS["passed"], comment='')
+    assert _wait_for(lambda: api_client.send_post.call_count == 1)
+    tr_plugin.add_result([3], TESTRAIL_TEST_STATUS["failed"], comment='')
+
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    sent = [[entry['case_id'] for entry in c[0][1]['results']] for c in api_client.send_post.call_args_list]
+    assert sent == [[1, 2], [3]]
+    assert all(c[0][0] == plugin.ADD_RESULTS_URL.format(10) for c in api_client.send_post.call_args_list)
+
+
+def test_streaming_holds_back_merged_results(api_client, tr_plugin, capsys):
+    tr_plugin.testrun_id = 10
+    tr_plugin.batch_size = 2
+    tr_plugin.stream_interval = 0.01
+    tr_plugin.merge_policy = plugin.MERGE_WORST
+    api_client.send_post.return_value = []
+    tr_plugin.start_streaming()
+
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS["failed"], comment='')
+    tr_plugin.add_result([2, 3], TESTRAIL_TEST_STATUS["passed"], comment='')
+    time.sleep(0.05)
+    assert api_client.send_post.call_count == 0
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS["passed"], comment='')
+
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    assert 'published at the end of the session' in capsys.readouterr().out
+    results = [r for c in api_client.send_post.call_args_list for r in c[0][1]['results']]
+    assert sorted(r['case_id'] for r in results) == [1, 2, 3]
+    assert [r['status_id'] for r in results if r['case_id'] == 1] == [TESTRAIL_TEST_STATUS["failed"]]
+
+
+@pytest.mark.parametrize('stream_interval', ['0', '-1', -0.5])
+def test_stream_interval_checked(stream_interval):
+    with pytest.raises(ValueError):
+        PyTestRailPlugin(None, 1, 1, 1, False, True, None, stream=True, stream_interval=stream_interval)
+
+
+def test_streaming_flushes_on_interval_to_testplan(api_client, tr_plugin):
+    tr_plugin.testplan_id = 100
+    tr_plugin.stream_interval = 0.01
+    api_client.send_get.return_value = TESTPLAN
+    api_client.send_post.return_value = []
+    tr_plugin.start_streaming()
+
+    tr_plugin.add_result([1234], TESTRAIL_TEST_STATUS["passed"], comment='')
+    assert _wait_for(lambda: api_client.send_post.call_count == 2)
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    assert api_client.send_get.call_count == 1
+    assert [c[0][0] for c in api_client.send_post.call_args_list] == [
+        plugin.ADD_RESULTS_URL.format(59), plugin.ADD_RESULTS_URL.format(61)]
+
+
+def test_pytest_sessionfinish_testplan_concurrently(api_client, tr_plugin):
+    tr_plugin.results = [{'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'defects': None}]
+    tr_plugin.testplan_id = 100
+    tr_plugin.testrun_id = 0
+    tr_plugin.publish_workers = 2
+    api_client.send_get.return_value = TESTPLAN
+    threads = set()
+
+    def send_post(uri, data, **kwargs):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        return []
+    api_client.send_post.side_effect = send_post
+
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    assert sorted(c[0][0] for c in api_client.send_post.call_args_list) == [
+        plugin.ADD_RESULTS_URL.format(59), plugin.ADD_RESULTS_URL.format(61)]
+    assert len(threads) == 2
+    assert sorted(tr_plugin.publish_timings) == [59, 61]
+    assert all(timing >= 0.05 for timing in tr_plugin.publish_timings.values())
+
+
+def test_payload_rendered_once_for_testplan(api_client, tr_plugin, monkeypatch):
+    tr_plugin.results = [
+        {'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'comment': 'An error', 'defects': None},
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'defects': None}
+    ]
+    tr_plugin.testplan_id = 100
+    tr_plugin.testrun_id = 0
+    api_client.send_get.return_value = TESTPLAN
+    rendered = []
+    render_result = tr_plugin.render_result
+    monkeypatch.setattr(tr_plugin, 'render_result', lambda result: rendered.append(result) or render_result(result))
+
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    assert api_client.send_post.call_count == 2
+    assert [result['case_id'] for result in rendered] == [1234, 5678]
+    assert tr_plugin.build_payload() is tr_plugin.build_payload()
+
+
+def test_results_payload_exclude():
+    payload = plugin.ResultsPayload([{'case_id': 1}, {'case_id': 2}, {'case_id': 1}, {'case_id': 3}])
+
+    excluded = payload.exclude([1, 4])
+    assert excluded.entries == [{'case_id': 2}, {'case_id': 3}]
+    assert excluded.sizes == [len(plugin.json.dumps(entry)) for entry in excluded.entries]
+    assert payload.exclude([]) is payload
+
+
+def test_add_result_does_not_keep_longrepr(tr_plugin):
+    class LongRepr(object):
+        def __str__(self):
+            return 'line\n' * plugin.COMMENT_SIZE_LIMIT
+
+    longrepr = LongRepr()
+    ref = weakref.ref(longrepr)
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS["failed"], comment=longrepr)
+    del longrepr
+
+    assert ref() is None
+    result = tr_plugin.results[0]
+    assert result.truncated is True
+    assert len(result.comment) == plugin.COMMENT_SIZE_LIMIT
+    assert result['case_id'] == 1 and result.get('unknown', 'default') == 'default'
+    with pytest.raises(AttributeError):
+        result.extra = 'no __dict__'
+
+    entry = tr_plugin.render_result(result)
+    assert entry['comment'].startswith(u'{}\n# Pytest result: #\nLog truncated\n...\n    line'.format(CUSTOM_COMMENT))
+
+
+def failure_repr(captured_lines):
+    def check(value):
+        assert value == [1, 2, 4], 'message\nwith lines'
+
+    try:
+        try:
+            raise ValueError('cause')
+        except ValueError:
+            check([1, 2, 3])
+    except AssertionError:
+        longrepr = pytest.ExceptionInfo.from_current().getrepr(showlocals=True, chain=True)
+    longrepr.addsection('Captured log', 'log line\n' * captured_lines)
+    return longrepr
+
+
+@pytest.mark.parametrize('strategy', plugin.COMMENT_STRATEGIES)
+def test_comment_renderer_reads_report_fragments(strategy):
+    longrepr = failure_repr(10)
+    text = str(longrepr)
+
+    assert plugin.CommentRenderer(len(text), strategy).render(longrepr) == (text, False)
+
+    comment, truncated = plugin.CommentRenderer(500, strategy).render(longrepr)
+    assert truncated is True and len(comment) == 500
+    if strategy == plugin.COMMENT_TAIL:
+        assert comment == text[-500:]
+    elif strategy == plugin.COMMENT_HEAD:
+        assert comment == text[:500]
+    else:
+        head, tail = comment.split(plugin.COMMENT_ELLIPSIS)
+        assert text.startswith(head) and text.endswith(tail)
+
+
+def test_add_result_renders_comment_once(tr_plugin):
+    tr_plugin.comment_renderer = plugin.CommentRenderer(100, plugin.COMMENT_HEAD)
+    tr_plugin.add_result([1, 2], TESTRAIL_TEST_STATUS["failed"], comment=failure_repr(100000))
+
+    first, second = tr_plugin.results
+    assert second.case_id == 2 and second.comment is first.comment
+    assert first.truncated is True and first.comment.startswith('def failure_repr')
+
+    entry = tr_plugin.render_result(second)
+    assert entry['comment'].startswith(u'{}\n# Pytest result: #\nLog truncated\n    def'.format(CUSTOM_COMMENT))
+    assert entry['comment'].endswith(u'\n...')
+
+
+@pytest.mark.parametrize(('policy', 'expected'), [
+    (plugin.MERGE_LAST, ('passed', 'n=3')),
+    (plugin.MERGE_WORST, ('failed', 'n=2')),
+    (plugin.MERGE_FIRST_FAILURE, ('failed', 'n=1')),
+])
+def test_merge_results(policy, expected):
+    results = [plugin.CaseResult(1, TESTRAIL_TEST_STATUS[status], duration=1, test_parametrize='n={}'.format(index))
+               for index, status in enumerate(['passed', 'failed', 'failed', 'passed'])]
+    results.insert(2, {'case_id': 2, 'status_id': TESTRAIL_TEST_STATUS['blocked']})
+
+    first, second = plugin.merge_results(results, policy)
+
+    assert isinstance(first, plugin.MergedCaseResult)
+    assert (first.status_id, first.test_parametrize) == (TESTRAIL_TEST_STATUS[expected[0]], expected[1])
+    assert first.duration == 4
+    assert first.summary == '4 results: 2 passed, 2 failed\nNot passed: n=1, n=2'
+    assert second is results[2]
+    assert plugin.merge_results(results, plugin.MERGE_ALL) is results
+
+
+def test_merged_results_published_once_per_case(api_client, tr_plugin, monkeypatch):
+    monkeypatch.setattr('pytest_testrail.results.MERGE_SUMMARY_PARAMS', 2)
+    tr_plugin.merge_policy = plugin.MERGE_WORST
+    for index in range(500):
+        status = 'failed' if index % 100 == 7 else 'passed'
+        tr_plugin.add_result([1, 2], TESTRAIL_TEST_STATUS[status], comment='error' if status == 'failed' else None,
+                             test_parametrize={'index': index})
+
+    tr_plugin.add_results(10)
+
+    entries = api_client.send_post.call_args[0][1]['results']
+    assert [entry['case_id'] for entry in entries] == [1, 2]
+    assert entries[0]['status_id'] == TESTRAIL_TEST_STATUS['failed']
+    assert entries[0]['comment'].startswith(
+        u"# Merged results: #\n500 results: 495 passed, 5 failed\nNot passed: {'index': 7}, {'index': 107}, "
+        u"... (3 more)\n\n# Test parametrize: #\n{'index': 407}\n\n")
+
+
+def test_merge_policy_checked():
+    with pytest.raises(ValueError):
+        PyTestRailPlugin(None, 1, 1, 1, False, True, None, merge_policy='best')
+
+
+def test_index_items(pytest_test_items, tr_plugin):
+    items_with_tr_keys = tr_plugin.index_items(pytest_test_items)
+
+    assert [(item, list(ids)) for item, ids in items_with_tr_keys] == [
+        (pytest_test_items[0], [1234, 5678]), (pytest_test_items[1], [8765, 4321])]
+    assert tr_plugin.testrail_keys[pytest_test_items[1].nodeid] == ([8765, 4321], 'PF-418, PF-517')
+
+
+def test_get_item_keys_parsed_once(pytest_test_items, tr_plugin, monkeypatch):
+    tr_plugin.index_items(pytest_test_items)
+    monkeypatch.setattr(plugin, 'get_item_keys', lambda item: pytest.fail('markers parsed again'))
+
+    assert tr_plugin.get_item_keys(pytest_test_items[0]) == ([1234, 5678], None)
+
+
+def test_run_membership():
+    membership = plugin.RunMembership([
+        {'case_id': 1, 'status_id': TESTRAIL_TEST_STATUS["blocked"]},
+        {'case_id': 2, 'status_id': TESTRAIL_TEST_STATUS["passed"]},
+        {'case_id': 3, 'status_id': TESTRAIL_TEST_STATUS["blocked"]},
+    ])
+
+    assert membership.case_ids == frozenset([1, 2, 3])
+    assert 2 in membership and 4 not in membership
+    assert membership.with_status(TESTRAIL_TEST_STATUS["blocked"]) == frozenset([1, 3])
+    assert membership.with_status(TESTRAIL_TEST_STATUS["failed"]) == frozenset()
+
+
+def test_run_membership_shared_by_skip_missing_and_blocked(api_client, pytest_test_items):
+    my_plugin = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID, SUITE_ID, False, True, TR_NAME,
+                                 run_id=10, publish_blocked=False, skip_missing=True)
+    my_plugin.is_testrun_available = lambda: True
+    api_client.send_get.return_value = [
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["blocked"]},
+        {'case_id': 8765, 'status_id': TESTRAIL_TEST_STATUS["untested"]}
+    ]
+
+    my_plugin.pytest_collection_modifyitems(None, None, pytest_test_items)
+    my_plugin.add_result([1234, 5678], TESTRAIL_TEST_STATUS["passed"])
+    my_plugin.add_result([8765], TESTRAIL_TEST_STATUS["passed"])
+    my_plugin.pytest_sessionfinish(None, 0)
+
+    assert api_client.send_get.call_count == 1
+    sent = api_client.send_post.call_args[0][1]['results']
+    assert [entry['case_id'] for entry in sent] == [5678, 8765]
+
+
+def test_get_tests_paginated(api_client, tr_plugin):
+    api_client.send_get.side_effect = [
+        {'offset': 0, 'limit': 2, 'size': 2, '_links': {'next': '/api/v2/get_tests/10&limit=2&offset=2', 'prev': None},
+         'tests': [{'id': 1, 'case_id': 1234, 'status_id': 1, 'title': 'x'},
+                   {'id': 2, 'case_id': 5678, 'status_id': 2}]},
+        {'offset': 2, 'limit': 2, 'size': 1, '_links': {'next': None, 'prev': '/api/v2/get_tests/10&limit=2&offset=0'},
+         'tests': [{'id': 3, 'case_id': 8765, 'status_id': 3}]},
+    ]
+
+    assert tr_plugin.get_tests(10) == [
+        {'case_id': 1234, 'status_id': 1}, {'case_id': 5678, 'status_id': 2}, {'case_id': 8765, 'status_id': 3}]
+    assert api_client.send_get.call_args_list == [
+        call(plugin.GET_TESTS_URL.format(10), cert_check=True),
+        call('get_tests/10&limit=2&offset=2', cert_check=True)]
+
+
+def test_get_tests_error_on_next_page(api_client, tr_plugin):
+    api_client.send_get.side_effect = [
+        {'_links': {'next': '/api/v2/get_tests/10&offset=250'}, 'tests': [{'case_id': 1234, 'status_id': 1}]},
+        {'error': 'Field :offset is not a valid offset.'},
+    ]
+
+    assert tr_plugin.get_tests(10) is None
+
+    api_client.send_get.side_effect = [{'error': 'Field :run_id is not a valid test run.'}]
+    assert tr_plugin.get_run_membership(11) is None
+
+
+class FakeConfig(object):
+    def __init__(self):
+        self.workeroutput = {}
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.config = FakeConfig()
+
+
+class FakeNode(object):
+    def __init__(self, workeroutput):
+        self.workeroutput = workeroutput
+
+
+def test_xdist_worker_ships_results_to_controller(api_client, pytest_test_items):
+    worker = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID, SUITE_ID, False, True, TR_NAME,
+                              xdist_role=plugin.XDIST_WORKER)
+    session = FakeSession()
+
+    worker.pytest_collection_modifyitems(session, session.config, pytest_test_items)
+    worker.add_result([1234, 5678], TESTRAIL_TEST_STATUS["failed"], comment='An error', duration=2,
+                      test_parametrize={'value': 1})
+    worker.pytest_sessionfinish(session, 0)
+
+    assert not api_client.send_get.called and not api_client.send_post.called
+    assert session.config.workeroutput[plugin.XDIST_OUTPUT_KEY] == {
+        'case_ids': [1234, 5678, 8765, 4321],
+        'results': [
+            (1234, TESTRAIL_TEST_STATUS["failed"], 'An error', 2, None, "{'value': 1}", False),
+            (5678, TESTRAIL_TEST_STATUS["failed"], 'An error', 2, None, "{'value': 1}", False),
+        ]
+    }
+
+
+def test_xdist_controller_creates_one_run_and_publishes_once(api_client):
+    controller = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID, SUITE_ID, False, True, 'name',
+                                  xdist_role=plugin.XDIST_CONTROLLER)
+    api_client.send_post.side_effect = [{'id': 42}, []]
+    outputs = [
+        {'case_ids': [1, 2], 'results': [(1, TESTRAIL_TEST_STATUS["passed"], None, 1, None, None, False)]},
+        {'case_ids': [2, 3], 'results': [(3, TESTRAIL_TEST_STATUS["failed"], 'err', 1, None, None, True)]},
+    ]
+
+    for output in outputs:
+        controller.pytest_testnodedown(FakeNode({plugin.XDIST_OUTPUT_KEY: output}), None)
+    controller.pytest_sessionfinish(None, 0)
+
+    assert api_client.send_post.call_args_list[0][0][0] == plugin.ADD_TESTRUN_URL.format(PROJECT_ID)
+    assert api_client.send_post.call_args_list[0][0][1]['case_ids'] == [1, 2, 3]
+    assert api_client.send_post.call_args_list[1][0][0] == plugin.ADD_RESULTS_URL.format(42)
+    entries = api_client.send_post.call_args_list[1][0][1]['results']
+    assert [entry['case_id'] for entry in entries] == [1, 3]
+    assert 'Log truncated' in entries[1]['comment']
+    assert api_client.send_post.call_count == 2
+
+
+def test_xdist_end_to_end(testdir):
+    pytest.importorskip('xdist')
+    testdir.makepyfile(PYTEST_FILE.replace('import testrail, ', 'import ').replace('@testrail(', '@pytestrail.case('))
+    with StubTestRailServer() as stub:
+        result = testdir.runpytest('-n', '2', '-p', 'pytest_testrail.conftest', '--testrail', '--tr-url', stub.url,
+                                   '--tr-email', 'user', '--tr-password', 'key', '--tr-testrun-project-id', '1',
+                                   '--tr-testrun-suite-id', '1')
+        result.assert_outcomes(passed=2)
+        endpoints = [request.endpoint for request in stub.requests]
+
+    assert endpoints == ['add_run', 'add_results_for_cases']
+    assert sorted(stub.requests[0].json()['case_ids']) == [1234, 4321, 5678, 8765]
+    assert sorted(entry['case_id'] for entry in stub.requests[1].json()['results']) == [1234, 4321, 5678, 8765]
+
+
+def test_async_option_uses_client_settings(testdir):
+    testdir.makepyfile("""
+        from pytest_testrail.plugin import pytestrail
+
+        @pytestrail.case('C1')
+        def test_one():
+            pass
+    """)
+    with StubTestRailServer() as stub:
+        # results are published asynchronously to testplans with several testruns
+        stub.plan = {'id': 1, 'is_completed': False, 'entries': [
+            {'runs': [{'id': run_id, 'is_completed': False}]} for run_id in (7, 8)]}
+        result = testdir.runpytest('-p', 'pytest_testrail.conftest', '--testrail', '--tr-async', '--tr-url', stub.url,
+                                   '--tr-email', 'user', '--tr-password', 'key', '--tr-plan-id', '1',
+                                   '--tr-compress-threshold', '1', '--tr-serializer', 'json')
+        result.assert_outcomes(passed=1)
+        uploads = [request for request in stub.requests if request.endpoint == 'add_results_for_cases']
+
+    assert len(uploads) == 2
+    assert all(request.headers.get('Content-Encoding') == 'gzip' for request in uploads)
+
+
+def test_entry_point_does_not_import_plugin_dependencies():
+    # the entry point is loaded by every pytest run, even without --testrail
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import pytest_testrail.conftest'],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stderr
+    modules = set(line.split('|')[-1].strip() for line in output.splitlines() if line.startswith('import time:'))
+
+    assert 'pytest_testrail.conftest' in modules
+    assert not modules & {'requests', 'urllib3', 'asyncio', 'pytest_testrail.plugin', 'pytest_testrail.testrail_api'}
@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+import threading
+
+import pytest
+
+from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.sharding import ShardRendezvous
+from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
+
+
+def run_shard(stub, shard_dir, shard_id, case_ids, run_ids):
+    client = APIClient(stub.url, 'user@email.com', 'api_key')
+    shard = ShardRendezvous(shard_dir, shard_count=3, shard_id=shard_id, timeout=10, poll_interval=0.01)
+    tr_plugin = PyTestRailPlugin(client, 1, 2, 3, False, True, 'Sharded run', close_on_complete=True, shard=shard)
+
+    tr_plugin.prepare_testrun(case_ids)
+    run_ids[shard_id] = tr_plugin.testrun_id
+    tr_plugin.add_result(case_ids, TESTRAIL_TEST_STATUS['passed'])
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+
+def test_shards_share_one_testrun(tmpdir):
+    shard_cases = {'node-a': [1, 2], 'node-b': [2, 3], 'node-c': [4]}
+    run_ids = {}
+    with StubTestRailServer() as stub:
+        threads = [threading.Thread(target=run_shard, args=(stub, str(tmpdir), shard_id, case_ids, run_ids))
+                   for shard_id, case_ids in shard_cases.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        requests = list(stub.requests)
+
+    endpoints = [request.endpoint for request in requests]
+    assert endpoints.count('add_run') == 1
+    assert requests[endpoints.index('add_run')].json()['case_ids'] == [1, 2, 3, 4]
+    assert set(run_ids.values()) == set([1])
+    assert endpoints.count('add_results_for_cases') == 3
+    # closed once, after every shard published its results
+    assert endpoints.count('close_run') == 1
+    assert endpoints[-1] == 'close_run'
+
+
+def test_shard_times_out_without_testrun(tmpdir):
+    shard = ShardRendezvous(str(tmpdir), shard_count=2, shard_id='late', timeout=0.05, poll_interval=0.01)
+    shard._acquire('run.lock')  # another shard is creating the testrun but never publishes it
+
+    assert shard.get_or_create_run([1], create_run=lambda case_ids: pytest.fail('testrun created twice')) == 0
+
+
+def test_shard_finish_elects_a_single_closer(tmpdir):
+    shards = [ShardRendezvous(str(tmpdir), shard_count=2, shard_id=str(index)) for index in range(2)]
+
+    assert shards[0].finish() is False
+    assert shards[1].finish() is True
+    assert shards[0].finish() is False
@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+import json
+
+import pytest
+
+from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.spool import ResultSpool, FSYNC_ALWAYS
+from pytest_testrail.testrail_api import APIClient
+from tests.stub_server import StubTestRailServer
+
+pytest_plugins = "pytester"
+
+TEST_FILE = """
+from pytest_testrail.plugin import pytestrail
+
+@pytestrail.case('C1')
+def test_one():
+    pass
+
+@pytestrail.case('C2', 'C3')
+def test_two():
+    assert False
+"""
+
+
+@pytest.fixture
+def stub():
+    with StubTestRailServer() as server:
+        yield server
+
+
+def make_plugin(stub, spool=None):
+    client = APIClient(stub.url, 'user@email.com', 'api_key', retries=0)
+    return PyTestRailPlugin(client, 1, 1, 1, False, True, None, run_id=5, batch_size=1, spool=spool)
+
+
+def uploaded_case_ids(stub):
+    return [entry['case_id'] for request in stub.requests if request.endpoint == 'add_results_for_cases'
+            for entry in request.json()['results']]
+
+
+def test_publish_spool_resumes_after_last_acknowledged_batch(stub, tmpdir):
+    path = str(tmpdir.join('results.spool'))
+    tr_plugin = make_plugin(stub, ResultSpool(path, fsync=FSYNC_ALWAYS))
+    tr_plugin.prepare_testrun([1, 2, 3])
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS['passed'])
+    tr_plugin.add_result([2, 3], TESTRAIL_TEST_STATUS['failed'], comment='assert False')
+
+    # TestRail goes down after the first batch
+    stub.inject(200, body=[{'case_id': 1}])
+    stub.inject(500, times=2)
+    tr_plugin.add_results(tr_plugin.testrun_id)
+    tr_plugin.spool.close()
+    assert len(tr_plugin.failed_batches) == 2
+
+    stub.requests = []
+    assert make_plugin(stub).publish_spool(ResultSpool(path, resume=True)) is True
+    assert uploaded_case_ids(stub) == [2, 3]
+    assert stub.requests[-1].json()['results'][0]['comment'].endswith('assert False')
+
+    # everything is acknowledged now
+    stub.requests = []
+    assert make_plugin(stub).publish_spool(ResultSpool(path, resume=True)) is True
+    assert uploaded_case_ids(stub) == []
+
+
+def test_spool_drops_partial_last_line(tmpdir):
+    path = tmpdir.join('results.spool')
+    path.write('{"target": {"run_id": 5}}\n{"result": [1, 1, "", 0, null, null, false]}\n{"result": [2, ')
+
+    spool = ResultSpool(str(path), resume=True)
+    spool.ack(5, (0, 1), [{'case_id': 1}])
+    spool.close()
+
+    lines = [json.loads(line) for line in path.read().splitlines()]
+    assert len(lines) == 3 and lines[-1]['ack'] == 5
+    assert spool.results == [[1, 1, '', 0, None, None, False]]
+
+
+def test_spool_uploads(tmpdir):
+    spool = ResultSpool(str(tmpdir.join('results.spool')))
+    # results streamed by chunks: [0, 4) published to both testruns, [4, 6) only to testrun 1
+    spool.ack(1, (0, 4), [{'case_id': 1}])
+    spool.ack(2, (0, 4), [{'case_id': 1}])
+    spool.ack(1, (4, 6), [{'case_id': 5}])
+
+    assert spool.uploads(1, 10) == [(0, 4), (4, 6), (6, 10)]
+    assert spool.uploads(2, 10) == [(0, 4), (4, 10)]
+    assert spool.uploads(3, 10) == [(0, 10)]
+    assert spool.is_acked(1, (0, 4), [{'case_id': 1}])
+    assert not spool.is_acked(1, (0, 4), [{'case_id': 2}])
+
+
+def test_publish_spool_command_line(testdir, stub):
+    testdir.makepyfile(TEST_FILE)
+    path = str(testdir.tmpdir.join('results.spool'))
+    options = ['-p', 'pytest_testrail.conftest', '--tr-url', stub.url, '--tr-email', 'user', '--tr-password', 'key',
+               '--tr-run-id', '5', '--tr-retries', '0']
+    # publishing fails at the end of the session
+    add_results_for_cases = stub.routes['add_results_for_cases']
+    stub.routes['add_results_for_cases'] = lambda request: (500, {'error': 'Internal Server Error'}, {})
+    result = testdir.runpytest('--testrail', '--tr-spool', path, *options)
+    result.assert_outcomes(passed=1, failed=1)
+    assert [request.endpoint for request in stub.requests] == ['get_run', 'add_results_for_cases']
+
+    stub.requests = []
+    stub.routes['add_results_for_cases'] = add_results_for_cases
+    result = testdir.runpytest('--tr-publish-spool', path, *options)
+
+    assert result.ret == 0
+    assert 'passed' not in result.stdout.str()
+    assert sorted(uploaded_case_ids(stub)) == [1, 2, 3]
@@ -0,0 +1,358 @@
+# -*- coding: UTF-8 -*-
+import os
+import pytest
+import threading
+import time
+from types import SimpleNamespace
+
+from pytest_testrail import testrail_api
+from pytest_testrail.plugin import CaseResult, PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.serializers import available_serializers, get_serializer
+from pytest_testrail.testrail_api import APIClient, RateLimiter
+from tests.stub_server import StubTestRailServer
+
+
+@pytest.fixture
+def stub():
+    with StubTestRailServer() as server:
+        yield server
+
+
+@pytest.fixture
+def client(stub):
+    with APIClient(stub.url, 'user@email.com', 'api_key') as api_client:
+        yield api_client
+
+
+def test_connections_are_reused(client, stub):
+    for run_id in range(5):
+        assert client.send_get('get_run/{}'.format(run_id)) == {'id': run_id, 'is_completed': False}
+    client.send_post('add_results_for_cases/1', {'results': []})
+
+    assert len(stub.requests) == 6
+    assert stub.connections == 1
+
+
+def test_close_releases_session(client, stub):
+    client.send_get('get_run/1')
+    session = client.session
+    client.close()
+
+    assert client._session is None
+    client.send_get('get_run/1')
+    assert client.session is not session
+    assert stub.connections == 2
+
+
+def test_pool_size(stub):
+    api_client = APIClient(stub.url, 'user@email.com', 'api_key', pool_size='3')
+    adapter = api_client.session.get_adapter(stub.url)
+    assert api_client.pool_size == 3
+    assert adapter._pool_maxsize == 3
+
+
+def test_basic_auth_is_sent(client, stub):
+    client.send_get('get_run/1')
+    assert stub.requests[0].headers['Authorization'].startswith('Basic ')
+
+
+def test_too_many_requests_pauses_every_thread(client, stub, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(testrail_api.time, 'sleep', sleeps.append)
+    stub.inject(429, headers={'Retry-After': '30'})
+
+    assert client.send_post('add_results_for_cases/1', {'results': []}) == []
+    assert len(sleeps) == 1 and 29 < sleeps[0] <= 30
+
+    # another thread sending a request while the pause is running waits as well
+    thread = threading.Thread(target=client.send_get, args=('get_run/1',))
+    thread.start()
+    thread.join()
+    assert len(sleeps) == 2 and sleeps[1] <= sleeps[0]
+    assert len(stub.requests) == 3
+
+
+def test_too_many_requests_retries_are_bounded(client, stub, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(testrail_api.time, 'sleep', sleeps.append)
+    client.rate_limit_retries = 2
+    stub.inject(429, body={'error': 'API rate limit exceeded'}, times=5)
+
+    assert client.send_post('add_results_for_cases/1', {'results': []}) == {'error': 'API rate limit exceeded'}
+
+    # without Retry-After, jittered exponential backoff
+    assert len(sleeps) == 2 and 0.5 <= sleeps[0] <= 1 and 1 <= sleeps[1] <= 2
+    assert len(stub.requests) == 3
+    stats = client.throttle_stats
+    assert (stats.too_many_requests, stats.throttled_requests, stats.gave_up) == (2, 2, 1)
+    assert stats.throttled_time == pytest.approx(sum(sleeps), abs=0.1)
+
+
+def test_periodically_throttled_server(client, stub):
+    stub.throttle = 3
+
+    for run_id in range(5):
+        assert client.send_get('get_run/{}'.format(run_id)) == {'id': run_id, 'is_completed': False}
+
+    # every third request is answered with '429', then sent again
+    assert [request.uri for request in stub.requests] == ['get_run/0', 'get_run/1', 'get_run/2', 'get_run/2',
+                                                          'get_run/3', 'get_run/4', 'get_run/4']
+    assert client.throttle_stats.too_many_requests == 2
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # only the client's sleeps, not the ones of the stub server
+    delays = []
+    monkeypatch.setattr(testrail_api, 'time', SimpleNamespace(time=time.time, sleep=delays.append))
+    return delays
+
+
+def test_get_retried_on_transient_errors(client, stub, sleeps):
+    stub.inject(502, body=b'<html>Bad Gateway</html>')
+    stub.inject(None)  # connection reset
+    stub.inject(0, delay=0.5)  # read timeout
+    client.timeout = 0.2
+
+    assert client.send_get('get_run/1') == {'id': 1, 'is_completed': False}
+    assert len(stub.requests) == 4
+    assert len(sleeps) == 3 and 0.5 <= sleeps[0] <= 1 and 1 <= sleeps[1] <= 2 and 2 <= sleeps[2] <= 4
+
+
+def test_retries_are_bounded(client, stub, sleeps):
+    client.retries = 2
+    stub.inject(502, body=b'<html>Bad Gateway</html>', times=5)
+
+    assert client.send_get('get_run/1') == {'error': 'HTTP 502: the response is not valid JSON'}
+    assert len(stub.requests) == 3
+
+
+@pytest.mark.parametrize('status', [None, 500, 502, 504])
+def test_results_not_posted_twice(client, stub, sleeps, status):
+    stub.inject(status)
+
+    response = client.send_post('add_results_for_cases/1', {'results': [{'case_id': 1}]})
+
+    assert client.get_error(response)
+    assert len(stub.requests) == 1 and sleeps == []
+
+
+def test_results_not_posted_twice_on_read_timeout(client, stub, sleeps):
+    client.timeout = 0.2
+    stub.inject(0, delay=0.5)
+
+    assert client.get_error(client.send_post('add_results_for_cases/1', {'results': []})).startswith('ReadTimeout')
+    assert len(stub.requests) == 1
+
+
+def test_post_retried_when_not_processed(client, stub, sleeps):
+    stub.inject(503)
+    assert client.send_post('add_results_for_cases/1', {'results': [{'case_id': 1}]}) == [{'case_id': 1}]
+
+    stub.inject(502)
+    assert client.send_post('close_run/1', {}) == {}
+    assert [request.uri for request in stub.requests] == ['add_results_for_cases/1'] * 2 + ['close_run/1'] * 2
+
+
+def test_post_retried_when_connection_refused(stub, sleeps):
+    url = stub.url
+    stub.stop()
+    api_client = APIClient(url, 'user@email.com', 'api_key', retries=1)
+
+    assert api_client.get_error(api_client.send_post('add_results_for_cases/1', {})).startswith('ConnectionError')
+    assert len(sleeps) == 1
+
+
+def test_rate_limiter_token_bucket(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(testrail_api.time, 'time', lambda: now[0])
+    limiter = RateLimiter(rate=600, burst=2)  # 10 requests per second
+
+    assert [limiter.reserve() for _ in range(4)] == [0, 0, pytest.approx(0.1), pytest.approx(0.2)]
+    now[0] += 1
+    assert limiter.reserve() == 0
+    assert limiter.stats.throttled_requests == 2
+
+    limiter.update({'X-RateLimit-Limit': '60', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '5'})
+    assert limiter.rate == 60
+    assert limiter.reserve() == pytest.approx(5)
+    limiter.update({'X-RateLimit-Limit': '120'})
+    assert limiter.rate == 60
+
+
+def test_get_tests_paginated_against_stub(client, stub):
+    stub.page_size = 250
+    stub.tests = [{'id': index, 'case_id': index, 'status_id': 1 + index % 5} for index in range(600)]
+    tr_plugin = PyTestRailPlugin(client, 1, 1, 1, False, True, None)
+
+    membership = tr_plugin.get_run_membership(10)
+
+    assert membership.case_ids == frozenset(range(600))
+    assert [request.uri for request in stub.requests] == [
+        'get_tests/10', 'get_tests/10&limit=250&offset=250', 'get_tests/10&limit=250&offset=500']
+
+
+@pytest.fixture
+def cached_client(stub, tmpdir):
+    with APIClient(stub.url, 'user@email.com', 'api_key', cache_dir=str(tmpdir.join('cache')),
+                   cache_ttl=60) as api_client:
+        yield api_client
+
+
+def test_cache_serves_fresh_metadata(cached_client, stub, tmpdir):
+    assert cached_client.send_get('get_run/1') == {'id': 1, 'is_completed': False}
+    assert cached_client.send_get('get_run/1') == {'id': 1, 'is_completed': False}
+    assert cached_client.send_get('get_case/1') == {'error': 'Unknown method'}
+    assert cached_client.send_get('get_case/1') == {'error': 'Unknown method'}
+    assert [request.uri for request in stub.requests] == ['get_run/1', 'get_case/1', 'get_case/1']
+
+    # shared by other clients (i.e. other processes) using the same directory
+    other_client = APIClient(stub.url, 'user@email.com', 'api_key', cache_dir=str(tmpdir.join('cache')),
+                             cache_ttl=60)
+    assert other_client.send_get('get_run/1') == {'id': 1, 'is_completed': False}
+    assert len(stub.requests) == 3
+
+
+def test_cache_dir_created_by_another_session(stub, tmpdir, monkeypatch):
+    mkdir = os.mkdir
+
+    def concurrent_mkdir(path, *args):
+        mkdir(path, *args)  # by another session
+        mkdir(path, *args)
+
+    monkeypatch.setattr('os.mkdir', concurrent_mkdir)
+
+    with APIClient(stub.url, 'user@email.com', 'api_key', cache_dir=str(tmpdir.join('cache')),
+                   cache_ttl=60) as api_client:
+        assert api_client.cache is not None
+
+
+def test_cache_revalidates_stale_metadata_with_etag(cached_client, stub):
+    stub.etags = True
+    cached_client.send_get('get_plan/1')
+    cached_client.cache.ttl = 0
+
+    assert cached_client.send_get('get_plan/1') == stub.plan
+    assert 'If-None-Match' not in stub.requests[0].headers
+    assert stub.requests[1].headers['If-None-Match'].startswith('"')
+
+    stub.plan = {'id': 1, 'is_completed': True, 'entries': []}
+    assert cached_client.send_get('get_plan/1') == stub.plan
+    assert len(stub.requests) == 3
+
+
+def test_cache_invalidated_by_writes(cached_client, stub):
+    for uri in ('get_run/1', 'get_run/10', 'get_tests/1', 'get_tests/1&offset=250', 'get_plan/7'):
+        cached_client.send_get(uri)
+
+    cached_client.send_post('add_results_for_cases/1', {'results': []})
+    assert cached_client.cache.get(cached_client._cache_key('get_run/1')) is None
+    assert cached_client.cache.get(cached_client._cache_key('get_tests/1&offset=250')) is None
+    assert cached_client.cache.get(cached_client._cache_key('get_run/10')) is not None
+    assert cached_client.cache.get(cached_client._cache_key('get_plan/7')) is not None
+
+    cached_client.send_post('close_run/10', {})
+    assert cached_client.cache.get(cached_client._cache_key('get_run/10')) is None
+    assert cached_client.cache.get(cached_client._cache_key('get_plan/7')) is None
+
+
+def make_results(count):
+    line = '    def test_{0}():\n>       assert response["status_id"] == {0}\nE       AssertionError'
+    comment = '# Pytest result: #\n' + '\n'.join(line.format(index) for index in range(20))
+    return [{'case_id': index, 'status_id': 5, 'comment': comment} for index in range(count)]
+
+
+def test_large_bodies_are_compressed(stub):
+    results = make_results(50)
+    with APIClient(stub.url, 'user@email.com', 'api_key', compress_threshold=1024) as api_client:
+        assert api_client.send_post('add_results_for_cases/1', {'results': results}) == results
+        api_client.send_post('close_run/1', {})
+
+    compressed, small = stub.requests
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.json() == {'results': results}
+    assert compressed.raw_size * 10 < len(compressed.body)
+    assert 'Content-Encoding' not in small.headers
+
+
+def test_compression_disabled_when_rejected():
+    results = make_results(50)
+    with StubTestRailServer(accept_gzip=False) as stub:
+        with APIClient(stub.url, 'user@email.com', 'api_key', compress_threshold=1024) as api_client:
+            assert api_client.send_post('add_results_for_cases/1', {'results': results}) == results
+            assert api_client.compress_threshold == 0
+            assert api_client.send_post('add_results_for_cases/1', {'results': results}) == results
+
+    assert [request.headers.get('Content-Encoding') for request in stub.requests] == ['gzip', None, None]
+
+
+def test_compression_kept_on_genuine_errors(client, stub):
+    client.compress_threshold = 1024
+    stub.inject(400, body={'error': 'Field :results.case_id is not a valid test case.'})
+
+    assert client.get_error(client.send_post('add_results_for_cases/1', {'results': make_results(50)}))
+    assert client.compress_threshold == 1024
+    assert [request.headers.get('Content-Encoding') for request in stub.requests] == ['gzip']
+
+
+@pytest.mark.parametrize('serializer', available_serializers())
+def test_serializers(stub, serializer):
+    results = [{'case_id': 1, 'status_id': 5, 'comment': u'assert "caf\xe9" == "\u2615"\n'}]
+    with APIClient(stub.url, 'user@email.com', 'api_key', serializer=serializer) as api_client:
+        assert api_client.serializer == serializer
+        assert api_client.send_post('add_results_for_cases/1', {'results': results}) == results
+
+    assert stub.requests[0].json() == {'results': results}
+    assert stub.requests[0].headers['Content-Type'] == 'application/json'
+
+
+@pytest.mark.parametrize('serializer', available_serializers())
+def test_lone_surrogates_published(stub, serializer):
+    # e.g. an undecodable file name in an exception message
+    with APIClient(stub.url, 'user@email.com', 'api_key', serializer=serializer) as api_client:
+        tr_plugin = PyTestRailPlugin(api_client, 1, 1, 1, False, True, None)
+        tr_plugin.add_result([1], TESTRAIL_TEST_STATUS['failed'], comment=u'No such file: /tmp/caf\udce9')
+        tr_plugin.add_results(10)
+
+    assert tr_plugin.failed_batches == []
+    assert u'/tmp/caf\udce9' in stub.requests[0].json()['results'][0]['comment']
+
+
+def test_unencodable_batch_kept_in_failed_batches(client, stub, monkeypatch):
+    def dumps(data):
+        raise ValueError('unencodable')
+    monkeypatch.setattr(client, '_dumps', dumps)
+    monkeypatch.setattr(testrail_api, 'json_dumps', dumps)
+    tr_plugin = PyTestRailPlugin(client, 1, 1, 1, False, True, None)
+    tr_plugin.add_result([1], TESTRAIL_TEST_STATUS['passed'])
+
+    tr_plugin.add_results(10)
+
+    assert stub.requests == []
+    assert [(batch['testrun_id'], batch['error']) for batch in tr_plugin.failed_batches] == [
+        (10, 'ValueError: unencodable')]
+
+
+def test_unknown_serializer():
+    with pytest.raises(ValueError):
+        get_serializer('pickle')
+
+
+def test_pre_encoded_bodies_sent_as_is(client, stub):
+    assert client.send_post('add_results_for_cases/1', b'{"results": [{"case_id": 1}]}') == [{'case_id': 1}]
+    assert stub.requests[0].body == b'{"results": [{"case_id": 1}]}'
+
+
+def test_testplan_batches_encoded_once(client, stub, monkeypatch):
+    encoded = []
+    dumps = client._dumps
+    monkeypatch.setattr(client, '_dumps', lambda data: encoded.append(data) or dumps(data))
+    tr_plugin = PyTestRailPlugin(client, 1, 1, 1, False, True, None, batch_size=2, publish_workers=3)
+    tr_plugin.results = [CaseResult(case_id, TESTRAIL_TEST_STATUS['passed']) for case_id in (1, 2, 3)]
+
+    tr_plugin.publish_to_testruns([10, 11, 12])
+
+    assert len(encoded) == 2
+    assert sorted(request.uri for request in stub.requests) == sorted(
+        'add_results_for_cases/{}'.format(run_id) for run_id in (10, 11, 12) for _ in range(2))
+    assert tr_plugin.failed_batches == []